@@ -0,0 +1,166 @@
+"""
+Bounded-concurrency execution of AI requests with rate limiting
+
+Every provider request goes through ai_executor.call(), which
+- waits for the requests-per-minute and tokens-per-minute buckets,
+- caps the number of requests in flight in this process,
+- retries rate-limit (429), server (5xx) and connection errors with jittered
+  exponential backoff.
+Processing threads call the AI functions directly, so throughput grows with
+the number of emails processed in parallel up to the provider quota instead
+of being limited by one round trip at a time. submit() runs a call on the
+executor's own pool and returns a Future, for callers that fan out several
+requests and gather the results.
+"""
+import os
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+# Requests sent to the AI provider at the same time by this process
+AI_MAX_IN_FLIGHT = int(os.environ.get('AI_MAX_IN_FLIGHT', '8'))
+# Provider quota per minute (0 = unlimited)
+AI_RPM_LIMIT = int(os.environ.get('AI_RPM_LIMIT', '0'))
+AI_TPM_LIMIT = int(os.environ.get('AI_TPM_LIMIT', '0'))
+# Retries after the first attempt for rate-limit and server errors
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', '4'))
+# Backoff bounds in seconds; each retry waits a random time up to base * 2^attempt
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Transport failures; google-genai lets httpx's own exceptions through, and they are
+# not ConnectionError/TimeoutError subclasses
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError, httpx.TimeoutException, httpx.NetworkError,
+                    httpx.RemoteProtocolError)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and dropped connections are worth another attempt"""
+    status = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if status in RETRYABLE_STATUS:
+        return True
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute; a limit of 0 never blocks"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """Take `amount` units, sleeping until they are available; returns the seconds waited"""
+        if not self.capacity or amount <= 0:
+            return 0.0
+        # A request larger than the bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._available >= amount:
+                    self._available -= amount
+                    return waited
+                delay = (amount - self._available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount: float):
+        """Correct an earlier estimate once the actual usage is known (may go into debt)"""
+        if not self.capacity or not amount:
+            return
+        with self._lock:
+            self._refill()
+            self._available = min(self.capacity, self._available - amount)
+
+
+class AIExecutor:
+    """Runs provider requests under an in-flight cap and RPM/TPM buckets, retrying transient errors"""
+
+    def __init__(self, max_in_flight: int = AI_MAX_IN_FLIGHT, rpm: int = AI_RPM_LIMIT,
+                 tpm: int = AI_TPM_LIMIT, max_retries: int = AI_MAX_RETRIES):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'retries': 0, 'failures': 0, 'tokens': 0, 'throttled_seconds': 0.0}
+
+    def _count(self, counter: str, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def call(self, request: Callable[[], Any], estimated_tokens: int = 0) -> Any:
+        """
+        Send one provider request (a no-argument callable) and return its response
+        Raises the last error once retries are exhausted or the error is not transient
+        """
+        attempt = 0
+        while True:
+            throttled = self.requests.acquire(1) + self.tokens.acquire(estimated_tokens)
+            if throttled:
+                self._count('throttled_seconds', throttled)
+
+            with self._slots:
+                self._count('requests')
+                try:
+                    response = request()
+                except Exception as e:
+                    error = e
+                else:
+                    usage = getattr(response, 'usage_metadata', None)
+                    actual = getattr(usage, 'total_token_count', None) if usage else None
+                    if actual:
+                        self.tokens.adjust(actual - estimated_tokens)
+                    self._count('tokens', actual or estimated_tokens)
+                    return response
+
+            if attempt >= self.max_retries or not is_retryable(error):
+                self._count('failures')
+                raise error
+            # Full jitter keeps retries from many threads from arriving together
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            self._count('retries')
+            print(f"AI request failed ({error}); retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Run fn(*args, **kwargs) on the executor's pool; fn's own requests still go through call()"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='ai')
+            pool = self._pool
+        return pool.submit(fn, *args, **kwargs)
+
+    def stats(self) -> Dict:
+        """Counters since process start"""
+        with self._lock:
+            counters = dict(self._counters)
+        counters['throttled_seconds'] = round(counters['throttled_seconds'], 3)
+        counters.update({
+            'max_in_flight': self.max_in_flight,
+            'rpm_limit': int(self.requests.capacity),
+            'tpm_limit': int(self.tokens.capacity)
+        })
+        return counters
+
+
+# Shared by every AI call in this process
+ai_executor = AIExecutor()
@@ -1,15 +1,209 @@
 import json
 import os
-from google import genai
+import re
+import time
+import threading
 from google.genai import types
 from pydantic import BaseModel
 from typing import List, Optional
 
+from analysis_cache import analysis_cache, cache_key
+from ai_executor import ai_executor, is_retryable
+from context_cache import ContextCache
+from ai_providers import get_provider
+
 # IMPORTANT: KEEP THIS COMMENT
 # Using Gemini integration blueprint - user requested Gemini 2.0 Flash
 # The SDK is google-genai (not google-generativeai)
 
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+# Gemini by default; AI_PROVIDER=stub answers offline for load tests (see ai_providers.py)
+provider = get_provider()
+# Write the draft reply in the analysis call for emails that need action, instead of a second call
+AI_FUSED_DRAFT = os.environ.get('AI_FUSED_DRAFT', 'false').lower() in ('1', 'true', 'yes')
+# Bump when the analysis prompt or schema changes, so cached analyses are not reused
+ANALYSIS_PROMPT_VERSION = "1-fused" if AI_FUSED_DRAFT else "1"
+
+# Email body token budgets per call type; bodies over budget are trimmed before the call (0 = no limit)
+DEFAULT_BODY_TOKEN_BUDGET = int(os.environ.get('AI_BODY_TOKEN_BUDGET', '2000'))
+BODY_TOKEN_BUDGETS = {
+    call_type: int(os.environ.get(f'AI_BODY_TOKEN_BUDGET_{call_type.upper()}', str(DEFAULT_BODY_TOKEN_BUDGET)))
+    for call_type in ('analysis', 'draft', 'summary', 'classification', 'priority', 'entities')
+}
+# Rough characters per token for English email text
+CHARS_PER_TOKEN = 4
+# Share of the budget kept from the start and the end of the body; the rest goes to high-value lines
+HEAD_SHARE = 0.4
+TAIL_SHARE = 0.2
+TRIM_MARKER = '[...]'
+# Output tokens reserved per request against the TPM limit until the actual usage is known
+RESPONSE_TOKEN_ESTIMATE = 400
+
+# Multi-email batch analysis (analyze_emails_batch): emails per request, estimated input
+# tokens per request, and the largest email (estimated tokens) that is batched at all
+AI_BATCH_MAX_EMAILS = int(os.environ.get('AI_BATCH_MAX_EMAILS', '20'))
+AI_BATCH_TOKEN_BUDGET = int(os.environ.get('AI_BATCH_TOKEN_BUDGET', '6000'))
+AI_BATCH_MAX_EMAIL_TOKENS = int(os.environ.get('AI_BATCH_MAX_EMAIL_TOKENS', '500'))
+
+# Lines worth keeping from the middle of a long body: questions, dates and amounts
+_HIGH_VALUE_LINE_RE = re.compile(
+    r'\?'
+    r'|\b\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}\b'
+    r'|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.? \d{1,2}\b'
+    r'|\b\d{1,2} (?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b'
+    r'|\b(?:mon|tues|wednes|thurs|fri|satur|sun)day\b|\b(?:today|tomorrow|deadline|asap|eod)\b'
+    r'|[$€£¥]\s?\d|\b\d[\d,.]*\s?(?:usd|eur|gbp|dollars|euros)\b',
+    re.IGNORECASE
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Local token estimate, close enough for budgeting without a count_tokens round trip"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+_usage = {}
+_usage_lock = threading.Lock()
+
+
+def _record_usage(call_type: str, response, seconds: float, provider_seconds: float, estimated_input_tokens: int):
+    """
+    Per call type request count, latency and token usage (estimated when the response has no usage data)
+    seconds includes throttling and retries; provider_seconds only the answered request itself
+    input_tokens is the full prompt; cached_input_tokens the part served from a context cache
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    input_tokens = getattr(usage, 'prompt_token_count', None) or estimated_input_tokens
+    cached_tokens = getattr(usage, 'cached_content_token_count', None) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', None) or 0
+    with _usage_lock:
+        counters = _usage.setdefault(call_type, {
+            'requests': 0, 'cached_requests': 0, 'seconds': 0.0, 'provider_seconds': 0.0,
+            'input_tokens': 0, 'cached_input_tokens': 0, 'output_tokens': 0
+        })
+        counters['requests'] += 1
+        counters['cached_requests'] += 1 if cached_tokens else 0
+        counters['seconds'] += seconds
+        counters['provider_seconds'] += provider_seconds
+        counters['input_tokens'] += input_tokens
+        counters['cached_input_tokens'] += cached_tokens
+        counters['output_tokens'] += output_tokens
+
+
+def ai_usage_stats() -> dict:
+    """Requests, average latency and average tokens per call type since process start"""
+    with _usage_lock:
+        usage = {call_type: dict(counters) for call_type, counters in _usage.items()}
+    for counters in usage.values():
+        requests = counters['requests']
+        counters['seconds'] = round(counters['seconds'], 3)
+        counters['avg_seconds'] = round(counters['seconds'] / requests, 3)
+        # Time around the provider's answer: waiting for rate limits and free slots, failed attempts
+        counters['avg_overhead_seconds'] = round((counters['seconds'] - counters['provider_seconds']) / requests, 4)
+        counters['provider_seconds'] = round(counters['provider_seconds'], 3)
+        counters['avg_input_tokens'] = round(counters['input_tokens'] / requests)
+        # What the prompts cost after context caching, next to the uncached avg_input_tokens
+        counters['avg_uncached_input_tokens'] = round((counters['input_tokens'] - counters['cached_input_tokens']) / requests)
+        counters['avg_output_tokens'] = round(counters['output_tokens'] / requests)
+    return usage
+
+
+_context_caches: List[ContextCache] = []
+
+
+def _context_cache(display_name: str, system_instruction: str) -> ContextCache:
+    """Provider-side cache for a static system prompt, created on first use (see context_cache.py)"""
+    cache = ContextCache(provider, display_name, system_instruction)
+    _context_caches.append(cache)
+    return cache
+
+
+def context_cache_stats() -> dict:
+    return {cache.display_name: cache.stats() for cache in _context_caches}
+
+
+def _send(call_type: str, prompt: str, config: types.GenerateContentConfig, input_tokens: int, response_tokens: int):
+    timing = {}
+
+    def request():
+        sent = time.perf_counter()
+        response = provider.generate(call_type, prompt, config)
+        timing['provider'] = time.perf_counter() - sent
+        return response
+
+    started = time.perf_counter()
+    response = ai_executor.call(request, estimated_tokens=input_tokens + response_tokens)
+    _record_usage(call_type, response, time.perf_counter() - started, timing['provider'], input_tokens)
+    return response
+
+
+def _generate(call_type: str, prompt: str, config: types.GenerateContentConfig,
+              response_tokens: int = RESPONSE_TOKEN_ESTIMATE, context: Optional[ContextCache] = None):
+    """
+    One request to the AI provider, sent through the rate-limited executor (see ai_executor.py)
+    With a context cache for config's system prompt, the cached copy is referenced instead of resending it
+    """
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(config.system_instruction or '')
+    cached_content = context.get() if context is not None else None
+    if cached_content:
+        cached_config = config.model_copy(update={'system_instruction': None, 'cached_content': cached_content})
+        try:
+            return _send(call_type, prompt, cached_config, input_tokens, response_tokens)
+        except Exception as e:
+            # Only an expired, deleted or rejected cache is worth resending with the prompt inline
+            if is_retryable(e) or not context.invalidate(e):
+                raise
+    return _send(call_type, prompt, config, input_tokens, response_tokens)
+
+
+def fit_to_budget(body: str, call_type: str) -> tuple:
+    """
+    Trim an email body to the token budget of the given call type
+    Keeps the head, lines with questions, dates or amounts, and the tail, in their original order
+    Returns (body, truncated)
+    """
+    budget = BODY_TOKEN_BUDGETS.get(call_type, DEFAULT_BODY_TOKEN_BUDGET)
+    if not budget or not body or estimate_tokens(body) <= budget:
+        return body, False
+
+    max_chars = budget * CHARS_PER_TOKEN
+    lines = body.split('\n')
+    keep = [None] * len(lines)
+    used = 0
+
+    # Head: leading lines, cutting the last one short if it doesn't fit
+    head_chars = int(max_chars * HEAD_SHARE)
+    first = 0
+    while first < len(lines) and used < head_chars:
+        keep[first] = lines[first][:head_chars - used]
+        used += len(keep[first]) + 1
+        first += 1
+
+    # Tail: trailing lines, keeping the end of the first one that doesn't fit
+    tail_chars = int(max_chars * TAIL_SHARE)
+    last = len(lines)
+    tail_used = 0
+    while last > first and tail_used < tail_chars:
+        last -= 1
+        line = lines[last]
+        keep[last] = line[max(0, len(line) - (tail_chars - tail_used)):]
+        tail_used += len(keep[last]) + 1
+    used += tail_used
+
+    # Middle: high-value lines that still fit the budget
+    for i in range(first, last):
+        line = lines[i]
+        # A long line that doesn't fit must not crowd out shorter ones further down
+        if _HIGH_VALUE_LINE_RE.search(line) and used + len(line) + 1 <= max_chars:
+            keep[i] = line
+            used += len(line) + 1
+
+    kept = []
+    for line in keep:
+        if line is not None:
+            kept.append(line)
+        elif not kept or kept[-1] != TRIM_MARKER:
+            kept.append(TRIM_MARKER)
+    return '\n'.join(kept), True
 
 
 class EmailClassification(BaseModel):
@@ -51,15 +245,12 @@ class CombinedEmailAnalysis(BaseModel):
     entities: List[ExtractedEntity]
     summary_narrative: str
     action_required: bool
+    # Only filled in fused mode (AI_FUSED_DRAFT), and only for emails that need action
+    draft_subject: Optional[str] = None
+    draft_body: Optional[str] = None
 
 
-def analyze_email_combined(email_subject: str, email_body: str, sender_email: str, has_attachments: bool = False, attachments: list = None) -> dict:
-    """
-    Combined AI analysis: classification, priority, sentiment, entities, and summary in ONE API call.
-    This reduces API usage from 4 separate calls to 1 call.
-    """
-    try:
-        system_prompt = """You are an expert email analyst. Analyze the email and provide:
+ANALYSIS_SYSTEM_PROMPT = """You are an expert email analyst. Analyze the email and provide:
 
 1. CLASSIFICATION: Categorize the email (e.g., "Sales Inquiry", "Technical Support", "Invoice/Billing", "HR Request", "Partnership", "Complaint", "General Inquiry", "Newsletter", "Marketing", "Spam", "Security Alert", "Security Warning", "Breach Notification", "Vulnerability Alert", "Threat Warning")
 
@@ -99,59 +290,260 @@ def analyze_email_combined(email_subject: str, email_body: str, sender_email: st
 
 Return all analysis in the specified JSON format."""
 
-        # Build attachment info
-        attachment_info = ""
-        if has_attachments and attachments:
-            attachment_count = len(attachments)
-            attachment_details = [f"{att.get('filename', 'unknown')} ({att.get('content_type', 'unknown type')})" for att in attachments]
-            attachment_info = f"\n\nAttachments ({attachment_count}): {', '.join(attachment_details)}"
-        
-        prompt = f"""Sender: {sender_email}
+# Fused mode: the analysis call also writes the reply, saving the separate draft call
+FUSED_DRAFT_SECTION = """
+
+7. DRAFT: Only when ACTION_REQUIRED is true, also write a polite, professional draft reply
+   in draft_subject ("Re: original subject" or a new subject) and draft_body:
+   - Be professional and courteous
+   - Address the main points from the original email
+   - Keep the response concise but complete
+   - Use appropriate tone for the classification category
+   When ACTION_REQUIRED is false, leave draft_subject and draft_body empty."""
+FUSED_ANALYSIS_SYSTEM_PROMPT = ANALYSIS_SYSTEM_PROMPT.replace(
+    "\n\nReturn all analysis", FUSED_DRAFT_SECTION + "\n\nReturn all analysis"
+)
+analysis_context = _context_cache('emailauto-analysis', ANALYSIS_SYSTEM_PROMPT)
+fused_analysis_context = _context_cache('emailauto-analysis-fused', FUSED_ANALYSIS_SYSTEM_PROMPT)
+
+
+def _analysis_prompt(email_subject: str, email_body: str, sender_email: str, has_attachments: bool, attachments: list) -> str:
+    """User prompt describing one email for analysis"""
+    # Build attachment info
+    attachment_info = ""
+    if has_attachments and attachments:
+        attachment_count = len(attachments)
+        attachment_details = [f"{att.get('filename', 'unknown')} ({att.get('content_type', 'unknown type')})" for att in attachments]
+        attachment_info = f"\n\nAttachments ({attachment_count}): {', '.join(attachment_details)}"
+    
+    return f"""Sender: {sender_email}
 Subject: {email_subject}
 {attachment_info}
 
 Body: {email_body}"""
 
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
+
+def _analysis_from_result(result: dict, body_truncated: bool) -> dict:
+    """Analysis dict from the model's CombinedEmailAnalysis JSON; fused results carry the reply in 'draft'"""
+    analysis = {
+        'classification': result.get('classification', 'General Inquiry'),
+        'priority': result.get('priority', 'P2'),
+        'sentiment': result.get('sentiment', 'Neutral'),
+        'entities': result.get('entities', []),
+        'summary_narrative': result.get('summary_narrative', ''),
+        'action_required': result.get('action_required', False),
+        'body_truncated': body_truncated
+    }
+    if analysis['action_required'] and result.get('draft_subject') and result.get('draft_body'):
+        analysis['draft'] = {
+            'subject': result['draft_subject'],
+            'body': result['draft_body'],
+            'body_truncated': body_truncated
+        }
+    return analysis
+
+
+def _default_analysis() -> dict:
+    """Neutral analysis used when the AI call fails"""
+    return {
+        'classification': 'General Inquiry',
+        'priority': 'P2',
+        'sentiment': 'Neutral',
+        'entities': [],
+        'summary_narrative': '',
+        'action_required': False
+    }
+
+
+def analyze_email_combined(email_subject: str, email_body: str, sender_email: str, has_attachments: bool = False, attachments: list = None) -> dict:
+    """
+    Combined AI analysis: classification, priority, sentiment, entities, and summary in ONE API call.
+    This reduces API usage from 4 separate calls to 1 call.
+    Identical emails are answered from the analysis cache (see analysis_cache.py).
+    """
+    key = cache_key(
+        sender_email, email_subject, email_body,
+        attachments if has_attachments else None,
+        provider.model, ANALYSIS_PROMPT_VERSION
+    )
+    return analysis_cache.get_or_compute(
+        key,
+        lambda: _analyze_email_combined(email_subject, email_body, sender_email, has_attachments, attachments),
+        model=provider.model
+    )
+
+
+def _analyze_email_combined(email_subject: str, email_body: str, sender_email: str, has_attachments: bool, attachments: list) -> tuple:
+    """One analysis API call; returns (analysis, ok) where failed calls give the default analysis"""
+    try:
+        email_body, body_truncated = fit_to_budget(email_body, 'analysis')
+        prompt = _analysis_prompt(email_subject, email_body, sender_email, has_attachments, attachments)
+
+        response = _generate(
+            'analysis_fused' if AI_FUSED_DRAFT else 'analysis',
+            prompt,
+            types.GenerateContentConfig(
+                system_instruction=FUSED_ANALYSIS_SYSTEM_PROMPT if AI_FUSED_DRAFT else ANALYSIS_SYSTEM_PROMPT,
                 response_mime_type="application/json",
                 response_schema=CombinedEmailAnalysis,
             ),
+            context=fused_analysis_context if AI_FUSED_DRAFT else analysis_context
         )
 
         if response.text:
-            result = json.loads(response.text)
-            return {
-                'classification': result.get('classification', 'General Inquiry'),
-                'priority': result.get('priority', 'P2'),
-                'sentiment': result.get('sentiment', 'Neutral'),
-                'entities': result.get('entities', []),
-                'summary_narrative': result.get('summary_narrative', ''),
-                'action_required': result.get('action_required', False)
-            }
+            return _analysis_from_result(json.loads(response.text), body_truncated), True
         
-        return {
-            'classification': 'General Inquiry',
-            'priority': 'P2',
-            'sentiment': 'Neutral',
-            'entities': [],
-            'summary_narrative': '',
-            'action_required': False
-        }
+        return _default_analysis(), False
 
     except Exception as e:
         print(f"Error in combined email analysis: {e}")
-        return {
-            'classification': 'General Inquiry',
-            'priority': 'P2',
-            'sentiment': 'Neutral',
-            'entities': [],
-            'summary_narrative': '',
-            'action_required': False
-        }
+        return _default_analysis(), False
+
+
+class BatchedEmailAnalysis(CombinedEmailAnalysis):
+    """Analysis of one email in a batch request"""
+    email_id: str
+
+
+class BatchEmailAnalysis(BaseModel):
+    """Batch analysis result, one entry per email"""
+    analyses: List[BatchedEmailAnalysis]
+
+
+BATCH_SYSTEM_SUFFIX = """
+
+You will receive several emails, each introduced by a line "=== EMAIL <id> ===".
+Analyze every email independently and return one entry per email in "analyses",
+with its email_id exactly as given."""
+BATCH_ANALYSIS_SYSTEM_PROMPT = ANALYSIS_SYSTEM_PROMPT + BATCH_SYSTEM_SUFFIX
+batch_analysis_context = _context_cache('emailauto-analysis-batch', BATCH_ANALYSIS_SYSTEM_PROMPT)
+
+_batch_counters = {'requests': 0, 'emails': 0, 'fallbacks': 0}
+_batch_lock = threading.Lock()
+
+
+def _count_batch(**amounts):
+    with _batch_lock:
+        for counter, amount in amounts.items():
+            _batch_counters[counter] += amount
+
+
+def batch_stats() -> dict:
+    """Batch analysis counters since process start"""
+    with _batch_lock:
+        counters = dict(_batch_counters)
+    counters['avg_batch_size'] = round(counters['emails'] / counters['requests'], 2) if counters['requests'] else 0.0
+    return counters
+
+
+def _plan_batches(items: List[dict]) -> List[List[dict]]:
+    """Pack items, in order, into batches within the email count and token budget"""
+    batches = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        if current and (len(current) >= AI_BATCH_MAX_EMAILS or current_tokens + item['tokens'] > AI_BATCH_TOKEN_BUDGET):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += item['tokens']
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _analyze_batch(batch: List[dict]) -> dict:
+    """
+    One request analyzing every email in the batch
+    Returns {email id: analysis} for the emails with a usable entry in the response
+    """
+    # Short positional ids are copied back more reliably than arbitrary message ids
+    by_position = {str(position): item for position, item in enumerate(batch, 1)}
+    prompt = "\n\n".join(f"=== EMAIL {position} ===\n{item['prompt']}" for position, item in by_position.items())
+
+    try:
+        response = _generate(
+            'batch',
+            prompt,
+            types.GenerateContentConfig(
+                system_instruction=BATCH_ANALYSIS_SYSTEM_PROMPT,
+                response_mime_type="application/json",
+                response_schema=BatchEmailAnalysis,
+            ),
+            response_tokens=RESPONSE_TOKEN_ESTIMATE * len(batch),
+            context=batch_analysis_context
+        )
+        data = json.loads(response.text) if response.text else {}
+    except Exception as e:
+        print(f"Error in batch email analysis: {e}")
+        return {}
+
+    results = {}
+    entries = data.get('analyses') if isinstance(data, dict) else None
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        item = by_position.get(str(entry.get('email_id', '')).strip())
+        # Skip unknown or repeated ids and entries missing the fields triage depends on
+        if item is None or item['id'] in results or not entry.get('classification') or not entry.get('priority'):
+            continue
+        analysis = _analysis_from_result(entry, item['body_truncated'])
+        results[item['id']] = analysis
+        if analysis_cache.enabled:
+            analysis_cache.put(item['key'], analysis, provider.model)
+    return results
+
+
+def analyze_emails_batch(emails: List[dict]) -> dict:
+    """
+    Analyze several short emails with as few requests as possible
+    Each email is a dict with 'id', 'subject', 'body', 'sender_email' and optionally
+    'has_attachments' / 'attachments'. Returns {id: analysis} for every email.
+    Cached emails are answered from the cache; long emails, and emails missing from a
+    partial or malformed batch response, go through analyze_email_combined() in parallel.
+    """
+    results = {}
+    pending = []
+    for email in emails:
+        attachments = email.get('attachments') if email.get('has_attachments') else None
+        key = cache_key(email['sender_email'], email['subject'], email['body'], attachments,
+                        provider.model, ANALYSIS_PROMPT_VERSION)
+        cached = analysis_cache.get(key) if analysis_cache.enabled else None
+        if cached is not None:
+            results[email['id']] = cached
+            continue
+
+        body, body_truncated = fit_to_budget(email['body'], 'analysis')
+        prompt = _analysis_prompt(email['subject'], body, email['sender_email'],
+                                  email.get('has_attachments', False), email.get('attachments'))
+        tokens = estimate_tokens(prompt)
+        if tokens <= AI_BATCH_MAX_EMAIL_TOKENS:
+            pending.append({'id': email['id'], 'key': key, 'prompt': prompt, 'tokens': tokens,
+                            'body_truncated': body_truncated})
+
+    # A batch of one gains nothing over the single-email call
+    batched = set()
+    for batch in _plan_batches(pending):
+        if len(batch) > 1:
+            results.update(_analyze_batch(batch))
+            batched.update(item['id'] for item in batch)
+            _count_batch(requests=1, emails=len(batch))
+
+    # Everything else goes out as single-email requests in parallel on the AI pool
+    fallbacks = []
+    for email in emails:
+        if email['id'] not in results:
+            if email['id'] in batched:
+                _count_batch(fallbacks=1)
+            args = (email['subject'], email['body'], email['sender_email'],
+                    email.get('has_attachments', False), email.get('attachments'))
+            fallbacks.append((email['id'], args, ai_executor.submit(analyze_email_combined, *args)))
+    for email_id, args, future in fallbacks:
+        # A call no pool thread has started yet runs here instead; the caller may itself be
+        # on the AI pool (analysis_batcher), which must never wait on its own queue
+        results[email_id] = analyze_email_combined(*args) if future.cancel() else future.result()
+    return results
 
 
 def generate_email_summary(email_subject: str, email_body: str) -> List[str]:
@@ -160,6 +552,8 @@ def generate_email_summary(email_subject: str, email_body: str) -> List[str]:
     Returns a list of 2-4 key points summarizing the email.
     """
     try:
+        email_body, _ = fit_to_budget(email_body, 'summary')
+        
         system_prompt = """You are an expert at summarizing emails concisely.
         
         Generate 2-4 bullet points that capture the key information and main points of the email.
@@ -172,10 +566,10 @@ def generate_email_summary(email_subject: str, email_body: str) -> List[str]:
         
         prompt = f"Subject: {email_subject}\n\nBody: {email_body}"
         
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
+        response = _generate(
+            'summary',
+            prompt,
+            types.GenerateContentConfig(
                 system_instruction=system_prompt,
                 response_mime_type="application/json",
                 response_schema=EmailSummary,
@@ -198,6 +592,8 @@ def classify_email(email_subject: str, email_body: str) -> dict:
     Invoice/Billing, HR Request, Spam, etc.
     """
     try:
+        email_body, _ = fit_to_budget(email_body, 'classification')
+        
         system_prompt = """You are an email classification expert. Analyze the email and classify it into one of these categories:
         - Sales Inquiry
         - Technical Support
@@ -212,10 +608,10 @@ def classify_email(email_subject: str, email_body: str) -> dict:
         
         prompt = f"Subject: {email_subject}\n\nBody: {email_body}"
         
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
+        response = _generate(
+            'classification',
+            prompt,
+            types.GenerateContentConfig(
                 system_instruction=system_prompt,
                 response_mime_type="application/json",
                 response_schema=EmailClassification,
@@ -237,6 +633,8 @@ def analyze_priority_sentiment(email_subject: str, email_body: str, sender_email
     and sentiment (Positive, Neutral, Negative)
     """
     try:
+        email_body, _ = fit_to_budget(email_body, 'priority')
+        
         system_prompt = """You are an email priority and sentiment analysis expert.
         
         Analyze the email and determine:
@@ -254,10 +652,10 @@ def analyze_priority_sentiment(email_subject: str, email_body: str, sender_email
         
         prompt = f"From: {sender_email}\nSubject: {email_subject}\n\nBody: {email_body}"
         
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
+        response = _generate(
+            'priority',
+            prompt,
+            types.GenerateContentConfig(
                 system_instruction=system_prompt,
                 response_mime_type="application/json",
                 response_schema=PriorityAnalysis,
@@ -278,6 +676,8 @@ def extract_entities(email_subject: str, email_body: str) -> dict:
     Extract structured data like Customer Name, Order ID, Date, Product SKU, Amount, etc.
     """
     try:
+        email_body, _ = fit_to_budget(email_body, 'entities')
+        
         system_prompt = """You are a data extraction expert. Extract structured entities from the email.
         
         Look for and extract:
@@ -299,10 +699,10 @@ def extract_entities(email_subject: str, email_body: str) -> dict:
         
         prompt = f"Subject: {email_subject}\n\nBody: {email_body}"
         
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
+        response = _generate(
+            'entities',
+            prompt,
+            types.GenerateContentConfig(
                 system_instruction=system_prompt,
                 response_mime_type="application/json",
                 response_schema=EntityExtraction,
@@ -318,6 +718,24 @@ def extract_entities(email_subject: str, email_body: str) -> dict:
         return {"entities": []}
 
 
+# Static so it can be cached on the provider; the classification and template go in the user prompt
+DRAFT_SYSTEM_PROMPT = """You are a professional email response assistant.
+
+Generate a polite, professional draft response to the email below. The email's
+classification is given with it, sometimes along with a template.
+
+Guidelines:
+- Be professional and courteous
+- Address the main points from the original email
+- Keep the response concise but complete
+- Use appropriate tone for the classification category
+- If a template is given, use it as a guide
+
+Respond with JSON containing "subject" and "body" fields:
+{"subject": "Re: original subject or new subject", "body": "email body text"}"""
+# Not context-cached: the prompt is far below the provider's minimum cacheable size
+
+
 def generate_draft_response(
     email_subject: str,
     email_body: str,
@@ -329,34 +747,26 @@ def generate_draft_response(
     Generate a draft response email based on the incoming email and optional template
     """
     try:
-        system_prompt = f"""You are a professional email response assistant.
-        
-        Generate a polite, professional draft response to the following email.
-        The email has been classified as: {classification}
+        email_body, body_truncated = fit_to_budget(email_body, 'draft')
         
-        Guidelines:
-        - Be professional and courteous
-        - Address the main points from the original email
-        - Keep the response concise but complete
-        - Use appropriate tone for the classification category
-        {"- Use this template as a guide: " + template if template else ""}
+        prompt = f"Classification: {classification}\n"
+        if template:
+            prompt += f"Template: {template}\n"
+        prompt += f"\nFrom: {sender_email}\nSubject: {email_subject}\n\nBody: {email_body}"
         
-        Respond with JSON containing "subject" and "body" fields:
-        {{"subject": "Re: original subject or new subject", "body": "email body text"}}"""
-        
-        prompt = f"From: {sender_email}\nSubject: {email_subject}\n\nBody: {email_body}"
-        
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
+        response = _generate(
+            'draft',
+            prompt,
+            types.GenerateContentConfig(
+                system_instruction=DRAFT_SYSTEM_PROMPT,
                 response_mime_type="application/json",
-            ),
+            )
         )
         
         if response.text:
-            return json.loads(response.text)
+            draft = json.loads(response.text)
+            draft['body_truncated'] = body_truncated
+            return draft
         return {"subject": f"Re: {email_subject}", "body": "Thank you for your email. We will review and respond shortly."}
     
     except Exception as e:
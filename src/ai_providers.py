@@ -0,0 +1,269 @@
+"""
+AI providers behind ai_processor
+
+ai_processor builds each request (prompt, GenerateContentConfig with the
+system prompt and response schema) and hands it to the provider selected by
+AI_PROVIDER:
+- 'gemini' (default): Google Gemini through the google-genai SDK
+- 'stub': no network and no API key; returns schema-valid JSON derived from a
+  hash of the prompt, after a configurable latency with jitter, and fails a
+  configurable share of requests with a retryable 503. Used to load-test the
+  pipeline and measure its own overhead separately from the model's. Its
+  classifications are never adverts, so it cannot make processing delete mail.
+Providers also create and renew the provider-side prompt caches used by
+context_cache.ContextCache.
+"""
+import os
+import re
+import json
+import time
+import random
+import typing
+import hashlib
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from google.genai import types
+from pydantic import BaseModel
+
+AI_PROVIDER = os.environ.get('AI_PROVIDER', 'gemini').lower()
+GEMINI_MODEL = "gemini-2.0-flash-exp"
+
+# Stub behaviour: mean latency and +/- jitter in milliseconds, share of requests that fail
+AI_STUB_LATENCY_MS = float(os.environ.get('AI_STUB_LATENCY_MS', '300'))
+AI_STUB_JITTER_MS = float(os.environ.get('AI_STUB_JITTER_MS', '100'))
+AI_STUB_ERROR_RATE = float(os.environ.get('AI_STUB_ERROR_RATE', '0'))
+# Seed for the stub's latency and error draws (responses are always a function of the prompt)
+AI_STUB_SEED = os.environ.get('AI_STUB_SEED')
+
+
+class AIProvider:
+    """Interface ai_processor talks to"""
+
+    name = 'base'
+    model = ''
+
+    def generate(self, call_type: str, prompt: str, config: types.GenerateContentConfig):
+        """Send one request; returns an object with .text (JSON) and optionally .usage_metadata"""
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        """Tokens in text for this provider's model; ~4 characters per token unless the provider can count"""
+        return -(-len(text) // 4)
+
+    def create_cache(self, display_name: str, system_instruction: str, ttl: str):
+        """Cache a system prompt on the provider; returns an object with .name and .expire_time"""
+        raise NotImplementedError(f'{self.name} does not support context caching')
+
+    def renew_cache(self, name: str, ttl: str):
+        """Extend a cached prompt's TTL; returns an object with .expire_time"""
+        raise NotImplementedError(f'{self.name} does not support context caching')
+
+    def delete_cache(self, name: str):
+        """Delete a cached prompt before its TTL runs out"""
+        raise NotImplementedError(f'{self.name} does not support context caching')
+
+
+class GeminiProvider(AIProvider):
+    """Google Gemini via google-genai"""
+
+    name = 'gemini'
+
+    def __init__(self, model: str = GEMINI_MODEL, api_key: Optional[str] = None):
+        # Imported here: the client needs GEMINI_API_KEY, which the stub provider does without
+        from google import genai
+        self.model = model
+        self.client = genai.Client(api_key=api_key or os.environ.get("GEMINI_API_KEY"))
+
+    def generate(self, call_type: str, prompt: str, config: types.GenerateContentConfig):
+        return self.client.models.generate_content(
+            model=self.model,
+            contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
+            config=config,
+        )
+
+    def count_tokens(self, text: str) -> int:
+        return self.client.models.count_tokens(model=self.model, contents=text).total_tokens
+
+    def create_cache(self, display_name: str, system_instruction: str, ttl: str):
+        return self.client.caches.create(
+            model=self.model,
+            config=types.CreateCachedContentConfig(
+                display_name=display_name,
+                system_instruction=system_instruction,
+                ttl=ttl
+            )
+        )
+
+    def renew_cache(self, name: str, ttl: str):
+        return self.client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=ttl))
+
+    def delete_cache(self, name: str):
+        self.client.caches.delete(name=name)
+
+
+class StubProviderError(Exception):
+    """Injected failure; carries a status code so the executor treats it like a provider 503"""
+
+    def __init__(self, message: str, code: int = 503):
+        super().__init__(message)
+        self.code = code
+
+
+# None of these match triage.is_advertisement, so a stub run against a real mailbox never deletes mail
+_STUB_CLASSIFICATIONS = ['General Inquiry', 'Technical Support', 'Customer Feedback', 'Invoice/Billing',
+                         'Meeting Request', 'Order Status', 'Notification', 'Security Alert']
+_STUB_SENTIMENTS = ['Positive', 'Neutral', 'Negative']
+_STUB_ENTITY_TYPES = ['order_id', 'customer_name', 'amount', 'date', 'company_name']
+_BATCH_ID_RE = re.compile(r'^=== EMAIL (\S+) ===$', re.MULTILINE)
+_SUBJECT_RE = re.compile(r'^Subject: (.*)$', re.MULTILINE)
+
+
+class StubProvider(AIProvider):
+    """Offline provider returning deterministic, schema-valid responses"""
+
+    name = 'stub'
+    model = 'stub'
+
+    def __init__(self, latency_ms: float = AI_STUB_LATENCY_MS, jitter_ms: float = AI_STUB_JITTER_MS,
+                 error_rate: float = AI_STUB_ERROR_RATE, seed: Optional[str] = AI_STUB_SEED):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Cached content name -> system prompt, so cached requests are answered like inline ones
+        self._caches = {}
+
+    def _draw(self):
+        with self._lock:
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+            failed = self._random.random() < self.error_rate
+        return max(0.0, delay), failed
+
+    @staticmethod
+    def _seed(text: str) -> int:
+        return int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+
+    def _sample(self, annotation, field: str, seed: int, prompt: str, instructions: str = ''):
+        """A value of the annotated type; known field names get plausible values"""
+        origin = typing.get_origin(annotation)
+        if origin is typing.Union:
+            args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+            return self._sample(args[0], field, seed, prompt, instructions) if args else None
+        if origin in (list, typing.List):
+            item_type = typing.get_args(annotation)[0]
+            return [self._sample(item_type, field, seed + i, prompt, instructions) for i in range(seed % 3)]
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            return self._instance(annotation, seed, prompt, instructions)
+        if annotation is bool:
+            # Questions in the body need action, like the real model would decide
+            return '?' in prompt.split('Body:', 1)[-1] or seed % 4 == 0
+        if annotation is float:
+            return round(0.5 + (seed % 50) / 100, 2)
+        if annotation is int:
+            return seed % 100
+        if field in ('classification', 'category'):
+            return _STUB_CLASSIFICATIONS[seed % len(_STUB_CLASSIFICATIONS)]
+        if field == 'priority':
+            return f'P{seed % 4}'
+        if field == 'sentiment':
+            return _STUB_SENTIMENTS[seed % len(_STUB_SENTIMENTS)]
+        if field == 'entity_type':
+            return _STUB_ENTITY_TYPES[seed % len(_STUB_ENTITY_TYPES)]
+        if field in ('draft_subject', 'subject'):
+            subject = _SUBJECT_RE.search(prompt)
+            return f"Re: {subject.group(1).strip() if subject else 'your email'}"
+        return f'stub {field} {seed % 10000}'
+
+    def _instance(self, model: typing.Type[BaseModel], seed: int, prompt: str, instructions: str) -> dict:
+        """Fields of a response model; optional fields only when the system prompt asks for them"""
+        values = {}
+        for field, info in model.model_fields.items():
+            if not info.is_required() and field not in instructions:
+                values[field] = info.default
+            else:
+                values[field] = self._sample(info.annotation, field, self._seed(f'{seed}:{field}'), prompt, instructions)
+        if values.get('action_required') is False:
+            # Fused drafts are only written for emails that need action
+            values.update({field: None for field in ('draft_subject', 'draft_body') if field in values})
+        return values
+
+    def _respond(self, call_type: str, prompt: str, instructions: str, config: types.GenerateContentConfig) -> dict:
+        schema = config.response_schema
+        if call_type == 'batch':
+            # One entry per email, keyed by the ids in the prompt
+            entry_schema = schema.model_fields['analyses'].annotation.__args__[0]
+            sections = _BATCH_ID_RE.split(prompt)[1:]
+            analyses = []
+            for email_id, email_prompt in zip(sections[0::2], sections[1::2]):
+                entry = self._instance(entry_schema, self._seed(email_prompt), email_prompt, instructions)
+                entry['email_id'] = email_id
+                analyses.append(entry)
+            return {'analyses': analyses}
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            return self._instance(schema, self._seed(prompt), prompt, instructions)
+        # Free-form JSON: the draft call
+        return {
+            'subject': self._sample(str, 'subject', 0, prompt),
+            'body': f'Thank you for your email. (stub reply {self._seed(prompt) % 10000})'
+        }
+
+    def generate(self, call_type: str, prompt: str, config: types.GenerateContentConfig):
+        delay, failed = self._draw()
+        time.sleep(delay)
+        if failed:
+            raise StubProviderError('Stub provider: injected 503 Service Unavailable')
+
+        with self._lock:
+            cached = self._caches.get(config.cached_content) if config.cached_content else None
+        if config.cached_content and cached is None:
+            raise StubProviderError(f'Stub provider: unknown cached content {config.cached_content}', code=400)
+        instructions = cached or str(config.system_instruction or '')
+        text = json.dumps(self._respond(call_type, prompt, instructions, config))
+
+        # Token counts at the same ~4 characters per token ai_processor estimates with
+        input_tokens = -(-(len(prompt) + len(instructions)) // 4)
+        output_tokens = -(-len(text) // 4)
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=input_tokens,
+                cached_content_token_count=-(-len(cached) // 4) if cached else 0,
+                candidates_token_count=output_tokens,
+                total_token_count=input_tokens + output_tokens
+            )
+        )
+
+    def create_cache(self, display_name: str, system_instruction: str, ttl: str):
+        name = f'cachedContents/stub-{display_name}-{self._seed(system_instruction) % 10 ** 8}'
+        with self._lock:
+            self._caches[name] = system_instruction
+        return SimpleNamespace(name=name, expire_time=datetime.now(timezone.utc) + timedelta(seconds=int(ttl.rstrip('s'))))
+
+    def renew_cache(self, name: str, ttl: str):
+        with self._lock:
+            if name not in self._caches:
+                raise StubProviderError(f'Stub provider: unknown cached content {name}', code=404)
+        return SimpleNamespace(expire_time=datetime.now(timezone.utc) + timedelta(seconds=int(ttl.rstrip('s'))))
+
+    def delete_cache(self, name: str):
+        with self._lock:
+            if self._caches.pop(name, None) is None:
+                raise StubProviderError(f'Stub provider: unknown cached content {name}', code=404)
+
+
+PROVIDERS = {
+    'gemini': GeminiProvider,
+    'stub': StubProvider,
+}
+
+
+def get_provider(name: str = AI_PROVIDER) -> AIProvider:
+    """Provider instance for a name in PROVIDERS"""
+    try:
+        return PROVIDERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown AI_PROVIDER {name!r}; expected one of: {', '.join(PROVIDERS)}")
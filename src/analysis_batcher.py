@@ -0,0 +1,94 @@
+"""
+Coalesces concurrent single-email analyses into batch requests
+
+Processing threads analyze one email each. With AI_BATCH_ENABLED, short
+emails are held for up to AI_BATCH_WINDOW_MS while other threads add theirs,
+and are then sent together through analyze_emails_batch(), so a backlog of
+notifications pays the system prompt and the round trip once per batch
+instead of once per email. Long emails skip the queue.
+"""
+import os
+import time
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from ai_processor import (
+    analyze_email_combined, analyze_emails_batch, estimate_tokens,
+    AI_BATCH_MAX_EMAILS, AI_BATCH_MAX_EMAIL_TOKENS
+)
+from ai_executor import ai_executor
+
+AI_BATCH_ENABLED = os.environ.get('AI_BATCH_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# How long the first email of a batch waits for others to join
+AI_BATCH_WINDOW_MS = int(os.environ.get('AI_BATCH_WINDOW_MS', '200'))
+
+
+class AnalysisBatcher:
+    """Collects analysis requests from many threads and flushes them as batches"""
+
+    def __init__(self, enabled: bool = AI_BATCH_ENABLED, window_ms: int = AI_BATCH_WINDOW_MS,
+                 max_emails: int = AI_BATCH_MAX_EMAILS):
+        self.enabled = enabled
+        self.window = window_ms / 1000.0
+        self.max_emails = max_emails
+        self._pending: List[Tuple[Dict, Future]] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._sequence = 0
+
+    def analyze(self, email_subject: str, email_body: str, sender_email: str,
+                has_attachments: bool = False, attachments: list = None) -> dict:
+        """Same contract as analyze_email_combined(); blocks until the email's batch is answered"""
+        if not self.enabled or estimate_tokens(email_body or '') > AI_BATCH_MAX_EMAIL_TOKENS:
+            return analyze_email_combined(email_subject, email_body, sender_email, has_attachments, attachments)
+
+        future = Future()
+        with self._cond:
+            # Ids only need to be unique within a batch; UIDs can repeat across accounts
+            self._sequence += 1
+            email = {
+                'id': str(self._sequence),
+                'subject': email_subject,
+                'body': email_body,
+                'sender_email': sender_email,
+                'has_attachments': has_attachments,
+                'attachments': attachments
+            }
+            self._pending.append((email, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='analysis-batcher', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_emails:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_emails]
+                del self._pending[:self.max_emails]
+            # Flush on the AI pool so the next batch can start collecting right away
+            ai_executor.submit(self._flush, batch)
+
+    @staticmethod
+    def _flush(batch: List[Tuple[Dict, Future]]):
+        try:
+            results = analyze_emails_batch([email for email, _ in batch])
+            for email, future in batch:
+                future.set_result(results[email['id']])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+# Shared by all processing threads in this process
+analysis_batcher = AnalysisBatcher()
@@ -0,0 +1,195 @@
+"""
+Content-hash cache of AI email analyses
+
+Mailing-list copies, repeated automated alerts and the same message delivered
+to several monitored accounts are analyzed once. The key is a SHA-256 of the
+normalized sender, subject, body and attachment list plus the model and prompt
+version, so a prompt or model change never serves an old answer. Entries live
+in an in-memory LRU in front of the analysis_cache table, which shares them
+between processes and survives restarts; both expire after ANALYSIS_CACHE_TTL.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import get_db
+
+ANALYSIS_CACHE_ENABLED = os.environ.get('ANALYSIS_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Entries kept in memory per process
+ANALYSIS_CACHE_SIZE = int(os.environ.get('ANALYSIS_CACHE_SIZE', '2048'))
+# Seconds an analysis is reused (default 7 days)
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', '604800'))
+# Seconds between deletions of expired rows from the table
+PURGE_INTERVAL = 3600
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _normalize(text: Optional[str]) -> str:
+    """Case and whitespace differences don't change the analysis"""
+    return _WHITESPACE_RE.sub(' ', text or '').strip().lower()
+
+
+def cache_key(sender_email: str, subject: str, body: str, attachments: Optional[List[Dict]],
+              model: str, prompt_version: str) -> str:
+    """Hex SHA-256 identifying one analysis request"""
+    attachment_list = sorted(
+        (_normalize(att.get('filename')), _normalize(att.get('content_type')))
+        for att in (attachments or [])
+    )
+    material = json.dumps([
+        model,
+        prompt_version,
+        _normalize(sender_email),
+        _normalize(subject),
+        _normalize(body),
+        attachment_list
+    ], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    """In-memory LRU in front of the analysis_cache table, with TTL and hit/miss counters"""
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_SIZE, ttl: int = ANALYSIS_CACHE_TTL,
+                 enabled: bool = ANALYSIS_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries: 'OrderedDict[str, Tuple[float, Dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per key being computed, so concurrent copies of a message make one AI call
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+        self._last_purge = 0.0
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _remember(self, key: str, analysis: Dict, expires_at: float):
+        with self._lock:
+            self._entries[key] = (expires_at, analysis)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str, count_miss: bool = True) -> Optional[Dict]:
+        """Cached analysis for the key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return dict(entry[1])
+                del self._entries[key]
+
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE analysis_cache SET hits = hits + 1
+                    WHERE cache_key = %s AND expires_at > NOW()
+                    RETURNING analysis, EXTRACT(EPOCH FROM expires_at - NOW()) AS expires_in
+                ''', (key,))
+                row = cursor.fetchone()
+        except Exception as e:
+            print(f"Error reading analysis cache: {e}")
+            self._count('errors')
+            row = None
+
+        if row is None:
+            if count_miss:
+                self._count('misses')
+            return None
+        self._count('db_hits')
+        # Remaining lifetime, computed by the database so its time zone handling cancels out
+        self._remember(key, row['analysis'], time.time() + float(row['expires_in']))
+        return dict(row['analysis'])
+
+    def put(self, key: str, analysis: Dict, model: str = None):
+        self._remember(key, analysis, time.time() + self.ttl)
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO analysis_cache (cache_key, analysis, model, expires_at)
+                    VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+                    ON CONFLICT (cache_key) DO UPDATE
+                        SET analysis = EXCLUDED.analysis, model = EXCLUDED.model,
+                            created_at = CURRENT_TIMESTAMP, expires_at = EXCLUDED.expires_at
+                ''', (key, json.dumps(analysis), model, self.ttl))
+                self._purge_expired(cursor)
+            self._count('stores')
+        except Exception as e:
+            print(f"Error writing analysis cache: {e}")
+            self._count('errors')
+
+    def _purge_expired(self, cursor):
+        now = time.monotonic()
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        cursor.execute('DELETE FROM analysis_cache WHERE expires_at <= NOW()')
+
+    def get_or_compute(self, key: str, compute: Callable[[], Tuple[Dict, bool]], model: str = None) -> Dict:
+        """
+        Cached analysis for the key, computing it at most once at a time per key
+        compute returns (analysis, cacheable); failed analyses are returned but not stored
+        """
+        if not self.enabled:
+            return compute()[0]
+
+        # A miss is counted once, by the thread that computes the analysis
+        analysis = self.get(key, count_miss=False)
+        if analysis is not None:
+            return analysis
+
+        with self._lock:
+            flight = self._inflight.setdefault(key, threading.Lock())
+        with flight:
+            # Another thread may have finished the same analysis while we waited
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._count('memory_hits')
+                return dict(entry[1])
+
+            self._count('misses')
+            try:
+                analysis, cacheable = compute()
+                if cacheable:
+                    self.put(key, analysis, model)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return dict(analysis)
+
+    def clear(self):
+        """Drop the in-memory entries (the table is left alone)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Counters since process start"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters['memory_hits'] + counters['db_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['db_hits']
+        counters.update({
+            'enabled': self.enabled,
+            'entries': size,
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0
+        })
+        return counters
+
+
+# Shared by every AI call in this process
+analysis_cache = AnalysisCache()
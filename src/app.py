@@ -2,133 +2,29 @@ import os
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
 from datetime import datetime
-import json
-
-from database import init_db, get_db
-from email_service import EmailService
-from ai_processor import generate_draft_response, analyze_email_combined
-from encryption import encrypt_password, decrypt_password
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from database import init_db, get_db, notify_change
+from encryption import encrypt_password
+from processing import process_account, ACCOUNT_CONCURRENCY
+from config_cache import config_cache
+from change_listener import start_change_listener
+from backtest import run_backtest, BACKTEST_SAMPLES
+from analysis_cache import analysis_cache
+from ai_executor import ai_executor
+from ai_processor import batch_stats, ai_usage_stats, context_cache_stats, provider
+from draft_engine import draft_engine
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 CORS(app)
 
-# Initialize database on startup
-with app.app_context():
-    init_db()
-
-
-def get_priority_level(priority):
-    """Convert priority string to numeric level for comparison (lower is higher priority)"""
-    priority_levels = {
-        'P0': 0,
-        'P1': 1,
-        'P2': 2,
-        'P3': 3
-    }
-    return priority_levels.get(priority, 2)
-
-
-def is_advertisement(classification, sender_email, subscriptions_whitelist):
-    """
-    Determine if an email is a pure advertisement that should be deleted.
-    
-    Criteria for pure adverts:
-    - Classified as Marketing, Spam, Promotional, Newsletter, or similar
-    - NOT in the subscriptions whitelist (emails you want to keep)
-    - Contains typical marketing/promotional language
-    
-    Returns True if the email should be permanently deleted
-    """
-    # Marketing-related classifications that indicate adverts
-    advert_classifications = [
-        'marketing',
-        'spam',
-        'promotional',
-        'advertisement',
-        'newsletter',
-        'sales',
-        'offer'
-    ]
-    
-    # Check if classification matches advert patterns
-    classification_lower = classification.lower()
-    is_marketing = any(advert_type in classification_lower for advert_type in advert_classifications)
-    
-    if not is_marketing:
-        return False
-    
-    # Check if sender is in subscriptions whitelist (keep these)
-    sender_lower = sender_email.lower()
-    for whitelisted in subscriptions_whitelist:
-        whitelisted_lower = whitelisted.lower()
-        if whitelisted_lower in sender_lower or sender_lower.endswith(whitelisted_lower):
-            return False  # Keep whitelisted newsletters
-    
-    # It's marketing and not whitelisted = pure advert to delete
-    return True
-
-
-def apply_triaging_matrix(sender_email, subject, body, ai_priority, sender_priorities, subject_keywords, body_keywords):
-    """
-    Apply triaging matrix rules to determine final priority.
-    Priority order: Sender whitelist > Subject keywords > Body keywords > AI priority
-    Priority levels: High Priority = P0/P1, Important = P2, Low Priority = P3
-    """
-    priority_map = {
-        'High Priority': 'P0',
-        'Important': 'P2',
-        'Low Priority': 'P3'
-    }
-    
-    final_priority = ai_priority
-    
-    # Check sender whitelist (highest priority)
-    for sender_config in sender_priorities:
-        sender_pattern = sender_config['config_value'].lower()
-        category = sender_config.get('category', '')
-        
-        if sender_pattern in sender_email.lower() or sender_email.lower().endswith(sender_pattern):
-            if category in priority_map:
-                final_priority = priority_map[category]
-                break
-    
-    # Check subject keywords (second priority)
-    subject_lower = subject.lower()
-    for keyword_config in subject_keywords:
-        keywords_str = keyword_config['config_value']
-        category = keyword_config.get('category', '')
-        
-        # Split by comma to handle multiple keywords in one entry
-        keywords = [k.strip().lower() for k in keywords_str.split(',')]
-        
-        for keyword in keywords:
-            if keyword and keyword in subject_lower:
-                if category in priority_map:
-                    mapped_priority = priority_map[category]
-                    # Only upgrade priority, never downgrade
-                    if get_priority_level(mapped_priority) < get_priority_level(final_priority):
-                        final_priority = mapped_priority
-                break
-    
-    # Check body keywords (third priority)
-    body_lower = body.lower()
-    for keyword_config in body_keywords:
-        keywords_str = keyword_config['config_value']
-        category = keyword_config.get('category', '')
-        
-        # Split by comma to handle multiple keywords in one entry
-        keywords = [k.strip().lower() for k in keywords_str.split(',')]
-        
-        for keyword in keywords:
-            if keyword and keyword in body_lower:
-                if category in priority_map:
-                    mapped_priority = priority_map[category]
-                    # Only upgrade priority, never downgrade
-                    if get_priority_level(mapped_priority) < get_priority_level(final_priority):
-                        final_priority = mapped_priority
-                break
-    
-    return final_priority
+# Initialize database and start listening for cache invalidations on startup
+# (spawned normalization workers re-import this module; skip it there)
+if multiprocessing.parent_process() is None:
+    with app.app_context():
+        init_db()
+    start_change_listener()
 
 
 @app.route('/')
@@ -143,29 +39,26 @@ def manage_config():
     if request.method == 'GET':
         config_type = request.args.get('type', 'all')
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            
-            if config_type == 'all':
-                cursor.execute('SELECT * FROM configurations ORDER BY config_type, config_key')
-            else:
-                cursor.execute('SELECT * FROM configurations WHERE config_type = %s', (config_type,))
-            
-            configs = cursor.fetchall()
-            
-            # Group by config_type
-            result = {}
-            for config in configs:
-                config_type = config['config_type']
-                if config_type not in result:
-                    result[config_type] = []
-                result[config_type].append({
-                    'key': config['config_key'],
-                    'value': config['config_value'],
-                    'category': config.get('category')
-                })
-            
-            return jsonify(result)
+        snapshot = config_cache.get()
+        
+        if config_type == 'all':
+            configs = sorted(snapshot.rows, key=lambda row: (row['config_type'], row['config_key']))
+        else:
+            configs = snapshot.of_type(config_type)
+        
+        # Group by config_type
+        result = {}
+        for config in configs:
+            config_type = config['config_type']
+            if config_type not in result:
+                result[config_type] = []
+            result[config_type].append({
+                'key': config['config_key'],
+                'value': config['config_value'],
+                'category': config.get('category')
+            })
+        
+        return jsonify(result)
     
     elif request.method == 'POST':
         data = request.json
@@ -182,7 +75,9 @@ def manage_config():
                 ON CONFLICT (config_type, config_key)
                 DO UPDATE SET config_value = %s, category = %s, updated_at = CURRENT_TIMESTAMP
             ''', (config_type, config_key, config_value, category, config_value, category))
+            notify_change(cursor, 'configurations')
             conn.commit()
+        config_cache.invalidate()
         
         return jsonify({'success': True, 'message': 'Configuration updated'})
 
@@ -206,7 +101,9 @@ def update_or_delete_config(config_type, config_key):
                 INSERT INTO configurations (config_type, config_key, config_value, category)
                 VALUES (%s, %s, %s, %s)
             ''', (config_type, new_key, new_value, category))
+            notify_change(cursor, 'configurations')
             conn.commit()
+        config_cache.invalidate()
         
         return jsonify({'success': True, 'message': 'Configuration updated'})
     
@@ -215,11 +112,39 @@ def update_or_delete_config(config_type, config_key):
             cursor = conn.cursor()
             cursor.execute('DELETE FROM configurations WHERE config_type = %s AND config_key = %s',
                           (config_type, config_key))
+            notify_change(cursor, 'configurations')
             conn.commit()
+        config_cache.invalidate()
         
         return jsonify({'success': True, 'message': 'Configuration deleted'})
 
 
+
+@app.route('/api/backtest', methods=['POST'])
+def backtest_rules():
+    """
+    Replay a proposed triage ruleset over processed mail without changing anything
+    Body: {"rules": {config_type: [rows]}, "limit": N, "samples": N}
+    """
+    data = request.json or {}
+    try:
+        limit = int(data['limit']) if data.get('limit') is not None else None
+        samples = int(data.get('samples', BACKTEST_SAMPLES))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'limit and samples must be integers'}), 400
+    if (limit is not None and limit < 1) or samples < 0:
+        return jsonify({'success': False, 'error': 'limit must be positive and samples not negative'}), 400
+    
+    try:
+        report = run_backtest(data.get('rules') or {}, limit=limit, samples=samples)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error running backtest: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    return jsonify({'success': True, 'report': report})
+
 @app.route('/api/templates', methods=['GET', 'POST'])
 def manage_templates():
     """Get or create email templates"""
@@ -256,6 +181,7 @@ def manage_templates():
                 data.get('category'),
                 data.get('priority', 'Important')
             ))
+            notify_change(cursor, 'email_templates')
             conn.commit()
         
         return jsonify({'success': True, 'message': 'Template saved'})
@@ -267,6 +193,7 @@ def delete_template(template_id):
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM email_templates WHERE id = %s', (template_id,))
+        notify_change(cursor, 'email_templates')
         conn.commit()
     
     return jsonify({'success': True, 'message': 'Template deleted'})
@@ -294,232 +221,27 @@ def process_emails():
             return jsonify({'success': False, 'error': 'No active email accounts configured. Please add an email account in the Email Accounts tab.'}), 400
         
         all_processed = []
+        errors = []
         
-        # Process emails from each account
-        for account in accounts:
-            try:
-                # Decrypt password
-                password = decrypt_password(account['encrypted_password'])
-                
-                # Initialize email service for this account
-                email_service = EmailService(
-                    account['imap_server'],
-                    account['email_address'],
-                    password
-                )
-                
-                # Fetch new emails
-                new_emails = email_service.fetch_new_emails(limit=10)
-                
-                # Get whitelist, subscriptions whitelist, subject keywords, and body keywords
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT config_value FROM configurations WHERE config_type = 'whitelist'")
-                    whitelist = [row['config_value'] for row in cursor.fetchall()]
-                    
-                    cursor.execute("SELECT config_value FROM configurations WHERE config_type = 'subscriptions_whitelist'")
-                    subscriptions_whitelist = [row['config_value'] for row in cursor.fetchall()]
-                    
-                    # Get priority-based sender whitelists
-                    cursor.execute("SELECT config_value, category FROM configurations WHERE config_type = 'whitelist'")
-                    sender_priorities = cursor.fetchall()
-                    
-                    # Get priority-based subject keywords
-                    cursor.execute("SELECT config_value, category FROM configurations WHERE config_type = 'subject_keyword'")
-                    subject_keywords = cursor.fetchall()
-                    
-                    # Get priority-based body keywords
-                    cursor.execute("SELECT config_value, category FROM configurations WHERE config_type = 'body_keyword'")
-                    body_keywords = cursor.fetchall()
-                
-                # Process emails from this account
-                for email_data in new_emails:
-                    sender_email = email_data['sender_email']
-                    
-                    # Validate sender
-                    validation_result = email_service.validate_sender(sender_email, whitelist, subscriptions_whitelist)
-                    
-                    if validation_result == 'subscription_not_whitelisted':
-                        # Skip subscription emails not in whitelist (auto-unsubscribe/delete)
-                        with get_db() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute('''
-                                INSERT INTO email_processing_log 
-                                (email_id, sender_email, subject, received_at, processing_status, validation_result, account_id)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                            ''', (
-                                email_data['id'],
-                                sender_email,
-                                email_data['subject'],
-                                email_data['date'],
-                                'rejected',
-                                validation_result,
-                                account['id']
-                            ))
-                        continue
-                    
-                    # Normalize content
-                    normalized_content = email_service.normalize_content(
-                        email_data.get('body_html', ''),
-                        email_data.get('body_text', '')
-                    )
-                    
-                    # AI Processing - COMBINED (1 API call instead of 4)
-                    analysis = analyze_email_combined(
-                        email_data['subject'],
-                        normalized_content,
-                        sender_email,
-                        email_data.get('has_attachments', False),
-                        email_data.get('attachments', [])
-                    )
-                    
-                    # Extract results from combined analysis
-                    classification = analysis.get('classification', 'General Inquiry')
-                    ai_priority = analysis.get('priority', 'P2')
-                    sentiment = analysis.get('sentiment', 'Neutral')
-                    entities = analysis.get('entities', [])
-                    summary_narrative = analysis.get('summary_narrative', '')
-                    summary_text = summary_narrative
-                    action_required = analysis.get('action_required', False)
-                    
-                    # Check if this is a pure advert (marketing email not in subscriptions whitelist)
-                    is_pure_advert = is_advertisement(classification, sender_email, subscriptions_whitelist)
-                    
-                    if is_pure_advert:
-                        # Permanently delete pure adverts from mailbox
-                        email_service.delete_email(email_data['id'])
-                        
-                        # Log the deletion
-                        with get_db() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute('''
-                                INSERT INTO email_processing_log 
-                                (email_id, sender_email, subject, received_at, processing_status, 
-                                 classification, priority, sentiment, validation_result, account_id)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            ''', (
-                                email_data['id'],
-                                sender_email,
-                                email_data['subject'],
-                                email_data['date'],
-                                'deleted_advert',
-                                classification,
-                                ai_priority,
-                                sentiment,
-                                'pure_advertisement',
-                                account['id']
-                            ))
-                        continue  # Skip to next email
-                    
-                    # Apply triaging matrix to determine final priority
-                    priority = apply_triaging_matrix(
-                        sender_email,
-                        email_data['subject'],
-                        normalized_content,
-                        ai_priority,
-                        sender_priorities,
-                        subject_keywords,
-                        body_keywords
-                    )
-                    
-                    # Check if email requires action (skip draft creation for informational emails)
-                    if not action_required:
-                        # Mark email as read and log as no action required
-                        email_service.mark_as_read(email_data['id'])
-                        
-                        with get_db() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute('''
-                                INSERT INTO email_processing_log 
-                                (email_id, sender_email, subject, received_at, processing_status, 
-                                 classification, priority, sentiment, validation_result, account_id)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            ''', (
-                                email_data['id'],
-                                sender_email,
-                                email_data['subject'],
-                                email_data['date'],
-                                'no_action_required',
-                                classification,
-                                priority,
-                                sentiment,
-                                'informational_only',
-                                account['id']
-                            ))
-                        continue  # Skip draft generation
-                    
-                    # Generate draft response (1 API call) - only for actionable emails
-                    draft = generate_draft_response(
-                        email_data['subject'],
-                        normalized_content,
-                        sender_email,
-                        classification
-                    )
-                    
-                    # Save draft to database
-                    with get_db() as conn:
-                        cursor = conn.cursor()
-                        cursor.execute('''
-                            INSERT INTO email_drafts 
-                            (original_email_id, sender_email, recipient_email, subject, body, 
-                             classification, priority, sentiment, extracted_data, original_content, summary, status, account_id)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            RETURNING id
-                        ''', (
-                            email_data['id'],
-                            sender_email,
-                            account['email_address'],
-                            draft.get('subject'),
-                            draft.get('body'),
-                            classification,
-                            priority,
-                            sentiment,
-                            json.dumps(entities),
-                            normalized_content,
-                            summary_text,
-                            'pending',
-                            account['id']
-                        ))
-                        draft_id = cursor.fetchone()['id']
-                        
-                        # Log processing
-                        cursor.execute('''
-                            INSERT INTO email_processing_log 
-                            (email_id, sender_email, subject, received_at, processing_status, 
-                             classification, priority, sentiment, validation_result, account_id)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ''', (
-                            email_data['id'],
-                            sender_email,
-                            email_data['subject'],
-                            email_data['date'],
-                            'processed',
-                            classification,
-                            priority,
-                            sentiment,
-                            validation_result,
-                            account['id']
-                        ))
-                    
-                    # Mark email as read so it won't be reprocessed
-                    email_service.mark_as_read(email_data['id'])
-                    
-                    all_processed.append({
-                        'account_name': account['account_name'],
-                        'email_id': email_data['id'],
-                        'draft_id': draft_id,
-                        'classification': classification,
-                        'priority': priority
-                    })
+        # Process accounts concurrently; total time is bounded by the slowest account
+        with ThreadPoolExecutor(max_workers=min(ACCOUNT_CONCURRENCY, len(accounts))) as executor:
+            futures = [executor.submit(process_account, account) for account in accounts]
             
-            except Exception as e:
-                print(f"Error processing account {account['account_name']}: {e}")
-                continue
+            # Collect in account order so the response is stable
+            for account, future in zip(accounts, futures):
+                try:
+                    result = future.result()
+                    all_processed.extend(result['processed'])
+                    errors.extend(result['errors'])
+                except Exception as e:
+                    print(f"Error processing account {account['account_name']}: {e}")
+                    errors.append({'account_name': account['account_name'], 'error': str(e)})
         
         return jsonify({
             'success': True,
             'processed_count': len(all_processed),
-            'processed': all_processed
+            'processed': all_processed,
+            'errors': errors
         })
     
     except Exception as e:
@@ -663,11 +385,31 @@ def get_stats():
         ''')
         by_category = cursor.fetchall()
         
+        # How often the local pre-classifier saved an AI call
+        cursor.execute('''
+            SELECT COUNT(*) FILTER (WHERE preclassifier_decision IS NOT NULL) as evaluated,
+                   COUNT(*) FILTER (WHERE ai_skipped) as ai_skipped
+            FROM email_processing_log
+        ''')
+        preclassifier = cursor.fetchone()
+        
         return jsonify({
             'pending_drafts': pending_drafts,
             'approved_drafts': approved_drafts,
             'total_processed': total_processed,
-            'by_category': list(by_category)
+            'by_category': list(by_category),
+            'preclassifier': {
+                'evaluated': preclassifier['evaluated'],
+                'ai_skipped': preclassifier['ai_skipped'],
+                'skip_rate': round(preclassifier['ai_skipped'] / preclassifier['evaluated'], 3) if preclassifier['evaluated'] else 0.0
+            },
+            'analysis_cache': analysis_cache.stats(),
+            'ai_executor': ai_executor.stats(),
+            'batch_analysis': batch_stats(),
+            'ai_provider': {'name': provider.name, 'model': provider.model},
+            'ai_usage': ai_usage_stats(),
+            'context_caches': context_cache_stats(),
+            'drafts': draft_engine.stats()
         })
 
 
@@ -989,6 +731,7 @@ def manage_actions():
                 data.get('sla_hours', 24)
             ))
             action_id = cursor.fetchone()['id']
+            notify_change(cursor, 'actions')
             conn.commit()
         
         return jsonify({'success': True, 'message': 'Action created', 'id': action_id})
@@ -1026,6 +769,7 @@ def manage_action(action_id):
                 data.get('sla_hours', 24),
                 action_id
             ))
+            notify_change(cursor, 'actions')
             conn.commit()
         
         return jsonify({'success': True, 'message': 'Action updated'})
@@ -1035,6 +779,8 @@ def manage_action(action_id):
             cursor = conn.cursor()
             cursor.execute('DELETE FROM action_templates WHERE action_id = %s', (action_id,))
             cursor.execute('DELETE FROM actions WHERE id = %s', (action_id,))
+            notify_change(cursor, 'actions')
+            notify_change(cursor, 'action_templates')
             conn.commit()
         
         return jsonify({'success': True, 'message': 'Action deleted'})
@@ -1072,6 +818,7 @@ def manage_action_templates(action_id):
                     VALUES (%s, %s, %s)
                 ''', (action_id, template_id, order))
             
+            notify_change(cursor, 'action_templates')
             conn.commit()
         
         return jsonify({'success': True, 'message': 'Template links updated'})
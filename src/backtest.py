@@ -0,0 +1,189 @@
+"""
+Triage rule backtesting over historical mail
+
+Replays sender validation, the advert check and the triaging matrix over the
+processing log (with the normalized body of the draft, where one was created)
+twice: with the current rules and with a proposed ruleset, and reports which
+messages would have ended up differently. Rows are read in id-keyset batches
+and both rulesets are compiled once, so replaying 100k messages takes seconds
+and only reads from the database.
+
+    python backtest.py proposed.json [--limit N] [--samples N]
+
+The proposal maps a config_type to the complete list of rows it should have,
+e.g. {"subject_keyword": [{"config_value": "invoice, overdue", "category": "Important"}]};
+types that are left out keep their current rows.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from typing import Dict, Iterator, List, Optional
+
+from database import get_db
+from matching import validate_sender
+from triage import should_delete
+from config_cache import config_cache, ConfigSnapshot
+
+# Configuration types that take part in triage and may be replaced by a proposal
+RULE_TYPES = ('whitelist', 'subscriptions_whitelist', 'subject_keyword', 'body_keyword')
+# Log rows read per query
+BACKTEST_BATCH_SIZE = int(os.environ.get('BACKTEST_BATCH_SIZE', '5000'))
+# Changed messages included in the report
+BACKTEST_SAMPLES = int(os.environ.get('BACKTEST_SAMPLES', '20'))
+
+
+def proposed_snapshot(current: ConfigSnapshot, proposal: Dict) -> ConfigSnapshot:
+    """Current configuration with the rule types in `proposal` replaced, compiled"""
+    if not isinstance(proposal, dict):
+        raise ValueError('Proposed rules must be an object keyed by config_type')
+    unknown = set(proposal) - set(RULE_TYPES)
+    if unknown:
+        raise ValueError(f"Unsupported config_type(s): {', '.join(sorted(unknown))}")
+
+    rows = [row for row in current.rows if row['config_type'] not in proposal]
+    for config_type, entries in proposal.items():
+        if not isinstance(entries, list):
+            raise ValueError(f'Rules for {config_type} must be a list')
+        for entry in entries:
+            # A bare string is shorthand for a row with no category
+            if isinstance(entry, str):
+                entry = {'config_value': entry}
+            if not isinstance(entry, dict) or not entry.get('config_value'):
+                raise ValueError(f'Every {config_type} rule needs a config_value')
+            rows.append({
+                'config_type': config_type,
+                'config_key': entry.get('config_key') or entry['config_value'],
+                'config_value': entry['config_value'],
+                'category': entry.get('category', '')
+            })
+    return ConfigSnapshot(-1, rows)
+
+
+def replay(snapshot: ConfigSnapshot, row: Dict) -> str:
+    """
+    Outcome of one logged message under a ruleset: 'rejected', 'deleted_advert',
+    'unanalyzed' (never reached the AI, so there is nothing to triage) or the final priority
+    """
+    sender_email = row['sender_email'] or ''
+    if validate_sender(sender_email, snapshot.whitelist, snapshot.subscriptions_whitelist) == 'subscription_not_whitelisted':
+        return 'rejected'
+
+    classification = row['classification']
+    if classification is None:
+        return 'unanalyzed'
+    if should_delete(classification, sender_email, snapshot.subscriptions_whitelist, row['ai_skipped']):
+        return 'deleted_advert'
+
+    return snapshot.triage.apply(sender_email, row['subject'] or '', row['body'] or '', row['ai_priority'] or 'P2')
+
+
+def _history_rows(limit: Optional[int], batch_size: int = BACKTEST_BATCH_SIZE) -> Iterator[List[Dict]]:
+    """Logged messages, newest first, in batches of at most batch_size"""
+    before_id = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Rows logged before ai_priority existed only have the final priority
+            cursor.execute('''
+                SELECT l.id, l.email_id, l.subject, l.sender_email, l.processing_status, l.classification,
+                       COALESCE(l.ai_priority, l.priority) AS ai_priority, COALESCE(l.ai_skipped, FALSE) AS ai_skipped,
+                       d.original_content AS body
+                FROM email_processing_log l
+                LEFT JOIN LATERAL (
+                    SELECT original_content FROM email_drafts
+                    WHERE original_email_id = l.email_id AND account_id = l.account_id
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) d ON TRUE
+                WHERE l.processing_status IN ('processed', 'no_action_required', 'deleted_advert', 'rejected')
+                  AND (%s IS NULL OR l.id < %s)
+                ORDER BY l.id DESC
+                LIMIT %s
+            ''', (before_id, before_id, size))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        before_id = rows[-1]['id']
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def run_backtest(proposal: Dict, limit: Optional[int] = None, samples: int = BACKTEST_SAMPLES) -> Dict:
+    """Replay the current and the proposed rules over the newest `limit` logged messages (all if None)"""
+    current = config_cache.get()
+    proposed = proposed_snapshot(current, proposal)
+
+    current_outcomes = Counter()
+    proposed_outcomes = Counter()
+    transitions = Counter()
+    examples = []
+    messages = 0
+    with_body = 0
+    replay_seconds = 0.0
+
+    started = time.perf_counter()
+    for rows in _history_rows(limit):
+        replay_started = time.perf_counter()
+        for row in rows:
+            before = replay(current, row)
+            after = replay(proposed, row)
+            current_outcomes[before] += 1
+            proposed_outcomes[after] += 1
+            if before != after:
+                transitions[f'{before} -> {after}'] += 1
+                if len(examples) < samples:
+                    examples.append({
+                        'log_id': row['id'],
+                        'email_id': row['email_id'],
+                        'sender_email': row['sender_email'],
+                        'subject': row['subject'],
+                        'current': before,
+                        'proposed': after
+                    })
+            if row['body']:
+                with_body += 1
+        messages += len(rows)
+        replay_seconds += time.perf_counter() - replay_started
+    elapsed = time.perf_counter() - started
+
+    return {
+        'messages': messages,
+        'messages_with_body': with_body,
+        'changed': sum(transitions.values()),
+        'transitions': dict(transitions.most_common()),
+        'current': dict(current_outcomes.most_common()),
+        'proposed': dict(proposed_outcomes.most_common()),
+        'examples': examples,
+        'rules': {'current': len(current.triage), 'proposed': len(proposed.triage)},
+        'elapsed_seconds': round(elapsed, 3),
+        'replay_seconds': round(replay_seconds, 3),
+        'messages_per_second': round(messages / elapsed) if elapsed > 0 else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a proposed triage ruleset over processed mail')
+    parser.add_argument('rules', help='JSON file with the proposed rules, keyed by config_type')
+    parser.add_argument('--limit', type=int, help='only replay the newest N messages')
+    parser.add_argument('--samples', type=int, default=BACKTEST_SAMPLES, help='changed messages to list')
+    args = parser.parse_args()
+
+    with open(args.rules) as f:
+        proposal = json.load(f)
+
+    try:
+        report = run_backtest(proposal, limit=args.limit, samples=args.samples)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(report, indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
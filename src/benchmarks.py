@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Performance regression benchmarks for the email pipeline
+
+Each benchmark builds synthetic worst-case input, times the current
+implementation and fails (exit code 1) if it exceeds its time budget.
+
+Usage: cd src && python benchmarks.py [normalize] [html] [triage] [ai] [--repeat N]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+
+from normalization import normalize_text
+from html_extract import FastHtmlBackend, Html2TextBackend, HTML_TEXT_MAX_CHARS
+from triage import TriageRuleset, get_priority_level
+
+
+def _time(func, *args, repeat: int = 3) -> float:
+    """Best wall-clock time of func(*args) over repeat runs, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _legacy_normalize(content: str) -> str:
+    """The regex-based normalization normalize_content used before normalization.py, kept for comparison"""
+    for pattern in [
+        r'On .+ wrote:.*$',
+        r'From:.*?Sent:.*?To:.*?Subject:.*$',
+        r'-----Original Message-----.*$',
+        r'________________________________.*$',
+    ]:
+        content = re.split(pattern, content, flags=re.MULTILINE | re.DOTALL)[0]
+    content = content.strip()
+
+    lines = content.split('\n')
+    for i, line in enumerate(lines):
+        if any(marker in line for marker in ['--', '___', 'Best regards', 'Sincerely', 'Thanks,', 'Regards,']):
+            content = '\n'.join(lines[:i]).strip()
+            break
+
+    content = re.sub(r'\n\s*\n\s*\n', '\n\n', content)
+    return '\n'.join(line.strip() for line in content.split('\n')).strip()
+
+
+def _pathological_bodies(size: int) -> dict:
+    """Bodies that make backtracking regexes blow up, each about size characters long"""
+    def fill(chunk: str) -> str:
+        return (chunk * (size // len(chunk) + 1))[:size]
+
+    return {
+        # Many "On ..." lines but no "wrote:" anywhere
+        'on_without_wrote': fill("On Monday we shipped the release to the staging cluster.\n"),
+        # Many "From:" / "Sent:" lines but never a "Subject:"
+        'from_without_subject': fill("From: alice@example.com\nSent: Tuesday\nTo: bob@example.com\n\n"),
+        # Long runs of whitespace-only lines
+        'blank_runs': fill("text\n" + " \n" * 200),
+        # A real forwarded thread: short reply on top of many quoted messages
+        'forwarded_thread': "Please see below.\n\n" + fill(
+            "From: Alice <alice@example.com>\nSent: Tuesday, 4 March\nTo: Bob\nSubject: RE: Report\n\n"
+            "On Tue, Mar 4, 2025 at 9:00 AM Bob wrote:\n> Looks good, thanks\n\n"
+        ),
+    }
+
+
+def bench_normalize(repeat: int) -> bool:
+    """normalize_text on 200 KB pathological bodies; budget 50 ms per body"""
+    budget = 0.05
+    ok = True
+    for name, body in _pathological_bodies(200 * 1024).items():
+        elapsed = _time(normalize_text, body, repeat=repeat)
+        # The legacy version takes seconds to minutes at full size, so compare on a 4 KB slice
+        small = body[:4 * 1024]
+        legacy = _time(_legacy_normalize, small, repeat=1)
+        current_small = _time(normalize_text, small, repeat=repeat)
+        status = 'ok' if elapsed <= budget else 'SLOW'
+        ok = ok and elapsed <= budget
+        print(f"normalize/{name:<22} 200KB: {elapsed * 1000:8.2f} ms [{status}]   "
+              f"4KB: {current_small * 1000:7.2f} ms (legacy {legacy * 1000:9.2f} ms)")
+    return ok
+
+
+def _html_corpus() -> dict:
+    """Synthetic HTML emails modelled on what real inboxes receive"""
+    style = "<style>" + ".c{color:#333;padding:0;margin:0}" * 2000 + "</style>"
+    preheader = '<div style="display:none;max-height:0">Preheader text you should not see</div>'
+    cell = ('<td class="c"><table><tr><td><a href="https://shop.example.com/p/{i}">Product {i}</a>'
+            '<img src="https://cdn.example.com/{i}.png"></td><td>Now only ${i}.99 &amp; free shipping</td></tr></table></td>')
+    rows = ''.join('<tr>' + ''.join(cell.format(i=r * 4 + c) for c in range(4)) + '</tr>' for r in range(2500))
+    return {
+        # A plain reply written in a webmail client
+        'reply': '<html><body><div dir="ltr">Hi Bob,<br><br>Can you send me the Q3 report by Friday?'
+                 '<br><br>Thanks,<br>Alice</div><blockquote>On Tue Bob wrote:<br>Sure</blockquote></body></html>',
+        # A newsletter with inline CSS, tracking script and a hidden preheader
+        'newsletter': '<html><head>' + style + '<script>var t=1;</script></head><body>' + preheader
+                      + ''.join(f'<h2>Story {i}</h2><p>Paragraph {i} about the week in review.</p>' for i in range(300))
+                      + '</body></html>',
+        # Megabytes of nested layout tables
+        'marketing_tables': '<html><head>' + style + '</head><body>' + preheader
+                            + '<table>' + rows + '</table></body></html>',
+    }
+
+
+# Documents the fast extractor once returned nothing for, and text each must keep
+_HTML_REGRESSIONS = [
+    # </head> is optional
+    ('<html><head><title>x</title><body><p>Hello there, invoice due</p></body></html>', 'Hello there, invoice due'),
+    # An unclosed hidden element ends with its parent
+    ('<div><p style="display:none">Preheader<span>more</span></div><p>Invoice due Friday</p>', 'Invoice due Friday'),
+]
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r'[A-Za-z0-9]{3,}', text))
+
+
+def bench_html(repeat: int) -> bool:
+    """Fast extractor vs html2text on the corpus; fast must be within budget and keep html2text's words"""
+    fast, reference = FastHtmlBackend(), Html2TextBackend()
+    budget = 0.25
+    ok = True
+    for name, html in _html_corpus().items():
+        capped = _time(fast.extract, html, HTML_TEXT_MAX_CHARS, repeat=repeat)
+        full = _time(fast.extract, html, None, repeat=repeat)
+        legacy = _time(reference.extract, html, None, repeat=1)
+
+        # Share of html2text's words the fast extractor also produces (full documents)
+        expected = _words(reference.extract(html))
+        recall = len(expected & _words(fast.extract(html))) / max(1, len(expected))
+
+        status = 'ok' if capped <= budget and recall >= 0.95 else 'SLOW' if capped > budget else 'LOSSY'
+        ok = ok and status == 'ok'
+        print(f"html/{name:<18} {len(html) // 1024:6d}KB: fast {capped * 1000:8.2f} ms "
+              f"(uncapped {full * 1000:8.2f} ms) html2text {legacy * 1000:9.2f} ms "
+              f"recall {recall:.1%} [{status}]")
+
+    for html, expected in _HTML_REGRESSIONS:
+        text = fast.extract(html)
+        found = expected in text and 'Preheader' not in text
+        ok = ok and found
+        print(f"html/regression {html[:40]!r}...: {text.strip()!r} [{'ok' if found else 'LOST'}]")
+    return ok
+
+
+def _legacy_apply_triaging_matrix(sender_email, subject, body, ai_priority, sender_priorities, subject_keywords, body_keywords):
+    """The per-email rule loops apply_triaging_matrix used before triage.py, kept for comparison"""
+    priority_map = {
+        'High Priority': 'P0',
+        'Important': 'P2',
+        'Low Priority': 'P3'
+    }
+    
+    final_priority = ai_priority
+    
+    # Check sender whitelist (highest priority)
+    for sender_config in sender_priorities:
+        sender_pattern = sender_config['config_value'].lower()
+        category = sender_config.get('category', '')
+        
+        if sender_pattern in sender_email.lower() or sender_email.lower().endswith(sender_pattern):
+            if category in priority_map:
+                final_priority = priority_map[category]
+                break
+    
+    # Check subject keywords (second priority)
+    subject_lower = subject.lower()
+    for keyword_config in subject_keywords:
+        keywords_str = keyword_config['config_value']
+        category = keyword_config.get('category', '')
+        
+        # Split by comma to handle multiple keywords in one entry
+        keywords = [k.strip().lower() for k in keywords_str.split(',')]
+        
+        for keyword in keywords:
+            if keyword and keyword in subject_lower:
+                if category in priority_map:
+                    mapped_priority = priority_map[category]
+                    # Only upgrade priority, never downgrade
+                    if get_priority_level(mapped_priority) < get_priority_level(final_priority):
+                        final_priority = mapped_priority
+                break
+    
+    # Check body keywords (third priority)
+    body_lower = body.lower()
+    for keyword_config in body_keywords:
+        keywords_str = keyword_config['config_value']
+        category = keyword_config.get('category', '')
+        
+        # Split by comma to handle multiple keywords in one entry
+        keywords = [k.strip().lower() for k in keywords_str.split(',')]
+        
+        for keyword in keywords:
+            if keyword and keyword in body_lower:
+                if category in priority_map:
+                    mapped_priority = priority_map[category]
+                    # Only upgrade priority, never downgrade
+                    if get_priority_level(mapped_priority) < get_priority_level(final_priority):
+                        final_priority = mapped_priority
+                break
+    
+    return final_priority
+
+
+def _triage_rules(count: int) -> tuple:
+    """count sender, subject and body rules each, with 3 keywords per keyword rule"""
+    categories = ['High Priority', 'Important', 'Low Priority']
+    senders = [{'config_value': f'partner{i}.example.com', 'category': categories[i % 3]} for i in range(count)]
+    subjects = [{'config_value': f'subj{i}a, subj{i}b, subj{i}c', 'category': categories[i % 3]} for i in range(count)]
+    bodies = [{'config_value': f'term{i}x, term{i}y, term{i}z', 'category': categories[i % 3]} for i in range(count)]
+    return senders, subjects, bodies
+
+
+def bench_triage(repeat: int) -> bool:
+    """Compiled TriageRuleset vs the rule loops at 1k+ rules; must agree and be at least 5x faster"""
+    ok = True
+    filler = 'The quarterly numbers look fine and the team is on track for the launch. ' * 130
+    emails = [
+        ('ceo@partner7.example.com', 'Quick question', filler, 'P2'),
+        ('someone@elsewhere.com', 'Re: subj1204b follow-up', filler, 'P3'),
+        ('someone@elsewhere.com', 'Hello', filler + ' term999z ' + filler, 'P3'),
+        ('someone@elsewhere.com', 'Hello', filler, 'P1'),
+    ]
+    for count in (1000, 3000):
+        senders, subjects, bodies = _triage_rules(count)
+        started = time.perf_counter()
+        ruleset = TriageRuleset(senders, subjects, bodies)
+        compile_time = time.perf_counter() - started
+
+        def run_compiled():
+            return [ruleset.apply(*email) for email in emails]
+
+        def run_legacy():
+            return [_legacy_apply_triaging_matrix(*email, senders, subjects, bodies) for email in emails]
+
+        compiled = _time(run_compiled, repeat=repeat) / len(emails)
+        legacy = _time(run_legacy, repeat=repeat) / len(emails)
+        agree = run_compiled() == run_legacy()
+        fast = compiled * 5 <= legacy
+        ok = ok and agree and fast
+        status = 'ok' if agree and fast else 'MISMATCH' if not agree else 'SLOW'
+        print(f"triage/{count * 7:>5} rules ({len(filler) // 1024}KB body): compiled {compiled * 1000:7.3f} ms/email "
+              f"(compile {compile_time * 1000:7.1f} ms once) legacy {legacy * 1000:8.3f} ms/email "
+              f"speedup {legacy / compiled:6.1f}x [{status}]")
+    return ok
+
+
+def bench_ai(repeat: int) -> bool:
+    """Our side of each AI call (prompt, executor, parsing) against a zero-latency stub; must stay under 1 ms"""
+    # The provider is chosen when ai_processor is imported, so configure the stub first
+    os.environ.update({'AI_PROVIDER': 'stub', 'AI_STUB_LATENCY_MS': '0', 'AI_STUB_JITTER_MS': '0', 'AI_STUB_ERROR_RATE': '0'})
+    import ai_processor
+    if ai_processor.provider.name != 'stub':
+        print(f"ai: skipped, ai_processor was already imported with the {ai_processor.provider.name} provider")
+        return True
+
+    ok = True
+    body = 'Hi, could you confirm the delivery date for order 4471? We need it before the audit. ' * 20
+    calls = {
+        'analysis': lambda i: ai_processor._analyze_email_combined(f'Order {i}', body, 'buyer@example.com', False, None),
+        'draft': lambda i: ai_processor.generate_draft_response(f'Order {i}', body, 'buyer@example.com', 'Sales Inquiry'),
+    }
+    count = 200
+    for call_type, call in calls.items():
+        # Averaged over all runs rather than the best, to line up with the stub time from the usage counters
+        before = ai_processor.ai_usage_stats().get(call_type, {}).get('provider_seconds', 0.0)
+        started = time.perf_counter()
+        for i in range(count * repeat):
+            call(i)
+        total = (time.perf_counter() - started) / (count * repeat)
+        provider = (ai_processor.ai_usage_stats()[call_type]['provider_seconds'] - before) / (count * repeat)
+        overhead = total - provider
+        fast = overhead <= 0.001
+        ok = ok and fast
+        print(f"ai/{call_type:<8}: {total * 1e6:7.1f} us/call, stub {provider * 1e6:7.1f} us, "
+              f"overhead {overhead * 1e6:7.1f} us/call [{'ok' if fast else 'SLOW'}]")
+    return ok
+
+
+BENCHMARKS = {
+    'normalize': bench_normalize,
+    'html': bench_html,
+    'triage': bench_triage,
+    'ai': bench_ai,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run performance regression benchmarks')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement; the best is reported')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    ok = True
+    for name in args.names or BENCHMARKS:
+        ok = BENCHMARKS[name](args.repeat) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
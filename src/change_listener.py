@@ -0,0 +1,103 @@
+"""
+Cross-process cache invalidation via Postgres LISTEN/NOTIFY
+
+Writes to cached tables call database.notify_change(cursor, table). Every
+process runs one ChangeListener thread that LISTENs on the channel and calls
+the callbacks registered for the changed table, so web workers and the
+ingestion daemon can cache aggressively without serving stale rules.
+"""
+import select
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+import psycopg2
+import psycopg2.extensions
+
+from database import DATABASE_URL, CHANGE_CHANNEL
+
+# Seconds between checks of the stop flag while waiting for notifications
+LISTEN_POLL_INTERVAL = 5
+# Reconnect backoff bounds in seconds
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+class ChangeListener(threading.Thread):
+    """Background LISTEN connection that dispatches table-change notifications to callbacks"""
+
+    def __init__(self):
+        super().__init__(name='db-change-listener', daemon=True)
+        self._callbacks: Dict[str, List[Callable[[], None]]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def subscribe(self, table: str, callback: Callable[[], None]):
+        """Call `callback` whenever another (or this) process commits a write to `table`"""
+        with self._lock:
+            self._callbacks[table].append(callback)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+                delay = RECONNECT_MIN_DELAY
+            except Exception as e:
+                print(f"Change listener connection failed: {e}; retrying in {delay}s")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _listen(self):
+        conn = psycopg2.connect(DATABASE_URL)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(f'LISTEN {CHANGE_CHANNEL}')
+
+            # Anything may have changed while we were not listening
+            self._dispatch_all()
+
+            while not self._stop_event.is_set():
+                if select.select([conn], [], [], LISTEN_POLL_INTERVAL) == ([], [], []):
+                    continue
+                conn.poll()
+                # Several writes to one table in a burst only need one invalidation
+                tables = {notify.payload for notify in conn.notifies}
+                conn.notifies.clear()
+                for table in tables:
+                    self._dispatch(table)
+        finally:
+            conn.close()
+
+    def _dispatch(self, table: str):
+        with self._lock:
+            callbacks = list(self._callbacks.get(table, []))
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error invalidating cache for {table}: {e}")
+
+    def _dispatch_all(self):
+        with self._lock:
+            tables = list(self._callbacks)
+        for table in tables:
+            self._dispatch(table)
+
+
+# One listener per process; caches subscribe at import, the entry points start it
+change_listener = ChangeListener()
+
+
+def start_change_listener():
+    """Start the process-wide listener thread (no-op if it is already running)"""
+    if not change_listener.is_alive():
+        try:
+            change_listener.start()
+        except RuntimeError:
+            # Already started by another thread
+            pass
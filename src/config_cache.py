@@ -0,0 +1,102 @@
+"""
+In-process cache of the configurations table
+
+The whole table is loaded with one query into a ConfigSnapshot that also holds
+the compiled sender matchers and triage ruleset, so a processing run over many
+accounts compiles and queries the rules once. Writes through /api/config call
+config_cache.invalidate() and NOTIFY other processes, whose change listener
+invalidates their copy. CONFIG_CACHE_TTL is a safety net for missed
+notifications.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from database import get_db
+from matching import SenderMatcher
+from triage import TriageRuleset
+from change_listener import change_listener
+
+# Seconds a snapshot may be served before it is reloaded even without a local write
+CONFIG_CACHE_TTL = float(os.environ.get('CONFIG_CACHE_TTL', '300'))
+
+
+class ConfigSnapshot:
+    """All configuration rows at one version, grouped by type and compiled for processing"""
+
+    def __init__(self, version: int, rows: List[Dict]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.rows = rows
+        self.by_type: Dict[str, List[Dict]] = {}
+        for row in rows:
+            self.by_type.setdefault(row['config_type'], []).append(row)
+
+        self.whitelist = SenderMatcher(self.values('whitelist'))
+        self.subscriptions_whitelist = SenderMatcher(self.values('subscriptions_whitelist'))
+        self.triage = TriageRuleset(
+            self.of_type('whitelist'),
+            self.of_type('subject_keyword'),
+            self.of_type('body_keyword')
+        )
+
+    def of_type(self, config_type: str) -> List[Dict]:
+        """Rows of one config_type in insertion order"""
+        return self.by_type.get(config_type, [])
+
+    def values(self, config_type: str) -> List[str]:
+        return [row['config_value'] for row in self.of_type(config_type)]
+
+    def keys(self, config_type: str) -> set:
+        return {row['config_key'] for row in self.of_type(config_type)}
+
+
+class ConfigCache:
+    """Serves the current ConfigSnapshot, reloading it after invalidate() or when it is older than ttl"""
+
+    def __init__(self, ttl: float = CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._version = 0
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._lock = threading.Lock()
+        # Separate from _lock so invalidate() never waits on a reload's query
+        self._load_lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        """Bump the version; the next get() reloads the table"""
+        with self._lock:
+            self._version += 1
+
+    def get(self) -> ConfigSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self._version and not self._expired(snapshot):
+            return snapshot
+
+        with self._load_lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != self._version or self._expired(snapshot):
+                # Stamp with the version seen before the query; a write during the load triggers another reload
+                version = self._version
+                snapshot = ConfigSnapshot(version, self._load())
+                self._snapshot = snapshot
+            return snapshot
+
+    def _expired(self, snapshot: ConfigSnapshot) -> bool:
+        return self.ttl > 0 and time.monotonic() - snapshot.loaded_at > self.ttl
+
+    @staticmethod
+    def _load() -> List[Dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT config_type, config_key, config_value, category FROM configurations ORDER BY id')
+            return cursor.fetchall()
+
+
+# Shared by the API and the processing loop in this process
+config_cache = ConfigCache()
+change_listener.subscribe('configurations', config_cache.invalidate)
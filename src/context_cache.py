@@ -0,0 +1,180 @@
+"""
+Provider-side caching of static system prompts (Gemini explicit context caching)
+
+The analysis system prompts are identical on every call. A ContextCache
+uploads one of them once through the AI provider (see ai_providers.py;
+Gemini's client.caches.create()) and hands out the cached content name, so
+requests send only the email itself. The cache is created on first use and
+its TTL is extended while it is in use. If creation fails (model without
+caching support) the prompt is sent inline and creation is retried after
+AI_CONTEXT_CACHE_RETRY seconds. A cache the provider no longer accepts
+(expired or deleted) is deleted and replaced on the next request.
+
+Off by default: Gemini only caches stable (non-experimental) models and at
+least AI_CONTEXT_CACHE_MIN_TOKENS tokens (1024 on 2.5 Flash, 4096 on 2.0 Flash),
+while the analysis prompts are around 600 tokens. The prompt is counted with
+the provider's count_tokens before creation, and a prompt below the minimum is
+never uploaded; caching stays off for it and /api/stats says why.
+"""
+import os
+import time
+import threading
+from datetime import timezone
+from typing import Dict, Optional
+
+AI_CONTEXT_CACHE_ENABLED = os.environ.get('AI_CONTEXT_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Smallest prompt the provider's model will cache
+AI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('AI_CONTEXT_CACHE_MIN_TOKENS', '4096'))
+# Seconds a cached prompt lives on the provider after creation or renewal
+AI_CONTEXT_CACHE_TTL = int(os.environ.get('AI_CONTEXT_CACHE_TTL', '3600'))
+# Seconds to wait after a failed creation before trying again
+AI_CONTEXT_CACHE_RETRY = int(os.environ.get('AI_CONTEXT_CACHE_RETRY', '3600'))
+# Renew when less than this many seconds are left, so requests never race the expiry
+RENEW_MARGIN = 300
+
+
+def is_cache_error(error: Exception) -> bool:
+    """Whether the provider rejected a request because of its cached content rather than the request itself"""
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    status = str(getattr(error, 'status', '') or '').upper()
+    if code == 404 or status == 'NOT_FOUND':
+        return True
+    return (code == 400 or status in ('INVALID_ARGUMENT', 'FAILED_PRECONDITION')) and 'cache' in str(error).lower()
+
+
+class ContextCache:
+    """One static system prompt cached on the provider, created lazily and renewed while used"""
+
+    def __init__(self, provider, display_name: str, system_instruction: str,
+                 ttl: int = AI_CONTEXT_CACHE_TTL, enabled: bool = AI_CONTEXT_CACHE_ENABLED,
+                 min_tokens: int = AI_CONTEXT_CACHE_MIN_TOKENS):
+        self.provider = provider
+        self.display_name = display_name
+        self.system_instruction = system_instruction
+        self.ttl = ttl
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        # Counted once, before the first creation
+        self._prompt_tokens: Optional[int] = None
+        self._name: Optional[str] = None
+        self._expires_at = 0.0
+        self._created_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'creations': 0, 'renewals': 0, 'failures': 0}
+        self._last_error: Optional[str] = None
+
+    @staticmethod
+    def _expiry(cached_content, fallback: float) -> float:
+        expire_time = getattr(cached_content, 'expire_time', None)
+        if expire_time is None:
+            return fallback
+        if expire_time.tzinfo is None:
+            expire_time = expire_time.replace(tzinfo=timezone.utc)
+        return expire_time.timestamp()
+
+    def _fail(self, action: str, error: Exception):
+        print(f"Context cache {self.display_name}: {action} failed ({error}); sending the prompt inline")
+        self._name = None
+        self._retry_at = time.time() + AI_CONTEXT_CACHE_RETRY
+        self._counters['failures'] += 1
+        self._last_error = str(error)
+
+    def get(self) -> Optional[str]:
+        """Cached content name to send instead of the system prompt, or None to send it inline"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        name = self._name
+        if name and self._expires_at - now > RENEW_MARGIN:
+            return name
+        if not name and now < self._retry_at:
+            return None
+
+        with self._lock:
+            now = time.time()
+            if self._name and self._expires_at - now > RENEW_MARGIN:
+                return self._name
+            if not self._name and now < self._retry_at:
+                return None
+            ttl = f'{self.ttl}s'
+            if self._name and self._expires_at > now:
+                try:
+                    updated = self.provider.renew_cache(self._name, ttl)
+                    self._expires_at = self._expiry(updated, now + self.ttl)
+                    self._counters['renewals'] += 1
+                    return self._name
+                except Exception as e:
+                    # Probably already gone on the provider side; create a new one below
+                    print(f"Context cache {self.display_name}: renewal failed ({e}); creating a new one")
+                    self._last_error = str(e)
+                    self._delete(self._name)
+            self._name = None
+            if not self._large_enough():
+                return None
+            try:
+                created = self.provider.create_cache(self.display_name, self.system_instruction, ttl)
+                self._name = created.name
+                self._expires_at = self._expiry(created, now + self.ttl)
+                self._created_at = now
+                self._retry_at = 0.0
+                self._counters['creations'] += 1
+                return self._name
+            except Exception as e:
+                self._fail('creation', e)
+                return None
+
+    def _large_enough(self) -> bool:
+        """Whether the prompt reaches the provider's minimum; a smaller one turns caching off for good"""
+        if self._prompt_tokens is None:
+            try:
+                self._prompt_tokens = self.provider.count_tokens(self.system_instruction)
+            except Exception as e:
+                self._fail('token count', e)
+                return False
+        if self._prompt_tokens >= self.min_tokens:
+            return True
+        self.enabled = False
+        self._last_error = (f"prompt is {self._prompt_tokens} tokens, below the {self.min_tokens} "
+                            f"the provider caches (AI_CONTEXT_CACHE_MIN_TOKENS)")
+        print(f"Context cache {self.display_name}: {self._last_error}; sending the prompt inline")
+        return False
+
+    def _delete(self, name: str):
+        """Delete a replaced cache so it stops billing storage; it may already be gone"""
+        try:
+            self.provider.delete_cache(name)
+        except Exception as e:
+            print(f"Context cache {self.display_name}: deleting {name} failed ({e})")
+
+    def invalidate(self, error: Exception) -> bool:
+        """
+        The provider rejected a request using the cache
+        Returns False, leaving the cache alone, when the error is about the request itself. Otherwise
+        the cache is deleted and the next request creates a new one, unless this one was only just
+        created, in which case the prompt is sent inline for AI_CONTEXT_CACHE_RETRY seconds.
+        """
+        if not is_cache_error(error):
+            return False
+        with self._lock:
+            if self._name:
+                self._delete(self._name)
+                if time.time() - self._created_at < RENEW_MARGIN:
+                    self._fail('request', error)
+                else:
+                    print(f"Context cache {self.display_name}: rejected by the provider ({error}); recreating it")
+                    self._name = None
+                    self._last_error = str(error)
+        return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'enabled': self.enabled,
+                'prompt_tokens': self._prompt_tokens,
+                'active': bool(self._name),
+                'expires_in': max(0, round(self._expires_at - time.time())) if self._name else 0,
+                'last_error': self._last_error
+            })
+        return stats
@@ -1,10 +1,16 @@
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json
 from contextlib import contextmanager
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
+# First key of the two-int advisory locks used to serialize ingestion per account
+ACCOUNT_LOCK_NAMESPACE = 4541
+
+# NOTIFY channel announcing writes to cached tables; the payload is the table name
+CHANGE_CHANNEL = 'emailauto_changes'
+
 def _migrate_env_credentials(conn):
     """Auto-migrate environment variable credentials to email_accounts table"""
     cursor = conn.cursor()
@@ -71,6 +77,65 @@ def get_db():
     finally:
         conn.close()
 
+@contextmanager
+def account_lock(account_id):
+    """
+    Postgres advisory lock so only one process ingests an account at a time
+    (e.g. the web app's /api/process-emails and the IDLE ingestion daemon).
+    Yields True if the lock was acquired, False if another session holds it.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(%s, %s) AS locked', (ACCOUNT_LOCK_NAMESPACE, account_id))
+        locked = cursor.fetchone()['locked']
+        try:
+            yield locked
+        finally:
+            if locked:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', (ACCOUNT_LOCK_NAMESPACE, account_id))
+    finally:
+        conn.close()
+
+def notify_change(cursor, table):
+    """
+    Tell every process caching `table` that it changed (see change_listener.py)
+    Sent in the caller's transaction, so listeners only hear about committed writes
+    """
+    cursor.execute('SELECT pg_notify(%s, %s)', (CHANGE_CHANNEL, table))
+
+def get_sync_state(account_id, folder='INBOX'):
+    """
+    Get the stored sync state for an account folder: UIDVALIDITY, the highest UID below which
+    every email is finished, the UIDs above it finished out of order, failed attempts per UID,
+    and the read flags/deletions (uid -> 'seen' or 'delete') that could not be applied yet
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT uidvalidity, last_uid, done_uids, failed_attempts, pending_mutations FROM mailbox_sync_state
+            WHERE account_id = %s AND folder = %s
+        ''', (account_id, folder))
+        return cursor.fetchone()
+
+def save_sync_state(account_id, folder, uidvalidity, last_uid, done_uids=(), failed_attempts=None,
+                    pending_mutations=None):
+    """Store the sync state for an account folder (see get_sync_state)"""
+    done_uids = sorted(done_uids)
+    failed_attempts = Json(failed_attempts or {})
+    pending_mutations = Json(pending_mutations or {})
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO mailbox_sync_state
+                (account_id, folder, uidvalidity, last_uid, done_uids, failed_attempts, pending_mutations)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (account_id, folder)
+            DO UPDATE SET uidvalidity = %s, last_uid = %s, done_uids = %s, failed_attempts = %s,
+                          pending_mutations = %s, updated_at = CURRENT_TIMESTAMP
+        ''', (account_id, folder, uidvalidity, last_uid, done_uids, failed_attempts, pending_mutations,
+              uidvalidity, last_uid, done_uids, failed_attempts, pending_mutations))
+
 def init_db():
     """Initialize database schema"""
     with get_db() as conn:
@@ -173,6 +238,43 @@ def init_db():
             )
         ''')
         
+        # Local pre-classifier outcome per email (see preclassifier.py)
+        cursor.execute('''
+            ALTER TABLE email_processing_log
+                ADD COLUMN IF NOT EXISTS preclassifier_decision VARCHAR(50),
+                ADD COLUMN IF NOT EXISTS preclassifier_confidence REAL,
+                ADD COLUMN IF NOT EXISTS ai_skipped BOOLEAN DEFAULT FALSE
+        ''')
+        
+        # Priority before the triaging matrix, so rule changes can be replayed (see backtest.py)
+        cursor.execute('''
+            ALTER TABLE email_processing_log ADD COLUMN IF NOT EXISTS ai_priority VARCHAR(20)
+        ''')
+        
+        # Draft lookup per logged email, used to replay body rules (see backtest.py)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_email_drafts_original_email
+                ON email_drafts (original_email_id, account_id, id)
+        ''')
+        
+        # Hashed body words, so the local model trains on the body of every outcome (see local_model.py)
+        cursor.execute('''
+            ALTER TABLE email_processing_log ADD COLUMN IF NOT EXISTS body_features INTEGER[]
+        ''')
+        
+        # AI analyses keyed by content hash (see analysis_cache.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                cache_key CHAR(64) PRIMARY KEY,
+                analysis JSONB NOT NULL,
+                model VARCHAR(100),
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMPTZ NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_expires_at ON analysis_cache (expires_at)')
+        
         # System settings table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS system_settings (
@@ -226,6 +328,29 @@ def init_db():
             )
         ''')
         
+        # Mailbox sync state - incremental UID watermark per account/folder
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS mailbox_sync_state (
+                id SERIAL PRIMARY KEY,
+                account_id INTEGER REFERENCES email_accounts(id) ON DELETE CASCADE,
+                folder VARCHAR(255) NOT NULL DEFAULT 'INBOX',
+                uidvalidity BIGINT,
+                last_uid BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(account_id, folder)
+            )
+        ''')
+        
+        # Emails above the watermark that finished while a lower one failed, failed attempts
+        # per UID, and processed emails whose read flag or deletion is still to be applied,
+        # so a run never redoes finished emails (see processing.py)
+        cursor.execute('''
+            ALTER TABLE mailbox_sync_state
+                ADD COLUMN IF NOT EXISTS done_uids BIGINT[] NOT NULL DEFAULT '{}',
+                ADD COLUMN IF NOT EXISTS failed_attempts JSONB NOT NULL DEFAULT '{}',
+                ADD COLUMN IF NOT EXISTS pending_mutations JSONB NOT NULL DEFAULT '{}'
+        ''')
+        
         # Migrate blacklist entries to subscriptions_whitelist
         cursor.execute('''
             UPDATE configurations 
@@ -0,0 +1,281 @@
+"""
+Draft engine: local rendering of action-linked templates, the AI only when needed
+
+Actions (by priority) link to email templates (by category) through
+action_templates. For an email that needs a reply, the engine picks the
+template linked to an action for the email's priority whose category matches
+the classification (or that has no category), and fills its {placeholders}
+from the entities the analysis extracted. A fully rendered template becomes
+the draft without an AI call; if placeholders are left, the partly rendered
+template is passed to generate_draft_response() as its guide. Emails with no
+matching template get the draft written by the fused analysis call
+(AI_FUSED_DRAFT) if there is one, or a freshly generated draft as before.
+Linked templates take precedence over the fused draft. Among several templates
+linked to one action, the link's execution_order decides.
+
+Templates are parsed once per load and reloaded when the change listener
+reports a write to email_templates, actions or action_templates. After a
+failed load, drafts go to the AI for TEMPLATE_LOAD_RETRY seconds before the
+templates are loaded again.
+"""
+import os
+import re
+import time
+import threading
+from string import Formatter
+from typing import Dict, List, Optional, Tuple
+
+from database import get_db
+from ai_processor import generate_draft_response
+from change_listener import change_listener
+
+LOCAL_DRAFTS_ENABLED = os.environ.get('LOCAL_DRAFTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Seconds templates may be served before they are reloaded even without a change notification
+TEMPLATE_CACHE_TTL = float(os.environ.get('TEMPLATE_CACHE_TTL', '300'))
+# Seconds to wait after a failed template load before trying again
+TEMPLATE_LOAD_RETRY = float(os.environ.get('TEMPLATE_LOAD_RETRY', '60'))
+
+# Email priority -> the priority category actions are configured with
+PRIORITY_CATEGORIES = {
+    'P0': 'High Priority',
+    'P1': 'High Priority',
+    'P2': 'Important',
+    'P3': 'Low Priority'
+}
+
+# Placeholder names and the entity types that can fill them, most specific first
+PLACEHOLDER_ALIASES = {
+    'customer_name': ('customer_name', 'person_name', 'name', 'person', 'contact_name', 'sender_name'),
+    'sender_name': ('sender_name', 'person_name', 'customer_name', 'name', 'person'),
+    'name': ('name', 'person_name', 'customer_name', 'sender_name'),
+    'order_id': ('order_id', 'order_number', 'reference_number', 'reference', 'ticket_id'),
+    'reference_number': ('reference_number', 'reference', 'order_id', 'ticket_id', 'invoice_number'),
+    'company_name': ('company_name', 'company', 'organization'),
+    'amount': ('amount', 'price', 'total'),
+    'date': ('date', 'deadline', 'requested_date'),
+}
+
+_KEY_RE = re.compile(r'[^a-z0-9]+')
+
+
+def _key(name: str) -> str:
+    """Entity types and placeholder names compare as snake_case"""
+    return _KEY_RE.sub('_', (name or '').lower()).strip('_')
+
+
+class CompiledTemplate:
+    """An email template parsed into literal text and placeholder segments"""
+
+    def __init__(self, row: Dict):
+        self.id = row['id']
+        self.name = row.get('name') or row.get('template_name')
+        self.category = (row.get('category') or '').strip().lower()
+        self.subject = self._parse(row.get('subject_template') or 'Re: {original_subject}')
+        self.body = self._parse(row['body_template'])
+
+    @staticmethod
+    def _parse(text: str) -> List[Tuple[str, Optional[str], str]]:
+        """[(literal, placeholder or None, original placeholder text)]"""
+        segments = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if field is None:
+                segments.append((literal, None, ''))
+                continue
+            original = '{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}'
+            segments.append((literal, _key(field) if field else None, original if field else '{}'))
+        return segments
+
+    @staticmethod
+    def _render(segments, values: Dict[str, str], missing: set) -> str:
+        parts = []
+        for literal, field, original in segments:
+            parts.append(literal)
+            if field is None:
+                parts.append(original)
+            elif values.get(field):
+                parts.append(values[field])
+            else:
+                # Left in place for the AI to fill in
+                parts.append(original)
+                missing.add(field)
+        return ''.join(parts)
+
+    def render(self, values: Dict[str, str]) -> Tuple[str, str, set]:
+        """(subject, body, names of body placeholders that could not be filled)"""
+        subject_missing = set()
+        subject = self._render(self.subject, values, subject_missing)
+        if subject_missing:
+            # The subject is not worth an AI call; fall back to a plain reply subject
+            subject = 'Re: ' + values.get('original_subject', '')
+        missing = set()
+        body = self._render(self.body, values, missing)
+        return subject, body, missing
+
+
+class TemplateIndex:
+    """Compiled templates indexed by (priority category, classification)"""
+
+    def __init__(self, version: int, rows: List[Dict]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.templates: Dict[int, CompiledTemplate] = {}
+        self._by_category: Dict[Tuple[str, str], CompiledTemplate] = {}
+        self._uncategorized: Dict[str, CompiledTemplate] = {}
+
+        # Rows come in action/link order, so the first link wins for each key
+        for row in rows:
+            action, template_row = row['action'], row['template']
+            priority = action.get('priority') or action.get('trigger_priority')
+            template = self.templates.get(template_row['id'])
+            if template is None:
+                try:
+                    template = CompiledTemplate(template_row)
+                except (ValueError, KeyError) as e:
+                    print(f"Skipping email template {template_row.get('id')}: {e}")
+                    continue
+                self.templates[template.id] = template
+            if template.category:
+                self._by_category.setdefault((priority, template.category), template)
+            else:
+                self._uncategorized.setdefault(priority, template)
+
+    def match(self, classification: str, priority: str) -> Optional[CompiledTemplate]:
+        category = PRIORITY_CATEGORIES.get(priority)
+        if category is None:
+            return None
+        return (self._by_category.get((category, (classification or '').strip().lower()))
+                or self._uncategorized.get(category))
+
+
+class DraftEngine:
+    """Drafts replies from linked templates where possible, falling back to generate_draft_response()"""
+
+    def __init__(self, enabled: bool = LOCAL_DRAFTS_ENABLED, ttl: float = TEMPLATE_CACHE_TTL):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._version = 0
+        self._index: Optional[TemplateIndex] = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._counters = {'template': 0, 'template_ai': 0, 'fused': 0, 'ai': 0}
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            # The write may have fixed whatever made the last load fail
+            self._retry_at = 0.0
+
+    def _templates(self) -> TemplateIndex:
+        index = self._index
+        if index is not None and index.version == self._version and not self._expired(index):
+            return index
+        with self._load_lock:
+            index = self._index
+            if index is None or index.version != self._version or self._expired(index):
+                version = self._version
+                index = TemplateIndex(version, self._load())
+                self._index = index
+            return index
+
+    def _expired(self, index: TemplateIndex) -> bool:
+        return self.ttl > 0 and time.monotonic() - index.loaded_at > self.ttl
+
+    @staticmethod
+    def _load() -> List[Dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Whole rows as JSON: the actions and action_templates columns differ between older and
+            # newer databases (the link order is execution_order, or ordering on older schemas)
+            cursor.execute('''
+                SELECT to_jsonb(a) AS action, to_jsonb(t) AS template
+                FROM action_templates at
+                JOIN actions a ON a.id = at.action_id
+                JOIN email_templates t ON t.id = at.template_id
+                ORDER BY a.id,
+                         COALESCE((to_jsonb(at)->>'execution_order')::int, (to_jsonb(at)->>'ordering')::int),
+                         at.id
+            ''')
+            return cursor.fetchall()
+
+    @staticmethod
+    def placeholder_values(email_subject: str, sender_email: str, classification: str,
+                           priority: str, entities: List[Dict]) -> Dict[str, str]:
+        """Values available to templates: email fields plus extracted entities under their aliases"""
+        best: Dict[str, Tuple[float, str]] = {}
+        for entity in entities or []:
+            if not isinstance(entity, dict) or not entity.get('value'):
+                continue
+            entity_type = _key(entity.get('entity_type', ''))
+            confidence = entity.get('confidence') or 0
+            if entity_type and (entity_type not in best or confidence > best[entity_type][0]):
+                best[entity_type] = (confidence, str(entity['value']))
+
+        values = {entity_type: value for entity_type, (_, value) in best.items()}
+        for placeholder, entity_types in PLACEHOLDER_ALIASES.items():
+            if placeholder not in values:
+                for entity_type in entity_types:
+                    if entity_type in best:
+                        values[placeholder] = best[entity_type][1]
+                        break
+        values.update({
+            'original_subject': email_subject or '',
+            'subject': email_subject or '',
+            'sender_email': sender_email or '',
+            'classification': classification or '',
+            'priority': priority or ''
+        })
+        return values
+
+    def _count(self, source: str):
+        with self._lock:
+            self._counters[source] += 1
+
+    def draft(self, email_subject: str, email_body: str, sender_email: str, classification: str,
+              priority: str, entities: List[Dict], fused_draft: Optional[Dict] = None) -> Dict:
+        """
+        Draft reply {'subject', 'body', 'source', 'template_id'}
+        source is 'template', 'template_ai', 'fused' (fused_draft, used when no template matches) or 'ai'
+        """
+        template = None
+        if self.enabled and time.monotonic() >= self._retry_at:
+            try:
+                template = self._templates().match(classification, priority)
+            except Exception as e:
+                print(f"Error loading draft templates: {e}; using the AI for {TEMPLATE_LOAD_RETRY:.0f}s")
+                self._retry_at = time.monotonic() + TEMPLATE_LOAD_RETRY
+
+        if template is None and fused_draft:
+            self._count('fused')
+            return dict(fused_draft, source='fused', template_id=None)
+
+        if template is None:
+            self._count('ai')
+            draft = generate_draft_response(email_subject, email_body, sender_email, classification)
+            draft.update({'source': 'ai', 'template_id': None})
+            return draft
+
+        values = self.placeholder_values(email_subject, sender_email, classification, priority, entities)
+        subject, body, missing = template.render(values)
+        if not missing:
+            self._count('template')
+            return {'subject': subject, 'body': body, 'source': 'template', 'template_id': template.id}
+
+        # Personalize: the AI fills what the entities could not, using the rendered template as its guide
+        self._count('template_ai')
+        draft = generate_draft_response(email_subject, email_body, sender_email, classification, template=body)
+        draft.update({'source': 'template_ai', 'template_id': template.id})
+        return draft
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+        total = sum(counters.values())
+        counters['local_rate'] = round(counters['template'] / total, 3) if total else 0.0
+        return counters
+
+
+# Shared by the processing threads in this process
+draft_engine = DraftEngine()
+for _table in ('email_templates', 'actions', 'action_templates'):
+    change_listener.subscribe(_table, draft_engine.invalidate)
@@ -1,13 +1,70 @@
 import os
 import re
-import html2text
 from bs4 import BeautifulSoup
 from imap_tools.mailbox import MailBox
-from imap_tools.query import AND
+from imap_tools.query import AND, U
+from imap_tools.utils import check_command_status
+from imap_tools.errors import MailboxFlagError, MailboxDeleteError, MailboxExpungeError, MailboxFetchError
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Iterator, Callable
 import email
 from email.header import decode_header
+from imap_pool import session_pool
+from normalize_pool import normalization_pool
+from matching import validate_sender
+from imap_fetch import (
+    HEADER_FETCH_ITEMS, parse_fetch_response, parse_bodystructure, split_parts,
+    parse_headers, decode_part, estimated_decoded_size
+)
+
+# Messages per UID FETCH when streaming with iter_emails()
+FETCH_BULK_SIZE = int(os.environ.get('FETCH_BULK_SIZE', '10'))
+# Per-section cap on downloaded body bytes (partial fetch); 0 disables the cap
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', str(256 * 1024))) or None
+
+
+def _uid_set(uids) -> str:
+    """Compress UIDs into an IMAP sequence set, e.g. ['1','2','3','7'] -> '1:3,7'"""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    start = prev = numbers[0]
+    for number in numbers[1:]:
+        if number == prev + 1:
+            prev = number
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = number
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+
+class MailboxMutationBuffer:
+    """
+    Deferred mailbox mutations collected during a processing run
+    UIDs are grouped by folder so they can be applied with one STORE per flag
+    and a single expunge per folder
+    """
+    
+    def __init__(self):
+        self.seen: Dict[str, set] = {}
+        self.deleted: Dict[str, set] = {}
+    
+    def mark_seen(self, uid: str, folder: str = "INBOX"):
+        self.seen.setdefault(folder, set()).add(str(uid))
+    
+    def delete(self, uid: str, folder: str = "INBOX"):
+        self.deleted.setdefault(folder, set()).add(str(uid))
+    
+    def folders(self) -> List[str]:
+        return sorted(set(self.seen) | set(self.deleted))
+    
+    def clear(self):
+        self.seen.clear()
+        self.deleted.clear()
+    
+    def __len__(self):
+        return sum(len(u) for u in self.seen.values()) + sum(len(u) for u in self.deleted.values())
+
 
 class EmailService:
     """Service for email ingestion and processing"""
@@ -16,9 +73,7 @@ class EmailService:
         self.imap_server = imap_server
         self.email_user = email_user
         self.email_password = email_password
-        self.html_converter = html2text.HTML2Text()
-        self.html_converter.ignore_links = False
-        self.html_converter.ignore_images = True
+        self.pending = MailboxMutationBuffer()
     
     def connect(self):
         """Connect to the IMAP mailbox"""
@@ -28,80 +83,225 @@ class EmailService:
             print(f"Error connecting to mailbox: {e}")
             raise
     
+    def session(self):
+        """
+        Borrow this account's pooled IMAP session
+        Reuses the authenticated connection across fetch, flag and delete calls
+        """
+        return session_pool.session(self.imap_server, self.email_user, self.email_password)
+    
+    def _select_folder(self, mailbox: MailBox, folder: str):
+        """Select folder unless the pooled session already has it selected"""
+        if mailbox.folder.get() != folder:
+            mailbox.folder.set(folder)
+    
     def fetch_new_emails(self, folder: str = "INBOX", limit: int = 10) -> List[Dict]:
         """
         Fetch new unread emails from the specified folder
         """
         emails = []
         try:
-            with self.connect() as mailbox:
-                mailbox.folder.set(folder)
+            with self.session() as mailbox:
+                self._select_folder(mailbox, folder)
                 
                 # Fetch unread emails
                 for msg in mailbox.fetch(AND(seen=False), limit=limit, reverse=True):
-                    email_data = {
-                        'id': msg.uid,
-                        'subject': msg.subject or '(No Subject)',
-                        'sender': msg.from_,
-                        'sender_email': self._extract_email(msg.from_),
-                        'recipient': msg.to,
-                        'date': msg.date,
-                        'body_html': msg.html,
-                        'body_text': msg.text,
-                        'has_attachments': len(msg.attachments) > 0,
-                        'attachments': [
-                            {
-                                'filename': att.filename,
-                                'content_type': att.content_type,
-                                'size': len(att.payload)
-                            } for att in msg.attachments
-                        ] if msg.attachments else []
-                    }
-                    emails.append(email_data)
+                    emails.append(self._build_email_data(msg))
             
             return emails
         except Exception as e:
             print(f"Error fetching emails: {e}")
             return []
     
+    def fetch_emails_since(self, last_uid: int = 0, uidvalidity: Optional[int] = None,
+                           folder: str = "INBOX", limit: int = 50) -> Tuple[List[Dict], Dict]:
+        """
+        Incrementally fetch emails with UID greater than last_uid
+        Only headers and BODYSTRUCTURE are downloaded (see iter_emails / load_bodies).
+        Returns (emails in ascending UID order, {'uidvalidity': int, 'last_uid': int})
+        where last_uid is the watermark the batch was fetched from.
+        """
+        uids, sync = self.sync_window(last_uid, uidvalidity, folder, limit)
+        return list(self.iter_emails(uids, folder, bulk=max(1, len(uids)))), sync
+    
+    def sync_window(self, last_uid: int = 0, uidvalidity: Optional[int] = None,
+                    folder: str = "INBOX", limit: int = 50) -> Tuple[List[str], Dict]:
+        """
+        Find the UIDs of emails newer than last_uid
+        Only 'UID last_uid+1:*' is searched, so the cost scales with new mail rather than mailbox size.
+        If the folder's UIDVALIDITY differs from the stored one (or nothing is stored yet) the
+        watermark is reset to just below the oldest unread message.
+        Returns (up to limit UIDs in ascending order, {'uidvalidity': int, 'last_uid': int})
+        """
+        with self.session() as mailbox:
+            # Always re-SELECT so the server reports the current UIDVALIDITY/UIDNEXT
+            mailbox.folder.set(folder)
+            current_validity = self._select_response_int(mailbox, 'UIDVALIDITY')
+            
+            if uidvalidity is None or current_validity != uidvalidity:
+                if uidvalidity is not None:
+                    print(f"UIDVALIDITY changed for {self.email_user}/{folder}; resetting sync state")
+                last_uid = self._initial_watermark(mailbox)
+            
+            # 'n:*' always matches the newest message, even when its UID is <= n
+            uids = [uid for uid in mailbox.uids(AND(uid=U(last_uid + 1, '*'))) if int(uid) > last_uid]
+        
+        uids = sorted(uids, key=int)[:limit]
+        return uids, {'uidvalidity': current_validity, 'last_uid': last_uid}
+    
+    def iter_emails(self, uids: List[str], folder: str = "INBOX", bulk: int = FETCH_BULK_SIZE,
+                    body_filter: Optional[Callable[[Dict], bool]] = None,
+                    max_body_bytes: Optional[int] = MAX_BODY_BYTES) -> Iterator[Dict]:
+        """
+        Stream emails in ascending UID order, fetching `bulk` messages per UID FETCH
+        Each chunk is a two-phase fetch: headers and BODYSTRUCTURE first, then, if body_filter
+        is given, the text bodies of the messages it accepts (one batched fetch per chunk).
+        The pooled session is released between chunks, so callers can start normalizing and
+        analyzing earlier messages while later ones are still on the wire, and memory stays
+        bounded by the chunk size on large backlog drains.
+        """
+        for start in range(0, len(uids), max(1, bulk)):
+            chunk = uids[start:start + max(1, bulk)]
+            with self.session() as mailbox:
+                self._select_folder(mailbox, folder)
+                result = mailbox.client.uid('FETCH', _uid_set(chunk), HEADER_FETCH_ITEMS)
+                check_command_status(result, MailboxFetchError)
+            
+            emails = [self._build_header_data(uid, item) for uid, item in parse_fetch_response(result[1]).items()]
+            emails.sort(key=lambda e: int(e['id']))
+            
+            if body_filter is not None:
+                self.load_bodies([e for e in emails if body_filter(e)], folder, max_body_bytes)
+            
+            yield from emails
+    
+    def _select_response_int(self, mailbox: MailBox, name: str) -> Optional[int]:
+        """Read an integer untagged response (e.g. UIDVALIDITY) left by the last SELECT"""
+        typ, data = mailbox.client.response(name)
+        if data and data[-1] is not None:
+            return int(data[-1])
+        return None
+    
+    def _initial_watermark(self, mailbox: MailBox) -> int:
+        """
+        Starting UID for a folder with no usable sync state
+        Existing unread mail is picked up once; everything already read is skipped.
+        """
+        unseen = mailbox.uids(AND(seen=False))
+        if unseen:
+            return min(int(uid) for uid in unseen) - 1
+        newest = mailbox.uids('UID *')
+        return max((int(uid) for uid in newest), default=0)
+    
+    def load_bodies(self, emails: List[Dict], folder: str = "INBOX",
+                    max_body_bytes: Optional[int] = MAX_BODY_BYTES) -> List[Dict]:
+        """
+        Phase two of the two-phase fetch: download only the text/plain and text/html
+        sections of the given header-only emails (attachments are never fetched).
+        Messages with the same section layout are fetched with a single UID FETCH.
+        Each section is capped at max_body_bytes with a partial fetch; capped emails
+        get body_truncated=True.
+        """
+        pending: Dict[Tuple[str, ...], List[Dict]] = {}
+        for email_data in emails:
+            if email_data.get('body_loaded'):
+                continue
+            sections = tuple(sorted(part['section'] for part in email_data['text_parts'].values()))
+            if not sections:
+                email_data['body_loaded'] = True
+                continue
+            pending.setdefault(sections, []).append(email_data)
+        
+        if not pending:
+            return emails
+        
+        with self.session() as mailbox:
+            self._select_folder(mailbox, folder)
+            for sections, group in pending.items():
+                by_uid = {str(e['id']): e for e in group}
+                partial = f"<0.{max_body_bytes}>" if max_body_bytes else ''
+                items = ' '.join(f"BODY.PEEK[{section}]{partial}" for section in sections)
+                result = mailbox.client.uid('FETCH', _uid_set(by_uid), f"(UID {items})")
+                check_command_status(result, MailboxFetchError)
+                
+                for uid, item in parse_fetch_response(result[1]).items():
+                    email_data = by_uid.get(uid)
+                    if email_data is None:
+                        continue
+                    for content_type, part in email_data['text_parts'].items():
+                        payload = item['BODY'].get(part['section'].upper(), b'')
+                        text = decode_part(payload, part['encoding'], part['charset'])
+                        if content_type == 'text/html':
+                            email_data['body_html'] = text
+                        else:
+                            email_data['body_text'] = text
+                        if max_body_bytes and part['size'] > max_body_bytes:
+                            email_data['body_truncated'] = True
+                    email_data['body_loaded'] = True
+        
+        return emails
+    
+    def _build_header_data(self, uid: str, item: Dict) -> Dict:
+        """Build the pipeline email dict from a phase-one (headers + BODYSTRUCTURE) fetch"""
+        parsed = parse_headers(item['BODY'].get('HEADER', b''))
+        text_parts, attachment_parts = split_parts(parse_bodystructure(item.get('BODYSTRUCTURE')))
+        return {
+            'id': uid,
+            'subject': parsed['subject'] or '(No Subject)',
+            'sender': parsed['from'],
+            'sender_email': self._extract_email(parsed['from']),
+            'recipient': parsed['to'],
+            'date': parsed['date'],
+            'headers': parsed['headers'],
+            'size': int(item.get('RFC822.SIZE') or 0),
+            'body_html': '',
+            'body_text': '',
+            'body_loaded': False,
+            'body_truncated': False,
+            'text_parts': text_parts,
+            'has_attachments': len(attachment_parts) > 0,
+            'attachments': [
+                {
+                    'filename': part['filename'] or 'unnamed',
+                    'content_type': part['content_type'],
+                    'size': estimated_decoded_size(part)
+                } for part in attachment_parts
+            ]
+        }
+    
+    def _build_email_data(self, msg) -> Dict:
+        """Convert an imap_tools MailMessage into the dict used by the processing pipeline"""
+        return {
+            'id': msg.uid,
+            'subject': msg.subject or '(No Subject)',
+            'sender': msg.from_,
+            'sender_email': self._extract_email(msg.from_),
+            'recipient': msg.to,
+            'date': msg.date,
+            'body_html': msg.html,
+            'body_text': msg.text,
+            'has_attachments': len(msg.attachments) > 0,
+            'attachments': [
+                {
+                    'filename': att.filename,
+                    'content_type': att.content_type,
+                    'size': len(att.payload)
+                } for att in msg.attachments
+            ] if msg.attachments else []
+        }
+    
     def _extract_email(self, from_field: str) -> str:
         """Extract email address from From field"""
         match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_field)
         return match.group(0) if match else from_field
     
-    def validate_sender(self, sender_email: str, whitelist: List[str], subscriptions_whitelist: List[str]) -> str:
+    def validate_sender(self, sender_email: str, whitelist, subscriptions_whitelist) -> str:
         """
         Validate sender against whitelist and subscriptions whitelist
+        Both lists may be passed pre-compiled as SenderMatcher (see matching.py)
         Returns: 'whitelisted', 'subscription_not_whitelisted', or 'unknown'
         """
-        sender_lower = sender_email.lower()
-        sender_domain = sender_email.split('@')[-1].lower() if '@' in sender_email else ''
-        
-        # Check whitelist (high priority senders)
-        for allowed in whitelist:
-            if allowed.lower() in sender_lower or allowed.lower() == sender_domain:
-                return 'whitelisted'
-        
-        # Detect subscription/newsletter emails using common patterns
-        subscription_indicators = [
-            'newsletter', 'noreply', 'no-reply', 'notifications', 
-            'updates', 'mailer', 'news', 'marketing', 'promo',
-            'automated', 'digest', 'subscriptions', 'campaigns'
-        ]
-        
-        is_subscription = any(indicator in sender_lower for indicator in subscription_indicators)
-        
-        if is_subscription:
-            # Check if this subscription is whitelisted (allowed to keep)
-            for allowed_sub in subscriptions_whitelist:
-                if allowed_sub.lower() in sender_lower or allowed_sub.lower() == sender_domain:
-                    return 'unknown'  # Process normally (it's a wanted subscription)
-            
-            # Subscription not in whitelist - should be unsubscribed/deleted
-            return 'subscription_not_whitelisted'
-        
-        # Not a subscription, process normally
-        return 'unknown'
+        return validate_sender(sender_email, whitelist, subscriptions_whitelist)
     
     def normalize_content(self, body_html: str, body_text: str) -> str:
         """
@@ -111,61 +311,14 @@ class EmailService:
         - Remove previous reply chains
         - Extract core message
         """
-        # Prefer text version if available, otherwise convert HTML
-        if body_text:
-            content = body_text
-        elif body_html:
-            content = self.html_converter.handle(body_html)
-        else:
-            return ""
-        
-        # Remove common email artifacts
-        content = self._remove_reply_chains(content)
-        content = self._remove_signatures(content)
-        content = self._clean_whitespace(content)
-        
-        return content
-    
-    def _remove_reply_chains(self, content: str) -> str:
-        """Remove previous email replies from the content"""
-        # Common reply indicators
-        reply_patterns = [
-            r'On .+ wrote:.*$',
-            r'From:.*?Sent:.*?To:.*?Subject:.*$',
-            r'-----Original Message-----.*$',
-            r'________________________________.*$',
-        ]
-        
-        for pattern in reply_patterns:
-            content = re.split(pattern, content, flags=re.MULTILINE | re.DOTALL)[0]
-        
-        return content.strip()
-    
-    def _remove_signatures(self, content: str) -> str:
-        """Remove email signatures"""
-        # Common signature patterns
-        signature_markers = ['--', '___', 'Best regards', 'Sincerely', 'Thanks,', 'Regards,']
-        
-        lines = content.split('\n')
-        for i, line in enumerate(lines):
-            if any(marker in line for marker in signature_markers):
-                # Keep content before signature
-                return '\n'.join(lines[:i]).strip()
-        
-        return content
-    
-    def _clean_whitespace(self, content: str) -> str:
-        """Clean up excessive whitespace"""
-        # Remove multiple blank lines
-        content = re.sub(r'\n\s*\n\s*\n', '\n\n', content)
-        # Remove leading/trailing whitespace from lines
-        lines = [line.strip() for line in content.split('\n')]
-        return '\n'.join(lines).strip()
+        # Prefer text version if available, otherwise convert HTML; large bodies
+        # are handled by worker processes so they don't hold the GIL here
+        return normalization_pool.normalize(body_html, body_text)
     
     def mark_as_read(self, email_id: str):
         """Mark an email as read"""
         try:
-            with self.connect() as mailbox:
+            with self.session() as mailbox:
                 mailbox.flag(email_id, '\\Seen', True)
         except Exception as e:
             print(f"Error marking email as read: {e}")
@@ -176,7 +329,7 @@ class EmailService:
         Marks it as deleted and expunges it from the server
         """
         try:
-            with self.connect() as mailbox:
+            with self.session() as mailbox:
                 # Mark email as deleted
                 mailbox.delete([email_id])
                 # Expunge to permanently remove
@@ -187,6 +340,65 @@ class EmailService:
             print(f"Error deleting email {email_id}: {e}")
             return False
     
+    def queue_mark_as_read(self, email_id: str, folder: str = "INBOX"):
+        """Defer marking an email as read until flush_mutations()"""
+        self.pending.mark_seen(email_id, folder)
+    
+    def queue_delete(self, email_id: str, folder: str = "INBOX"):
+        """Defer permanently deleting an email until flush_mutations()"""
+        self.pending.delete(email_id, folder)
+    
+    def flush_mutations(self) -> Dict:
+        """
+        Apply all queued flag and delete operations
+        Per folder this issues one UID STORE for \\Seen, one UID STORE for \\Deleted
+        and a single (UID) EXPUNGE, instead of one round trip per message.
+        Returns {'marked_read': n, 'deleted': n, 'failed': {uid: 'seen' or 'delete'}}; failed
+        holds the queued operations that were not applied, so the caller can retry them.
+        """
+        counts = {'marked_read': 0, 'deleted': 0, 'failed': {}}
+        if not len(self.pending):
+            return counts
+        
+        try:
+            with self.session() as mailbox:
+                uidplus = 'UIDPLUS' in mailbox.client.capabilities
+                for folder in self.pending.folders():
+                    deleted = self.pending.deleted.get(folder, set())
+                    # No point flagging messages that are about to be expunged
+                    seen = self.pending.seen.get(folder, set()) - deleted
+                    self._select_folder(mailbox, folder)
+                    
+                    if seen:
+                        result = mailbox.client.uid('STORE', _uid_set(seen), '+FLAGS.SILENT', r'(\Seen)')
+                        check_command_status(result, MailboxFlagError)
+                        counts['marked_read'] += len(seen)
+                    self.pending.seen.pop(folder, None)
+                    
+                    if deleted:
+                        uid_set = _uid_set(deleted)
+                        result = mailbox.client.uid('STORE', uid_set, '+FLAGS.SILENT', r'(\Deleted)')
+                        check_command_status(result, MailboxDeleteError)
+                        # UID EXPUNGE only removes our messages; plain EXPUNGE is the fallback
+                        if uidplus:
+                            result = mailbox.client.uid('EXPUNGE', uid_set)
+                            check_command_status(result, MailboxExpungeError)
+                        else:
+                            mailbox.expunge()
+                        counts['deleted'] += len(deleted)
+                        print(f"Permanently deleted {len(deleted)} email(s) from {folder}")
+                    self.pending.deleted.pop(folder, None)
+        except Exception as e:
+            print(f"Error applying queued mailbox changes: {e}")
+            # Whatever is still queued was not applied; a delete also covers the read flag
+            for uids in self.pending.seen.values():
+                counts['failed'].update((uid, 'seen') for uid in uids)
+            for uids in self.pending.deleted.values():
+                counts['failed'].update((uid, 'delete') for uid in uids)
+        
+        self.pending.clear()
+        return counts
+    
     def send_draft_email(self, to_email: str, subject: str, body: str):
         """
         This is a placeholder for sending emails.
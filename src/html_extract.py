@@ -0,0 +1,248 @@
+"""
+HTML to plain text extraction for email bodies
+
+The text only feeds normalization and the AI prompt, so extraction favours
+speed over layout fidelity: style, script and hidden elements are dropped,
+tables flatten to lines, and parsing stops as soon as enough text has been
+collected. Open elements are tracked on a stack, so an unclosed hidden element
+ends with its parent and a <head> without </head> ends where the body begins. The backend is chosen with HTML_EXTRACT_BACKEND:
+
+- fast:      streaming html.parser extractor (default)
+- html2text: the previous Markdown-style conversion
+"""
+import os
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+
+import html2text
+
+HTML_EXTRACT_BACKEND = os.environ.get('HTML_EXTRACT_BACKEND', 'fast')
+# Stop extracting once this many characters of text have been collected; 0 disables the cap
+HTML_TEXT_MAX_CHARS = int(os.environ.get('HTML_TEXT_MAX_CHARS', '20000')) or None
+
+# HTML is fed to the parser in chunks of this size so that parsing can stop early
+FEED_CHUNK_SIZE = 64 * 1024
+
+# Elements whose content is never visible text
+SKIP_TAGS = {'head', 'title', 'style', 'script', 'noscript', 'template', 'svg', 'object', 'iframe'}
+# Elements that start a new line
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'blockquote', 'hr', 'pre',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'header', 'footer', 'center',
+}
+# Elements without an end tag
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'param', 'source', 'track', 'wbr',
+}
+
+# Elements allowed inside <head>; any other start tag means the body has begun (</head> is optional)
+HEAD_TAGS = {'title', 'meta', 'link', 'style', 'script', 'noscript', 'template', 'base'}
+# Start tags that implicitly close an open <p>
+P_CLOSING_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'fieldset', 'footer', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'menu', 'nav', 'ol', 'p', 'pre',
+    'section', 'table', 'ul',
+}
+
+_HIDDEN_STYLE_RE = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden|max-height\s*:\s*0(?![.\d])', re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+class _TextCollector(HTMLParser):
+    """HTMLParser that collects visible text and tracks how much it has collected"""
+
+    def __init__(self, include_links: bool):
+        super().__init__(convert_charrefs=True)
+        self.include_links = include_links
+        self.parts: List[str] = []
+        self.length = 0
+        # Open elements, with a count per tag so stray end tags are recognised in O(1)
+        self._stack: List[str] = []
+        self._open: Dict[str, int] = {}
+        # Stack index of the skipped element we are inside; the skip ends when it is popped,
+        # whether by its own end tag or by an ancestor's
+        self._skip_at: Optional[int] = None
+        self._pre_depth = 0
+        self._href: Optional[str] = None
+        self._link_text: List[str] = []
+
+    def _emit(self, text: str):
+        if self._href is not None:
+            self._link_text.append(text)
+        self.parts.append(text)
+        self.length += len(text)
+
+    def _newline(self):
+        if self.parts and not self.parts[-1].endswith('\n'):
+            self._emit('\n')
+
+    def _push(self, tag: str):
+        self._stack.append(tag)
+        self._open[tag] = self._open.get(tag, 0) + 1
+
+    def _pop(self):
+        tag = self._stack.pop()
+        self._open[tag] -= 1
+        if self._skip_at is not None and len(self._stack) <= self._skip_at:
+            self._skip_at = None
+
+    def _close(self, tag: str) -> bool:
+        """Pop up to and including the innermost open `tag`; False for a stray end tag"""
+        if not self._open.get(tag):
+            return False
+        while self._stack[-1] != tag:
+            self._pop()
+        self._pop()
+        return True
+
+    def _in_head(self) -> bool:
+        """Directly inside a skipped <head>, not inside one of its children"""
+        return (self._skip_at is not None and self._stack[self._skip_at] == 'head'
+                and len(self._stack) == self._skip_at + 1)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in P_CLOSING_TAGS and self._stack and self._stack[-1] == 'p':
+            # Ends a hidden <p> too, like a browser would
+            self._pop()
+            if self._skip_at is None:
+                self._newline()
+
+        if self._skip_at is not None:
+            if self._in_head() and tag not in HEAD_TAGS:
+                # <body> or flow content directly in <head>: the head ended without its end tag
+                self._pop()
+            else:
+                if tag not in VOID_TAGS:
+                    self._push(tag)
+                return
+
+        attributes = dict(attrs)
+        hidden = (
+            tag in SKIP_TAGS
+            or 'hidden' in attributes
+            or (attributes.get('aria-hidden') or '').lower() == 'true'
+            or _HIDDEN_STYLE_RE.search(attributes.get('style') or '')
+        )
+        if tag not in VOID_TAGS:
+            self._push(tag)
+            if hidden:
+                self._skip_at = len(self._stack) - 1
+                return
+        elif hidden:
+            return
+
+        if tag == 'br':
+            # Consecutive <br>s are deliberate blank lines
+            self._emit('\n')
+        elif tag in BLOCK_TAGS:
+            self._newline()
+        if tag == 'li':
+            self._emit('- ')
+        elif tag in ('td', 'th'):
+            self._emit(' ')
+        elif tag == 'pre':
+            self._pre_depth += 1
+        elif tag == 'a' and self.include_links:
+            href = attributes.get('href') or ''
+            if href.startswith(('http://', 'https://')):
+                self._href, self._link_text = href, []
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        skipping = self._skip_at is not None
+        closed = self._close(tag)
+        if skipping or (tag != 'br' and not closed and tag not in BLOCK_TAGS):
+            return
+
+        if tag == 'a' and self._href is not None:
+            href, self._href = self._href, None
+            text = ''.join(self._link_text).strip()
+            if text and text != href:
+                self._emit(f" ({href})")
+        elif tag == 'pre':
+            self._pre_depth = max(0, self._pre_depth - 1)
+        if tag in BLOCK_TAGS:
+            self._newline()
+
+    def handle_data(self, data):
+        if self._in_head() and data.strip():
+            # Text can't be in <head>, so the body has begun
+            self._pop()
+        if self._skip_at is not None:
+            return
+        if not self._pre_depth:
+            data = _WHITESPACE_RE.sub(' ', data)
+            if data == ' ' and (not self.parts or self.parts[-1].endswith((' ', '\n'))):
+                return
+        if data:
+            self._emit(data)
+
+
+class FastHtmlBackend:
+    """Streaming extractor built on the standard library's html.parser"""
+
+    name = 'fast'
+
+    def __init__(self, include_links: bool = True):
+        self.include_links = include_links
+
+    def extract(self, html: str, max_chars: Optional[int] = None) -> str:
+        collector = _TextCollector(self.include_links)
+        for start in range(0, len(html), FEED_CHUNK_SIZE):
+            collector.feed(html[start:start + FEED_CHUNK_SIZE])
+            if max_chars and collector.length >= max_chars:
+                # Enough text for the prompt; the rest of the document is never parsed
+                break
+        else:
+            collector.close()
+        text = ''.join(collector.parts)
+        return text[:max_chars] if max_chars else text
+
+
+class Html2TextBackend:
+    """The html2text Markdown conversion the app used originally"""
+
+    name = 'html2text'
+
+    def __init__(self, include_links: bool = True):
+        self.include_links = include_links
+
+    def extract(self, html: str, max_chars: Optional[int] = None) -> str:
+        # HTML2Text keeps parse state on the instance, so each call gets its own
+        converter = html2text.HTML2Text()
+        converter.ignore_links = not self.include_links
+        converter.ignore_images = True
+        text = converter.handle(html)
+        return text[:max_chars] if max_chars else text
+
+
+BACKENDS = {
+    FastHtmlBackend.name: FastHtmlBackend,
+    Html2TextBackend.name: Html2TextBackend,
+}
+
+
+def get_backend(name: str = HTML_EXTRACT_BACKEND):
+    """Instantiate an extraction backend by name, falling back to the fast one"""
+    backend = BACKENDS.get(name)
+    if backend is None:
+        print(f"Unknown HTML_EXTRACT_BACKEND '{name}', using '{FastHtmlBackend.name}'")
+        backend = FastHtmlBackend
+    return backend()
+
+
+# Shared by every EmailService in this process; backends are stateless between calls
+html_extractor = get_backend()
+
+
+def html_to_text(html: str, max_chars: Optional[int] = HTML_TEXT_MAX_CHARS) -> str:
+    """Convert an HTML email body to plain text with the configured backend"""
+    if not html:
+        return ''
+    return html_extractor.extract(html, max_chars)
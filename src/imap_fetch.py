@@ -0,0 +1,295 @@
+"""
+Low-level helpers for the two-phase IMAP fetch
+
+Phase one fetches UID, RFC822.SIZE, BODYSTRUCTURE and the header block with
+BODY.PEEK, which is enough for sender validation and triage pre-checks.
+Phase two fetches only the text/plain and text/html sections of messages that
+survive validation. Attachment sizes come from BODYSTRUCTURE, so attachment
+payloads are never downloaded.
+"""
+import re
+import base64
+import quopri
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses, parsedate_to_datetime
+from typing import List, Dict, Optional, Tuple
+
+HEADER_FETCH_ITEMS = '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+class _Literal:
+    """Marker for a literal string in the token stream"""
+
+    def __init__(self, value: bytes):
+        self.value = value
+
+
+def _segments(fetch_data: list) -> List:
+    """
+    Flatten imaplib FETCH data into text segments and literals
+    imaplib returns literals as (b'... {123}', b'<literal>') tuples
+    """
+    segments = []
+    for item in fetch_data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            head, literal = item[0], item[1]
+            match = _LITERAL_RE.search(head)
+            if match:
+                head = head[:match.start()]
+            segments.append(head)
+            segments.append(_Literal(literal))
+        else:
+            segments.append(item)
+            # Each plain item is a separate response line
+            segments.append(b' ')
+    return segments
+
+
+def _tokenize(segments: List):
+    """Tokenize IMAP response data into a nested list structure"""
+    root: list = []
+    stack = [root]
+
+    for segment in segments:
+        if isinstance(segment, _Literal):
+            stack[-1].append(segment.value)
+            continue
+
+        text = segment
+        i, n = 0, len(text)
+        while i < n:
+            ch = text[i:i + 1]
+            if ch in (b' ', b'\r', b'\n'):
+                i += 1
+            elif ch == b'(':
+                child: list = []
+                stack[-1].append(child)
+                stack.append(child)
+                i += 1
+            elif ch == b')':
+                if len(stack) > 1:
+                    stack.pop()
+                i += 1
+            elif ch == b'"':
+                i += 1
+                value = bytearray()
+                while i < n and text[i:i + 1] != b'"':
+                    if text[i:i + 1] == b'\\' and i + 1 < n:
+                        i += 1
+                    value += text[i:i + 1]
+                    i += 1
+                stack[-1].append(bytes(value))
+                i += 1
+            else:
+                start = i
+                depth = 0
+                while i < n:
+                    ch = text[i:i + 1]
+                    if ch == b'[':
+                        depth += 1
+                    elif ch == b']':
+                        depth -= 1
+                    elif depth == 0 and ch in (b' ', b'(', b')'):
+                        break
+                    i += 1
+                atom = text[start:i]
+                stack[-1].append(None if atom.upper() == b'NIL' else atom.decode('ascii', 'replace'))
+    return root
+
+
+def _section_key(name: str) -> str:
+    """'BODY[1.2]<0>' -> '1.2', 'BODY[HEADER.FIELDS (FROM)]' -> 'HEADER'"""
+    section = name[name.index('[') + 1:name.rindex(']')].upper()
+    if section.startswith('HEADER'):
+        return 'HEADER'
+    return section
+
+
+def parse_fetch_response(fetch_data: list) -> Dict[str, Dict]:
+    """
+    Parse UID FETCH response data into {uid: {'UID', 'RFC822.SIZE', 'BODYSTRUCTURE', 'BODY': {section: bytes}}}
+    """
+    tokens = _tokenize(_segments(fetch_data))
+    messages: Dict[str, Dict] = {}
+
+    for token in tokens:
+        if not isinstance(token, list):
+            continue
+        item: Dict = {'BODY': {}}
+        for j in range(0, len(token) - 1, 2):
+            name, value = token[j], token[j + 1]
+            if not isinstance(name, str):
+                continue
+            upper = name.upper()
+            if upper.startswith('BODY[') or upper.startswith('BINARY['):
+                item['BODY'][_section_key(upper)] = value if isinstance(value, bytes) else b''
+            else:
+                item[upper] = value
+        uid = item.get('UID')
+        if uid is None:
+            # Unsolicited FETCH (e.g. a FLAGS update) - not part of our request
+            continue
+        merged = messages.setdefault(str(uid), {'BODY': {}})
+        merged['BODY'].update(item.pop('BODY'))
+        merged.update(item)
+    return messages
+
+
+def _text(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def _params(value) -> Dict[str, str]:
+    """Body parameter list ("CHARSET" "utf-8" "NAME" "x.pdf") -> dict"""
+    if not isinstance(value, list):
+        return {}
+    result = {}
+    for j in range(0, len(value) - 1, 2):
+        key = _text(value[j])
+        if key:
+            result[key.lower()] = _decode_header_value(_text(value[j + 1]) or '')
+    return result
+
+
+def parse_bodystructure(structure, section: str = '') -> List[Dict]:
+    """
+    Flatten a BODYSTRUCTURE into leaf parts
+    Each part: {'section', 'content_type', 'charset', 'encoding', 'size', 'disposition', 'filename'}
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    if isinstance(structure[0], list):
+        # Multipart: child bodies followed by the subtype and extension data
+        parts = []
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            child_section = f"{section}.{index}" if section else str(index)
+            parts.extend(parse_bodystructure(child, child_section))
+        return parts
+
+    main_type = (_text(structure[0]) or 'application').lower()
+    sub_type = (_text(structure[1]) or 'octet-stream').lower() if len(structure) > 1 else 'octet-stream'
+    params = _params(structure[2]) if len(structure) > 2 else {}
+    encoding = (_text(structure[5]) or '7bit').lower() if len(structure) > 5 else '7bit'
+    try:
+        size = int(structure[6]) if len(structure) > 6 else 0
+    except (TypeError, ValueError):
+        size = 0
+
+    # Extension data starts after the type-specific fields
+    if main_type == 'text':
+        ext_start = 8
+    elif main_type == 'message' and sub_type == 'rfc822':
+        ext_start = 10
+    else:
+        ext_start = 7
+    disposition = None
+    disposition_params: Dict[str, str] = {}
+    if len(structure) > ext_start + 1 and isinstance(structure[ext_start + 1], list):
+        disp = structure[ext_start + 1]
+        disposition = (_text(disp[0]) or '').lower() or None
+        disposition_params = _params(disp[1]) if len(disp) > 1 else {}
+
+    filename = disposition_params.get('filename') or params.get('name')
+
+    return [{
+        'section': section or '1',
+        'content_type': f"{main_type}/{sub_type}",
+        'charset': params.get('charset', 'utf-8'),
+        'encoding': encoding,
+        'size': size,
+        'disposition': disposition,
+        'filename': filename,
+    }]
+
+
+def split_parts(parts: List[Dict]) -> Tuple[Dict[str, Dict], List[Dict]]:
+    """
+    Pick the body text parts and the attachments out of a flattened BODYSTRUCTURE
+    Returns ({'text/plain': part, 'text/html': part}, [attachment parts])
+    """
+    text_parts: Dict[str, Dict] = {}
+    attachments = []
+    for part in parts:
+        if part['disposition'] == 'attachment' or part['filename']:
+            attachments.append(part)
+        elif part['content_type'] in ('text/plain', 'text/html'):
+            text_parts.setdefault(part['content_type'], part)
+        elif not part['content_type'].startswith('text/'):
+            # Inline images and other non-text parts still count as attachments
+            attachments.append(part)
+    return text_parts, attachments
+
+
+def estimated_decoded_size(part: Dict) -> int:
+    """Attachment size without downloading it; base64 inflates payloads by 4/3"""
+    if part['encoding'] == 'base64':
+        return part['size'] * 3 // 4
+    return part['size']
+
+
+def decode_part(payload: bytes, encoding: str, charset: str) -> str:
+    """Undo the content-transfer-encoding of a fetched section and decode its charset"""
+    if encoding == 'base64':
+        # Partial fetches may cut the data mid-quantum; decode the complete quanta only
+        payload = re.sub(rb'\s+', b'', payload)
+        payload = payload[:len(payload) - len(payload) % 4]
+        try:
+            payload = base64.b64decode(payload)
+        except (ValueError, TypeError):
+            pass
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def _decode_header_value(value: str) -> str:
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def parse_headers(raw_headers: bytes) -> Dict:
+    """
+    Parse a raw header block into the fields the pipeline needs
+    Returns {'subject', 'from', 'to', 'date', 'headers'} where headers maps lowercase names to decoded values
+    """
+    message = BytesHeaderParser().parsebytes(raw_headers or b'')
+    headers = {}
+    for name, value in message.items():
+        headers.setdefault(name.lower(), _decode_header_value(str(value)))
+
+    from_addresses = [addr for _, addr in getaddresses([headers.get('from', '')]) if addr]
+    to_addresses = tuple(addr for _, addr in getaddresses([headers.get('to', '')]) if addr)
+
+    date = None
+    if headers.get('date'):
+        try:
+            date = parsedate_to_datetime(headers['date'])
+        except (TypeError, ValueError, IndexError):
+            date = None
+
+    return {
+        'subject': headers.get('subject', ''),
+        'from': from_addresses[0].lower() if from_addresses else '',
+        'to': to_addresses,
+        'date': date,
+        'headers': headers,
+    }
@@ -0,0 +1,149 @@
+import os
+import imaplib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple, Optional
+from imap_tools.mailbox import MailBox
+
+# Seconds a session may sit unused before it is logged out
+IMAP_SESSION_IDLE_TIMEOUT = int(os.environ.get('IMAP_SESSION_IDLE_TIMEOUT', '300'))
+# Sessions unused for longer than this are checked with NOOP before being handed out
+IMAP_SESSION_NOOP_INTERVAL = int(os.environ.get('IMAP_SESSION_NOOP_INTERVAL', '30'))
+
+# Errors that mean the underlying connection is no longer usable
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, socket.error, EOFError)
+
+
+class _PooledSession:
+    """A single authenticated MailBox plus the bookkeeping the pool needs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mailbox: Optional[MailBox] = None
+        self.password: Optional[str] = None
+        self.last_used = 0.0
+
+
+class IMAPSessionPool:
+    """
+    Keeps one authenticated MailBox alive per account so that fetches,
+    flag updates and deletes reuse the same TLS connection and LOGIN.
+
+    - Sessions are keyed by (imap_server, email_user)
+    - Each session is used by one caller at a time
+    - Sessions idle longer than noop_interval are checked with NOOP and
+      transparently reconnected if the server dropped them
+    - Sessions idle longer than idle_timeout are logged out by a reaper thread
+    """
+
+    def __init__(self, idle_timeout: int = IMAP_SESSION_IDLE_TIMEOUT,
+                 noop_interval: int = IMAP_SESSION_NOOP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.noop_interval = noop_interval
+        self._sessions: Dict[Tuple[str, str], _PooledSession] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @contextmanager
+    def session(self, imap_server: str, email_user: str, email_password: str):
+        """Borrow an authenticated MailBox for the given account"""
+        entry = self._get_entry(imap_server, email_user)
+
+        with entry.lock:
+            try:
+                mailbox = self._ensure_connected(entry, imap_server, email_user, email_password)
+                yield mailbox
+            except CONNECTION_ERRORS:
+                # Connection died mid-operation; drop it so the next caller reconnects
+                self._close_entry(entry)
+                raise
+            finally:
+                entry.last_used = time.monotonic()
+
+    def _get_entry(self, imap_server: str, email_user: str) -> _PooledSession:
+        key = (imap_server, email_user.lower())
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = _PooledSession()
+                self._sessions[key] = entry
+            self._start_reaper()
+            return entry
+
+    def _ensure_connected(self, entry: _PooledSession, imap_server: str,
+                          email_user: str, email_password: str) -> MailBox:
+        """Return a live MailBox for the entry, reconnecting if needed"""
+        if entry.mailbox is not None and entry.password != email_password:
+            # Credentials changed since the session was opened
+            self._close_entry(entry)
+
+        if entry.mailbox is not None and time.monotonic() - entry.last_used > self.noop_interval:
+            try:
+                entry.mailbox.client.noop()
+            except Exception as e:
+                print(f"IMAP session for {email_user} dropped, reconnecting: {e}")
+                self._close_entry(entry)
+
+        if entry.mailbox is None:
+            entry.mailbox = MailBox(imap_server).login(email_user, email_password)
+            entry.password = email_password
+
+        return entry.mailbox
+
+    def _close_entry(self, entry: _PooledSession):
+        mailbox, entry.mailbox, entry.password = entry.mailbox, None, None
+        if mailbox is None:
+            return
+        try:
+            mailbox.logout()
+        except Exception:
+            # Connection is already gone; nothing left to clean up
+            pass
+
+    def close_idle(self):
+        """Log out every session that has not been used within idle_timeout"""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._sessions.values())
+        for entry in entries:
+            if entry.mailbox is None or now - entry.last_used < self.idle_timeout:
+                continue
+            # Skip sessions that are currently borrowed
+            if entry.lock.acquire(blocking=False):
+                try:
+                    self._close_entry(entry)
+                finally:
+                    entry.lock.release()
+
+    def close_all(self):
+        """Log out every pooled session and stop the reaper"""
+        self._stop.set()
+        with self._lock:
+            entries = list(self._sessions.values())
+            self._sessions.clear()
+        for entry in entries:
+            with entry.lock:
+                self._close_entry(entry)
+
+    def _start_reaper(self):
+        """Start the idle reaper thread on first use (caller holds self._lock)"""
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        self._stop.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name='imap-session-reaper', daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(1, min(self.idle_timeout, 60))
+        while not self._stop.wait(interval):
+            try:
+                self.close_idle()
+            except Exception as e:
+                print(f"Error closing idle IMAP sessions: {e}")
+
+
+# Shared pool used by every EmailService in this process
+session_pool = IMAPSessionPool()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+IMAP IDLE ingestion daemon
+
+Holds one IDLE connection per active email account and runs the normal
+processing pipeline as soon as the server reports new mail (EXISTS), instead
+of waiting for someone to press "Process New Emails". Every IDLE renewal also
+runs a catch-up pass (one UID SEARCH from the watermark when nothing is new),
+so mail whose EXISTS was missed waits at most IMAP_IDLE_TIMEOUT.
+
+Usage: cd src && python ingest_daemon.py
+"""
+
+import os
+import signal
+import threading
+import time
+from imap_tools.mailbox import MailBox
+
+from database import init_db, get_db
+from encryption import decrypt_password
+from processing import process_account
+from change_listener import start_change_listener
+
+# Re-issue IDLE before the server drops it (RFC 2177 allows 29 min; many providers cut off at ~10)
+IMAP_IDLE_TIMEOUT = int(os.environ.get('IMAP_IDLE_TIMEOUT', '540'))
+# How often the IDLE socket is polled, which bounds how long a shutdown takes
+IMAP_IDLE_POLL_INTERVAL = 5
+# Seconds before retrying an account another process was busy with
+LOCKED_RETRY_INTERVAL = 30
+# How often the email_accounts table is re-read to pick up added/removed/changed accounts
+ACCOUNT_REFRESH_INTERVAL = int(os.environ.get('INGEST_ACCOUNT_REFRESH_INTERVAL', '60'))
+# Reconnect backoff bounds in seconds
+RECONNECT_MIN_DELAY = 5
+RECONNECT_MAX_DELAY = 300
+
+
+class AccountWatcher(threading.Thread):
+    """Keeps an IDLE connection open for one account and processes new mail when it arrives"""
+
+    def __init__(self, account):
+        super().__init__(name=f"idle-{account['id']}", daemon=True)
+        self.account = account
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._stop_event.is_set():
+            try:
+                self._watch()
+                delay = RECONNECT_MIN_DELAY
+            except Exception as e:
+                print(f"IDLE connection for {self.account['account_name']} failed: {e}; retrying in {delay}s")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _watch(self):
+        account = self.account
+        password = decrypt_password(account['encrypted_password'])
+
+        # Dedicated connection: a connection in IDLE can't be shared with the session pool
+        with MailBox(account['imap_server']).login(account['email_address'], password) as mailbox:
+            print(f"Watching {account['account_name']} with IMAP IDLE")
+
+            # Catch up on anything that arrived while we were not connected
+            processed = self._process()
+
+            while not self._stop_event.is_set():
+                # Processing runs after every cycle, not only on EXISTS: mail reported while the
+                # previous pass ran, or skipped because the account was busy, is picked up here
+                self._idle(mailbox, IMAP_IDLE_TIMEOUT if processed else LOCKED_RETRY_INTERVAL)
+                if self._stop_event.is_set():
+                    break
+                processed = self._process()
+
+    def _idle(self, mailbox: MailBox, timeout: float):
+        """
+        Run one IDLE cycle
+        The cycle ends on EXISTS, shutdown, or after timeout seconds so IDLE is re-issued in time
+        """
+        mailbox.idle.start()
+        try:
+            deadline = time.monotonic() + timeout
+            while not self._stop_event.is_set() and time.monotonic() < deadline:
+                for response in mailbox.idle.poll(timeout=IMAP_IDLE_POLL_INTERVAL):
+                    if response.startswith(b'* BYE'):
+                        raise ConnectionError(response.decode(errors='replace'))
+                    if response.rstrip().endswith(b'EXISTS'):
+                        return
+        finally:
+            mailbox.idle.stop()
+
+    def _process(self) -> bool:
+        """Process new mail; returns False if another process held the account, so it is retried soon"""
+        try:
+            result = process_account(self.account)
+            if result['processed']:
+                print(f"Processed {len(result['processed'])} new email(s) for {self.account['account_name']}")
+            return not result.get('locked')
+        except Exception as e:
+            print(f"Error processing account {self.account['account_name']}: {e}")
+            return True
+
+
+def get_active_accounts():
+    """Get all active email accounts keyed by id"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, account_name, email_address, imap_server, imap_port, encrypted_password, updated_at
+            FROM email_accounts
+            WHERE is_active = TRUE
+            ORDER BY id
+        ''')
+        return {account['id']: account for account in cursor.fetchall()}
+
+
+def run():
+    """Start one watcher per active account and keep the set in sync with the database"""
+    init_db()
+    start_change_listener()
+
+    shutdown = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown.set())
+    signal.signal(signal.SIGINT, lambda *_: shutdown.set())
+
+    watchers = {}
+    while not shutdown.is_set():
+        try:
+            accounts = get_active_accounts()
+        except Exception as e:
+            print(f"Error loading email accounts: {e}")
+            accounts = None
+
+        if accounts is not None:
+            # Stop watchers for removed, deactivated or edited accounts
+            for account_id, watcher in list(watchers.items()):
+                current = accounts.get(account_id)
+                if current is None or current['updated_at'] != watcher.account['updated_at'] or not watcher.is_alive():
+                    watcher.stop()
+                    del watchers[account_id]
+
+            for account_id, account in accounts.items():
+                if account_id not in watchers:
+                    watcher = AccountWatcher(account)
+                    watchers[account_id] = watcher
+                    watcher.start()
+
+        shutdown.wait(ACCOUNT_REFRESH_INTERVAL)
+
+    print("Shutting down ingestion daemon...")
+    for watcher in watchers.values():
+        watcher.stop()
+    for watcher in watchers.values():
+        watcher.join(timeout=IMAP_IDLE_POLL_INTERVAL * 2)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Local email classifier learned from past Gemini results
+
+A multinomial naive Bayes model over hashed features (subject words and
+bigrams, sender address parts, body words), trained on the classifications
+Gemini already produced in email_processing_log. The model is
+just per-label feature counts in NumPy arrays, so training is incremental:
+new rows are added to the counts without revisiting old ones.
+
+The processing pipeline uses it as a fast path for non-actionable mail when
+it is confident, and calls analyze_email_combined otherwise.
+
+Usage: cd src && python local_model.py train [--full]
+       cd src && python local_model.py info
+"""
+
+import os
+import re
+import sys
+import time
+import zlib
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+LOCAL_MODEL_PATH = os.environ.get(
+    'LOCAL_MODEL_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models', 'email_classifier.npz')
+)
+LOCAL_MODEL_ENABLED = os.environ.get('LOCAL_MODEL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Minimum probability of both the classification and the no-action prediction to skip the AI
+LOCAL_MODEL_THRESHOLD = float(os.environ.get('LOCAL_MODEL_THRESHOLD', '0.9'))
+# Labels with fewer training examples than this are never predicted
+LOCAL_MODEL_MIN_EXAMPLES = int(os.environ.get('LOCAL_MODEL_MIN_EXAMPLES', '20'))
+
+# Hashed feature space; changing it invalidates saved models
+N_FEATURES = 2 ** 16
+# Body words beyond this many are ignored
+MAX_BODY_TOKENS = 300
+# Additive smoothing for feature likelihoods
+ALPHA = 0.1
+# Seconds between checks for a retrained model file
+RELOAD_INTERVAL = 60
+
+# Each target is learned independently from the same features
+TARGETS = ('classification', 'priority', 'sentiment', 'action_required')
+
+_TOKEN_RE = re.compile(r'[a-z0-9][a-z0-9\'$%.-]*[a-z0-9%]|[a-z0-9]')
+
+
+def _tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall((text or '').lower())
+
+
+def _hashed(features) -> np.ndarray:
+    features = list(features)
+    return np.fromiter(
+        (zlib.crc32(feature.encode('utf-8')) % N_FEATURES for feature in features),
+        dtype=np.int64, count=len(features)
+    )
+
+
+def body_features(body: str) -> np.ndarray:
+    """
+    Hashed body word features for one email
+    Logged with every processed email, so training sees the same body features as prediction.
+    """
+    return _hashed('b:' + token for token in _tokens(body)[:MAX_BODY_TOKENS])
+
+
+def featurize(subject: str, sender_email: str, body: str = '', body_hashes: Optional[List[int]] = None) -> np.ndarray:
+    """Hashed feature indices (with repeats) for one email; body_hashes replaces body when given"""
+    features = []
+    subject_tokens = _tokens(subject)
+    features.extend('s:' + token for token in subject_tokens)
+    features.extend(f's:{a}_{b}' for a, b in zip(subject_tokens, subject_tokens[1:]))
+
+    sender = (sender_email or '').lower()
+    local_part, _, domain = sender.rpartition('@')
+    features.append('f:' + sender)
+    if domain:
+        features.append('d:' + domain)
+        # Organisational domain, e.g. mail.example.com -> example.com
+        features.append('d:' + '.'.join(domain.split('.')[-2:]))
+    features.extend('l:' + token for token in _tokens(local_part))
+
+    body = np.asarray(body_hashes, dtype=np.int64) if body_hashes is not None else body_features(body)
+    return np.concatenate([_hashed(features), body])
+
+
+class NaiveBayesModel:
+    """Per-target multinomial naive Bayes over hashed features, stored as raw counts"""
+
+    def __init__(self):
+        # target -> {'labels': [str], 'counts': float32[labels, N_FEATURES], 'docs': float64[labels]}
+        self.targets: Dict[str, Dict] = {}
+        self.last_row_id = 0
+        self.trained_at = 0.0
+        self._log_probs: Dict[str, tuple] = {}
+
+    def partial_fit(self, examples: List[Dict]):
+        """Add examples ({'subject', 'sender_email', 'body' or 'body_features', <target>: label}) to the counts"""
+        for example in examples:
+            features = featurize(example.get('subject'), example.get('sender_email'), example.get('body'),
+                                 example.get('body_features'))
+            for target in TARGETS:
+                label = example.get(target)
+                if label is None or label == '':
+                    continue
+                state = self.targets.setdefault(target, {
+                    'labels': [],
+                    'counts': np.zeros((0, N_FEATURES), dtype=np.float32),
+                    'docs': np.zeros(0, dtype=np.float64),
+                })
+                label = str(label)
+                if label not in state['labels']:
+                    state['labels'].append(label)
+                    state['counts'] = np.vstack([state['counts'], np.zeros((1, N_FEATURES), dtype=np.float32)])
+                    state['docs'] = np.append(state['docs'], 0.0)
+                row = state['labels'].index(label)
+                np.add.at(state['counts'][row], features, 1.0)
+                state['docs'][row] += 1
+        self._log_probs = {}
+
+    def _compiled(self, target: str) -> Optional[tuple]:
+        """(labels, log priors, log likelihoods) for labels with enough examples"""
+        if target not in self._log_probs:
+            state = self.targets.get(target)
+            if state is None:
+                return None
+            keep = state['docs'] >= LOCAL_MODEL_MIN_EXAMPLES
+            if keep.sum() < 2:
+                self._log_probs[target] = None
+                return None
+            counts = state['counts'][keep].astype(np.float64) + ALPHA
+            log_likelihood = np.log(counts / counts.sum(axis=1, keepdims=True)).astype(np.float32)
+            docs = state['docs'][keep]
+            log_prior = np.log(docs / docs.sum())
+            labels = [label for label, k in zip(state['labels'], keep) if k]
+            self._log_probs[target] = (labels, log_prior, log_likelihood)
+        return self._log_probs[target]
+
+    def predict(self, subject: str, sender_email: str, body: str = '') -> Dict[str, tuple]:
+        """{target: (label, probability)} for every target the model can predict"""
+        features = featurize(subject, sender_email, body)
+        result = {}
+        for target in TARGETS:
+            compiled = self._compiled(target)
+            if compiled is None:
+                continue
+            labels, log_prior, log_likelihood = compiled
+            scores = log_prior + log_likelihood[:, features].sum(axis=1)
+            scores = np.exp(scores - scores.max())
+            probabilities = scores / scores.sum()
+            best = int(probabilities.argmax())
+            result[target] = (labels[best], float(probabilities[best]))
+        return result
+
+    def save(self, path: str = LOCAL_MODEL_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        arrays = {
+            'meta': np.array([self.last_row_id, self.trained_at, N_FEATURES], dtype=np.float64),
+        }
+        for target, state in self.targets.items():
+            # Plain unicode arrays, so loading never needs pickle
+            arrays[f'{target}__labels'] = np.array(state['labels'], dtype=np.str_)
+            arrays[f'{target}__counts'] = state['counts']
+            arrays[f'{target}__docs'] = state['docs']
+        # Write then rename so a running process never loads a half-written file
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = LOCAL_MODEL_PATH) -> 'NaiveBayesModel':
+        model = cls()
+        with np.load(path, allow_pickle=False) as data:
+            last_row_id, trained_at, n_features = data['meta']
+            if int(n_features) != N_FEATURES:
+                raise ValueError(f"Model was trained with {int(n_features)} features, expected {N_FEATURES}")
+            model.last_row_id, model.trained_at = int(last_row_id), float(trained_at)
+            for target in TARGETS:
+                if f'{target}__labels' in data:
+                    model.targets[target] = {
+                        'labels': [str(label) for label in data[f'{target}__labels']],
+                        'counts': data[f'{target}__counts'],
+                        'docs': data[f'{target}__docs'],
+                    }
+        return model
+
+
+class _ModelHolder:
+    """Loads the saved model lazily and picks up retrained files without a restart"""
+
+    def __init__(self, path: str = LOCAL_MODEL_PATH):
+        self.path = path
+        self.model: Optional[NaiveBayesModel] = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[NaiveBayesModel]:
+        now = time.monotonic()
+        if now - self._checked_at < RELOAD_INTERVAL:
+            return self.model
+        with self._lock:
+            if now - self._checked_at < RELOAD_INTERVAL:
+                return self.model
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                self.model = None
+                return None
+            if mtime != self._mtime:
+                try:
+                    self.model = NaiveBayesModel.load(self.path)
+                    self._mtime = mtime
+                except Exception as e:
+                    print(f"Error loading local model {self.path}: {e}")
+            return self.model
+
+
+_holder = _ModelHolder()
+
+
+def predict_analysis(subject: str, sender_email: str, body: str = '') -> Optional[Dict]:
+    """
+    Analysis dict in the shape of analyze_email_combined() when the model is confident
+    that the email needs no action, otherwise None (use the AI)
+    """
+    if not LOCAL_MODEL_ENABLED:
+        return None
+    model = _holder.get()
+    if model is None:
+        return None
+
+    prediction = model.predict(subject, sender_email, body)
+    if 'classification' not in prediction or 'action_required' not in prediction:
+        return None
+    classification, class_confidence = prediction['classification']
+    action, action_confidence = prediction['action_required']
+    # Actionable mail needs the AI's summary and entities for the draft
+    if action != 'False' or min(class_confidence, action_confidence) < LOCAL_MODEL_THRESHOLD:
+        return None
+
+    return {
+        'classification': classification,
+        'priority': prediction.get('priority', ('P3', 0.0))[0],
+        'sentiment': prediction.get('sentiment', ('Neutral', 0.0))[0],
+        'entities': [],
+        'summary_narrative': '',
+        'action_required': False,
+        'confidence': round(min(class_confidence, action_confidence), 3)
+    }
+
+
+def _training_rows(last_row_id: int, batch_size: int = 5000):
+    """AI-labelled rows newer than last_row_id, with the body features logged for them"""
+    from database import get_db
+
+    while True:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Skip rows labelled by the local model or pre-classifier, so the model never learns from itself.
+            # The model stands in for the AI, so it learns the AI's priority rather than the one triage
+            # rules produced; rows logged before ai_priority existed only have the final priority
+            cursor.execute('''
+                SELECT l.id, l.subject, l.sender_email, l.classification,
+                       COALESCE(l.ai_priority, l.priority) AS ai_priority, l.sentiment,
+                       l.processing_status, l.body_features
+                FROM email_processing_log l
+                WHERE l.id > %s
+                  AND l.classification IS NOT NULL
+                  AND l.processing_status IN ('processed', 'no_action_required', 'deleted_advert')
+                  AND NOT COALESCE(l.ai_skipped, FALSE)
+                ORDER BY l.id
+                LIMIT %s
+            ''', (last_row_id, batch_size))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_row_id = rows[-1]['id']
+
+
+def train(full: bool = False, path: str = LOCAL_MODEL_PATH) -> NaiveBayesModel:
+    """Train from scratch (full) or add the rows logged since the last training run"""
+    model = None
+    if not full and os.path.exists(path):
+        try:
+            model = NaiveBayesModel.load(path)
+        except ValueError as e:
+            # Files from older versions (pickled labels, other features) can't be extended
+            print(f"Retraining from scratch: {e}")
+    if model is None:
+        model = NaiveBayesModel()
+
+    added = 0
+    for rows in _training_rows(model.last_row_id):
+        model.partial_fit([{
+            'subject': row['subject'],
+            'sender_email': row['sender_email'],
+            # Rows logged before body features were recorded train on subject and sender only
+            'body_features': row['body_features'] or [],
+            'classification': row['classification'],
+            'priority': row['ai_priority'],
+            'sentiment': row['sentiment'],
+            # A draft is only created for emails that need a response
+            'action_required': str(row['processing_status'] == 'processed'),
+        } for row in rows])
+        model.last_row_id = rows[-1]['id']
+        added += len(rows)
+
+    model.trained_at = time.time()
+    model.save(path)
+    print(f"Trained on {added} new example(s); model saved to {path}")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train or inspect the local email classifier')
+    parser.add_argument('command', choices=['train', 'info'])
+    parser.add_argument('--full', action='store_true', help='retrain from scratch instead of incrementally')
+    parser.add_argument('--path', default=LOCAL_MODEL_PATH, help='model file')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train(full=args.full, path=args.path)
+        return
+
+    if not os.path.exists(args.path):
+        print(f"No model at {args.path}; run 'python local_model.py train' first")
+        sys.exit(1)
+    model = NaiveBayesModel.load(args.path)
+    print(f"Model {args.path}: trained up to log row {model.last_row_id} "
+          f"at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(model.trained_at))}")
+    for target, state in model.targets.items():
+        labels = ', '.join(f"{label} ({int(docs)})" for label, docs in zip(state['labels'], state['docs']))
+        print(f"  {target}: {labels}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Compiled multi-pattern matchers for sender and keyword rules
+
+Whitelists and keyword lists are compiled once into a trie-shaped regular
+expression, so a message is scanned in a single pass by the C regex engine
+and the cost per message depends on the length of the text, not on how many
+rules there are. Matching keeps the existing semantics: case-insensitive
+substring matching.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+# Sender fragments that identify newsletters and other bulk mail
+SUBSCRIPTION_INDICATORS = [
+    'newsletter', 'noreply', 'no-reply', 'notifications',
+    'updates', 'mailer', 'news', 'marketing', 'promo',
+    'automated', 'digest', 'subscriptions', 'campaigns'
+]
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Regex source matching any of the words, shaped like a trie so that the
+    engine never retries a shared prefix; longer words are preferred
+    """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node: Dict) -> str:
+        terminal = '' in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            body = branches[0]
+            if terminal:
+                return f'(?:{body})?'
+            return body
+        body = '(?:' + '|'.join(branches) + ')'
+        return body + '?' if terminal else body
+
+    return build(trie)
+
+
+class KeywordAutomaton:
+    """
+    Matches many lowercase keywords against a text in one scan
+
+    Each keyword carries a rank (lower is better); best() returns the best rank
+    of any keyword occurring in the text, overlapping occurrences included.
+    """
+
+    def __init__(self, keywords: Iterable[Tuple[str, int]]):
+        ranks: Dict[str, int] = {}
+        for keyword, rank in keywords:
+            keyword = keyword.strip().lower()
+            if keyword and rank < ranks.get(keyword, rank + 1):
+                ranks[keyword] = rank
+        self.size = len(ranks)
+
+        # The scan reports the longest keyword starting at each position; fold the
+        # ranks of its prefixes (also keywords, starting at the same place) into it
+        self._ranks: Dict[str, int] = {}
+        for keyword, rank in ranks.items():
+            best = rank
+            for end in range(1, len(keyword)):
+                prefix_rank = ranks.get(keyword[:end])
+                if prefix_rank is not None and prefix_rank < best:
+                    best = prefix_rank
+            self._ranks[keyword] = best
+
+        self._any = self._scan = None
+        if ranks:
+            pattern = _trie_pattern(ranks)
+            self._any = re.compile(pattern)
+            # Zero-width lookahead so every start position is tried, catching overlapping keywords
+            self._scan = re.compile(f'(?=({pattern}))')
+
+    def __len__(self):
+        return self.size
+
+    def search(self, text: str) -> bool:
+        """True if any keyword occurs in the (lowercase) text"""
+        return self._any is not None and self._any.search(text) is not None
+
+    def best(self, text: str, stop_at: Optional[int] = None) -> Optional[int]:
+        """
+        Best rank among keywords occurring in the (lowercase) text, or None
+        Scanning stops early once a rank <= stop_at is found
+        """
+        if self._scan is None:
+            return None
+        best = None
+        for match in self._scan.finditer(text):
+            rank = self._ranks[match.group(1)]
+            if best is None or rank < best:
+                best = rank
+                if stop_at is not None and best <= stop_at:
+                    break
+        return best
+
+
+class SenderMatcher:
+    """
+    Compiled sender whitelist
+
+    An entry matches a sender if it occurs anywhere in the sender address
+    (case-insensitive), as the original loops did. Exact addresses and domains
+    are answered from hash sets; everything else goes through one automaton.
+    """
+
+    def __init__(self, entries: Iterable[str]):
+        cleaned = [entry.strip().lower() for entry in entries if entry and entry.strip()]
+        self.addresses = {entry for entry in cleaned if '@' in entry}
+        self.domains = {entry for entry in cleaned if '@' not in entry}
+        self.automaton = KeywordAutomaton((entry, 0) for entry in cleaned)
+
+    def __len__(self):
+        return len(self.automaton)
+
+    def matches(self, sender_email: str) -> bool:
+        sender_lower = sender_email.lower()
+        if sender_lower in self.addresses:
+            return True
+        if '@' in sender_lower and sender_lower.rsplit('@', 1)[1] in self.domains:
+            return True
+        return self.automaton.search(sender_lower)
+
+
+@lru_cache(maxsize=32)
+def _compile_sender_matcher(entries: Tuple[str, ...]) -> SenderMatcher:
+    return SenderMatcher(entries)
+
+
+def sender_matcher(entries: Union[SenderMatcher, List[str], Tuple[str, ...]]) -> SenderMatcher:
+    """Compiled matcher for a whitelist; identical lists share one compiled matcher"""
+    if isinstance(entries, SenderMatcher):
+        return entries
+    return _compile_sender_matcher(tuple(entries))
+
+
+_subscription_indicators = KeywordAutomaton((indicator, 0) for indicator in SUBSCRIPTION_INDICATORS)
+
+
+def is_subscription_sender(sender_email: str) -> bool:
+    """True if the sender address looks like bulk mail (newsletter, no-reply, ...)"""
+    return _subscription_indicators.search(sender_email.lower())
+
+
+def validate_sender(sender_email: str, whitelist, subscriptions_whitelist) -> str:
+    """
+    Validate sender against whitelist and subscriptions whitelist
+    Returns: 'whitelisted', 'subscription_not_whitelisted', or 'unknown'
+    """
+    # Check whitelist (high priority senders)
+    if sender_matcher(whitelist).matches(sender_email):
+        return 'whitelisted'
+
+    # Detect subscription/newsletter emails using common patterns
+    if is_subscription_sender(sender_email):
+        # Check if this subscription is whitelisted (allowed to keep)
+        if sender_matcher(subscriptions_whitelist).matches(sender_email):
+            return 'unknown'  # Process normally (it's a wanted subscription)
+
+        # Subscription not in whitelist - should be unsubscribed/deleted
+        return 'subscription_not_whitelisted'
+
+    # Not a subscription, process normally
+    return 'unknown'
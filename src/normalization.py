@@ -0,0 +1,99 @@
+"""
+Email body normalization
+
+Cuts quoted reply chains and signatures and tidies whitespace in a single pass
+over the lines of a message. All patterns are compiled once at import and are
+anchored to a single line, so the cost is linear in the size of the body no
+matter how many quoted messages a forwarded thread contains.
+"""
+import re
+from typing import List
+
+from html_extract import html_to_text
+
+# Lines containing any of these start a signature (same markers as before)
+SIGNATURE_MARKERS = ['--', '___', 'Best regards', 'Sincerely', 'Thanks,', 'Regards,']
+
+# Separators some clients put above the quoted message
+REPLY_SEPARATORS = ['-----Original Message-----', '________________________________']
+
+# How many lines below "From:" the rest of an Outlook-style quote header may appear
+QUOTE_HEADER_WINDOW = 8
+
+# Cheap first filter: only lines matching this are looked at more closely
+_CANDIDATE_RE = re.compile(
+    '|'.join(re.escape(marker) for marker in SIGNATURE_MARKERS + REPLY_SEPARATORS)
+    + r'|^[\s>*]*(?:On\s|From:)'
+)
+_SIGNATURE_RE = re.compile('|'.join(re.escape(marker) for marker in SIGNATURE_MARKERS))
+_ON_WROTE_RE = re.compile(r'^[\s>*]*On\s')
+_WROTE_RE = re.compile(r'\bwrote:')
+_FROM_RE = re.compile(r'^[\s>*]*From:')
+_QUOTE_FIELD_RE = re.compile(r'^[\s>*]*(Sent|To|Subject):', re.IGNORECASE)
+
+
+def _is_quote_header(lines: List[str], i: int) -> bool:
+    """'From:' followed closely by 'Sent:', 'To:' and 'Subject:' lines (Outlook quote header)"""
+    fields = set()
+    for line in lines[i + 1:i + 1 + QUOTE_HEADER_WINDOW]:
+        match = _QUOTE_FIELD_RE.match(line)
+        if match:
+            fields.add(match.group(1).lower())
+    return fields >= {'sent', 'to', 'subject'}
+
+
+def find_boundary(lines: List[str]) -> int:
+    """
+    Index of the first line that starts a quoted reply or a signature
+    Returns len(lines) if the message has neither
+    """
+    for i, line in enumerate(lines):
+        if not _CANDIDATE_RE.search(line):
+            continue
+        if _SIGNATURE_RE.search(line):
+            return i
+        if any(separator in line for separator in REPLY_SEPARATORS):
+            return i
+        if _ON_WROTE_RE.match(line):
+            # Gmail wraps long "On <date>, <name> wrote:" attributions onto a second line
+            if _WROTE_RE.search(line) or (i + 1 < len(lines) and _WROTE_RE.search(lines[i + 1])):
+                return i
+        if _FROM_RE.match(line) and _is_quote_header(lines, i):
+            return i
+    return len(lines)
+
+
+def normalize_text(content: str) -> str:
+    """
+    Strip reply chains and signatures from a plain-text body and clean up whitespace
+    Lines are stripped and runs of blank lines collapse to a single blank line
+    """
+    lines = content.split('\n')
+    lines = lines[:find_boundary(lines)]
+
+    cleaned = []
+    blank = False
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if blank:
+                continue
+            blank = True
+        else:
+            blank = False
+        cleaned.append(line)
+    return '\n'.join(cleaned).strip()
+
+
+def normalize_body(body_html: str, body_text: str) -> str:
+    """
+    Normalize an email body, preferring the text part and falling back to converted HTML
+    Module-level so it can run in the normalization worker processes
+    """
+    if body_text:
+        content = body_text
+    elif body_html:
+        content = html_to_text(body_html)
+    else:
+        return ""
+    return normalize_text(content)
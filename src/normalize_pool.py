@@ -0,0 +1,192 @@
+"""
+Process pool for CPU-bound body normalization
+
+HTML extraction and reply/signature stripping are pure Python and hold the GIL,
+so running them on request threads stalls every other request in the web
+process during a large drain. Large bodies are sent to a pool of worker
+processes instead; small ones are cheaper to normalize inline than to pickle.
+
+A body that runs longer than NORMALIZE_TIMEOUT in a worker (time spent queued
+does not count) is treated as hostile: the pool is terminated (killing the
+stuck worker), rebuilt, and the body falls back to a cheap truncated version
+of its text part, or of its HTML with the tags stripped.
+"""
+import os
+import re
+import html
+import time
+import atexit
+import itertools
+import threading
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from normalization import normalize_body
+from html_extract import HTML_TEXT_MAX_CHARS
+
+# Worker processes; 0 normalizes everything inline on the calling thread
+NORMALIZE_WORKERS = int(os.environ.get('NORMALIZE_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+# Seconds one body may take in a worker before the pool is killed and rebuilt
+NORMALIZE_TIMEOUT = float(os.environ.get('NORMALIZE_TIMEOUT', '10'))
+# Bodies smaller than this (bytes of HTML + text) are normalized inline
+NORMALIZE_INLINE_BYTES = int(os.environ.get('NORMALIZE_INLINE_BYTES', str(16 * 1024)))
+
+# Start-time slots shared with the workers; more jobs than this in flight at once reuse slots
+_START_SLOTS = 4096
+_TAG_RE = re.compile(r'<[^>]*>')
+
+# Worker side: the pool's start-time array, set by _init_worker
+_job_starts = None
+
+
+def _init_worker(starts):
+    global _job_starts
+    _job_starts = starts
+
+
+def _normalize_job(slot: int, body_html: str, body_text: str) -> str:
+    """normalize_body() in a worker, recording when the job was picked up"""
+    _job_starts[slot] = time.time()
+    return normalize_body(body_html, body_text)
+
+
+def _fallback(body_html: str, body_text: str) -> str:
+    """Cheap stand-in for a body whose normalization was killed"""
+    limit = HTML_TEXT_MAX_CHARS or None
+    if body_text:
+        return ' '.join(body_text[:limit].split())
+    if body_html:
+        # Plain tag strip; a few times the text cap of markup is plenty for limit characters of text
+        text = html.unescape(_TAG_RE.sub(' ', body_html[:limit * 4 if limit else None]))
+        return ' '.join(text.split())[:limit]
+    return ''
+
+
+class NormalizationPool:
+    """
+    Runs normalize_body() in worker processes with a per-body timeout
+
+    - normalize_batch() takes [(body_html, body_text), ...] and returns texts in order
+    - Safe to call from many threads; the pool is started on first use
+    - Workers are spawned, not forked, so they never inherit the web process's
+      threads, database connections or IMAP sockets
+    """
+
+    def __init__(self, workers: int = NORMALIZE_WORKERS, timeout: float = NORMALIZE_TIMEOUT,
+                 inline_bytes: int = NORMALIZE_INLINE_BYTES):
+        self.workers = workers
+        self.timeout = timeout
+        self.inline_bytes = inline_bytes
+        self._pool = None
+        # When each job was picked up by a worker (0 while queued), indexed by slot
+        self._starts = None
+        self._slots = itertools.count()
+        # Bumped every time the pool is rebuilt, so callers can tell their jobs were lost
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> Tuple[object, int, object]:
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context('spawn')
+                self._starts = context.RawArray('d', _START_SLOTS)
+                self._pool = context.Pool(self.workers, initializer=_init_worker, initargs=(self._starts,))
+            return self._pool, self._generation, self._starts
+
+    def _submit(self, pool, starts, body: Tuple[str, str]) -> Tuple[object, int]:
+        with self._lock:
+            slot = next(self._slots) % _START_SLOTS
+        starts[slot] = 0.0
+        return pool.apply_async(_normalize_job, (slot,) + tuple(body)), slot
+
+    def _wait(self, job, slot: int, starts, generation: int) -> str:
+        """
+        Result of a job; raises multiprocessing.TimeoutError once it has run for self.timeout
+        in a worker, or when the pool it was queued on has been rebuilt
+        Time spent queued behind other callers' jobs does not count.
+        """
+        while True:
+            if job.ready():
+                return job.get(0)
+            started = starts[slot]
+            remaining = started + self.timeout - time.time() if started else self.timeout
+            if remaining <= 0 or self._generation != generation:
+                raise multiprocessing.TimeoutError()
+            try:
+                return job.get(remaining)
+            except multiprocessing.TimeoutError:
+                continue
+
+    def _rebuild(self, generation: int):
+        """Kill the pool if it is still the one the caller used; the next call starts a fresh one"""
+        with self._lock:
+            if self._generation != generation or self._pool is None:
+                return
+            self._pool.terminate()
+            self._pool = None
+            self._generation += 1
+
+    def normalize(self, body_html: str, body_text: str) -> str:
+        return self.normalize_batch([(body_html, body_text)])[0]
+
+    def normalize_batch(self, bodies: List[Tuple[str, str]]) -> List[str]:
+        results: List[Optional[str]] = [None] * len(bodies)
+        remote = []
+        for i, (body_html, body_text) in enumerate(bodies):
+            body_html, body_text = body_html or '', body_text or ''
+            if self.workers <= 0 or len(body_html) + len(body_text) < self.inline_bytes:
+                results[i] = normalize_body(body_html, body_text)
+            else:
+                remote.append(i)
+
+        retried = set()
+        while remote:
+            pool, generation, starts = self._get_pool()
+            jobs = [(i, *self._submit(pool, starts, bodies[i])) for i in remote]
+            remote = []
+            for position, (i, job, slot) in enumerate(jobs):
+                try:
+                    results[i] = self._wait(job, slot, starts, generation)
+                    continue
+                except multiprocessing.TimeoutError:
+                    pass
+                except Exception as e:
+                    print(f"Error normalizing email body in worker: {e}")
+                    results[i] = _fallback(*bodies[i])
+                    continue
+
+                if self._generation != generation and i not in retried:
+                    # Another caller killed the pool under us; our jobs were innocent, resubmit them
+                    retried.update(j for j, _, _ in jobs[position:])
+                    remote = [j for j, later, _ in jobs[position:] if not self._collect(later, results, j)]
+                    break
+
+                print(f"Normalizing an email body took longer than {self.timeout}s; restarting normalization workers")
+                results[i] = _fallback(*bodies[i])
+                # Keep what already finished, resubmit the rest to a fresh pool
+                remote = [j for j, later, _ in jobs[position + 1:] if not self._collect(later, results, j)]
+                self._rebuild(generation)
+                break
+        return results
+
+    @staticmethod
+    def _collect(job, results: list, i: int) -> bool:
+        """Store a finished job's result; returns False if it has not finished"""
+        if not job.ready():
+            return False
+        try:
+            results[i] = job.get(0)
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+# Shared by every EmailService in this process
+normalization_pool = NormalizationPool()
+atexit.register(normalization_pool.close)
@@ -0,0 +1,145 @@
+"""
+Local first-pass classifier for bulk mail
+
+Scores an email from its headers, sender address and body for the signals
+that bulk senders are required (or in the habit of) including: List-Unsubscribe,
+Precedence: bulk, Auto-Submitted, ESP tracking headers, no-reply senders and
+"unsubscribe" footers. Confident newsletter / marketing / notification cases
+skip the Gemini call entirely; everything else goes to the AI as before.
+A local decision never deletes mail: processing marks those emails read, and
+only an AI classification can send an advert to queue_delete.
+"""
+import os
+import re
+from typing import Dict, List
+
+from matching import is_subscription_sender
+
+PRECLASSIFIER_ENABLED = os.environ.get('PRECLASSIFIER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Minimum confidence for the local decision to replace the AI analysis
+PRECLASSIFIER_THRESHOLD = float(os.environ.get('PRECLASSIFIER_THRESHOLD', '0.8'))
+
+# Headers set by email service providers and marketing platforms
+ESP_HEADER_PREFIXES = (
+    'x-mailchimp', 'x-mc-user', 'x-campaign', 'x-sg-eid', 'x-sendgrid', 'x-mailgun', 'x-mailjet',
+    'x-ses-outgoing', 'x-sfmc', 'x-hubspot', 'x-klaviyo', 'x-marketo', 'x-brevo', 'x-sib-id',
+    'x-constantcontact', 'x-emarsys', 'x-rpcampaign', 'x-newsletter', 'feedback-id', 'x-feedback-id',
+)
+ESP_MAILER_RE = re.compile(
+    r'mailchimp|sendgrid|mailgun|mailjet|sendinblue|brevo|hubspot|klaviyo|marketo|salesforce|'
+    r'exacttarget|constant ?contact|campaign ?monitor|acoustic|braze|customer\.io|phplist|mautic',
+    re.IGNORECASE
+)
+_PROMO_SUBJECT_RE = re.compile(
+    r'\d+\s?% off|\bsale\b|\bdeals?\b|\boffer\b|\bdiscount\b|\bcoupon\b|\bfree shipping\b|\blast chance\b|'
+    r'\blimited time\b|\bshop now\b|\bbuy now\b|\bexclusive\b|\bsave (?:up to )?[$€£]?\d',
+    re.IGNORECASE
+)
+_UNSUBSCRIBE_RE = re.compile(r'unsubscribe|opt[ -]out|manage (?:your )?(?:email )?preferences|email preferences', re.IGNORECASE)
+_VIEW_ONLINE_RE = re.compile(r'view (?:this email )?(?:in|on) (?:your|a|the) browser|view online|view as a web ?page', re.IGNORECASE)
+# Security mail must reach the AI so it lands in the Security Alerts summary
+_SECURITY_RE = re.compile(
+    r'security|password|sign[ -]?in|log[ -]?in|breach|suspicious|verif|unauthori[sz]ed|2fa|two-factor|vulnerab',
+    re.IGNORECASE
+)
+_NO_REPLY_RE = re.compile(r'^(?:no-?reply|do-?not-?reply|notifications?|alerts?|mailer-daemon)@', re.IGNORECASE)
+
+
+def _score(email_data: Dict) -> Dict:
+    headers = email_data.get('headers') or {}
+    sender_email = email_data.get('sender_email') or ''
+    subject = email_data.get('subject') or ''
+    body = (email_data.get('body_text') or email_data.get('body_html') or '')[:20000]
+
+    bulk = 0.0
+    notification = 0.0
+    promo = 0.0
+    reasons: List[str] = []
+
+    if 'list-unsubscribe' in headers:
+        bulk += 0.45
+        reasons.append('list-unsubscribe')
+    if 'list-unsubscribe-post' in headers:
+        bulk += 0.1
+        reasons.append('one-click-unsubscribe')
+    if 'list-id' in headers:
+        bulk += 0.2
+        reasons.append('list-id')
+    if (headers.get('precedence') or '').strip().lower() in ('bulk', 'list', 'junk'):
+        bulk += 0.3
+        reasons.append('precedence-bulk')
+    if any(name.startswith(ESP_HEADER_PREFIXES) for name in headers) or ESP_MAILER_RE.search(headers.get('x-mailer') or ''):
+        bulk += 0.3
+        reasons.append('esp')
+
+    auto_submitted = (headers.get('auto-submitted') or '').strip().lower()
+    if auto_submitted and auto_submitted != 'no':
+        notification += 0.6
+        reasons.append('auto-submitted')
+    if _NO_REPLY_RE.match(sender_email):
+        notification += 0.3
+        reasons.append('no-reply-sender')
+
+    if is_subscription_sender(sender_email):
+        bulk += 0.15
+        reasons.append('bulk-sender')
+    if _UNSUBSCRIBE_RE.search(body):
+        bulk += 0.2
+        reasons.append('unsubscribe-footer')
+    if _VIEW_ONLINE_RE.search(body):
+        bulk += 0.1
+        reasons.append('view-online')
+    if _PROMO_SUBJECT_RE.search(subject):
+        promo += 0.3
+        reasons.append('promo-subject')
+
+    # Replies in a thread are conversations, whatever else they look like
+    if 'in-reply-to' in headers or subject.lower().startswith(('re:', 'aw:', 'sv:')):
+        bulk -= 0.6
+        notification -= 0.6
+        reasons.append('reply')
+
+    return {'bulk': bulk, 'notification': notification, 'promo': promo, 'reasons': reasons}
+
+
+def preclassify(email_data: Dict) -> Dict:
+    """
+    Local classification of an email as bulk mail
+    Returns {'decision', 'confidence', 'reasons', 'skip_ai'} where decision is
+    'Marketing', 'Newsletter', 'Notification' or None (no opinion)
+    """
+    scores = _score(email_data)
+    bulk, notification, promo = scores['bulk'], scores['notification'], scores['promo']
+
+    if notification > 0 and notification + max(0.0, bulk) * 0.5 >= bulk:
+        decision, confidence = 'Notification', notification + max(0.0, bulk) * 0.5
+    elif bulk > 0:
+        decision = 'Marketing' if promo > 0 or 'esp' in scores['reasons'] else 'Newsletter'
+        confidence = bulk + promo
+    else:
+        decision, confidence = None, 0.0
+
+    confidence = round(max(0.0, min(confidence, 1.0)), 2)
+    security = bool(_SECURITY_RE.search(email_data.get('subject') or ''))
+    if security:
+        scores['reasons'].append('security-terms')
+    return {
+        'decision': decision,
+        'confidence': confidence,
+        'reasons': scores['reasons'],
+        'skip_ai': (PRECLASSIFIER_ENABLED and decision is not None and not security
+                    and confidence >= PRECLASSIFIER_THRESHOLD)
+    }
+
+
+def analysis_from_preclassification(preclassification: Dict, email_data: Dict) -> Dict:
+    """Stand-in for analyze_email_combined() when the local decision is confident"""
+    return {
+        'classification': preclassification['decision'],
+        'priority': 'P3',
+        'sentiment': 'Neutral',
+        'entities': [],
+        'summary_narrative': f"{preclassification['decision']} email from {email_data.get('sender_email', '')} "
+                             f"(classified locally: {', '.join(preclassification['reasons'])}).",
+        'action_required': False
+    }
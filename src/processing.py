@@ -0,0 +1,461 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from database import get_db, get_sync_state, save_sync_state, account_lock
+from email_service import EmailService
+from triage import should_delete
+from config_cache import config_cache
+from preclassifier import preclassify, analysis_from_preclassification
+from local_model import predict_analysis, body_features
+from draft_engine import draft_engine
+from analysis_batcher import analysis_batcher
+from ai_executor import AI_MAX_IN_FLIGHT
+from encryption import decrypt_password
+
+# Maximum number of new messages fetched per account per run; the rest drain on later runs
+FETCH_BATCH_SIZE = int(os.environ.get('FETCH_BATCH_SIZE', '50'))
+# Accounts processed in parallel by /api/process-emails
+ACCOUNT_CONCURRENCY = int(os.environ.get('ACCOUNT_CONCURRENCY', '4'))
+# Emails of one account processed in parallel
+PER_ACCOUNT_CONCURRENCY = int(os.environ.get('PER_ACCOUNT_CONCURRENCY', '4'))
+# Runs an email may fail before it is logged as an error and skipped for good
+MAX_EMAIL_ATTEMPTS = int(os.environ.get('MAX_EMAIL_ATTEMPTS', '3'))
+# Emails processed in parallel across all accounts in this process; defaults to the
+# AI requests allowed in flight, since the AI calls are the slow part of each email
+GLOBAL_EMAIL_CONCURRENCY = int(os.environ.get('GLOBAL_EMAIL_CONCURRENCY', str(AI_MAX_IN_FLIGHT)))
+
+_email_slots = threading.BoundedSemaphore(GLOBAL_EMAIL_CONCURRENCY)
+
+
+def process_email(email_service, account, email_data, validation_result, rules):
+    """
+    Run one email through normalization, AI analysis, triage and draft creation
+    Returns a summary dict when a draft was created, otherwise None.
+    Mailbox changes are queued on email_service and applied by the caller.
+    """
+    subscriptions_whitelist = rules['subscriptions_whitelist']
+    triage = rules['triage']
+    
+    sender_email = email_data['sender_email']
+    
+    if validation_result == 'subscription_not_whitelisted':
+        # Skip subscription emails not in whitelist (auto-unsubscribe/delete)
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO email_processing_log 
+                (email_id, sender_email, subject, received_at, processing_status, validation_result, account_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ''', (
+                email_data['id'],
+                sender_email,
+                email_data['subject'],
+                email_data['date'],
+                'rejected',
+                validation_result,
+                account['id']
+            ))
+        return None
+    
+    # Normalize content
+    normalized_content = email_service.normalize_content(
+        email_data.get('body_html', ''),
+        email_data.get('body_text', '')
+    )
+    
+    # Hashed body words for the log, the training data of the local model
+    logged_body_features = body_features(normalized_content).tolist()
+    
+    # Cheap local pass first: confident newsletters, adverts and notifications skip the AI call
+    # and are only marked read, never deleted. Whitelisted senders always get the full analysis.
+    preclassification = preclassify(email_data) if validation_result != 'whitelisted' else None
+    ai_skipped = bool(preclassification and preclassification['skip_ai'])
+    pre_decision = (preclassification['decision'] or 'none') if preclassification else None
+    pre_confidence = preclassification['confidence'] if preclassification else None
+    
+    # Second local pass: the model trained on past AI results (local_model.py), for mail it is sure needs no action
+    model_analysis = None
+    if preclassification and not ai_skipped:
+        model_analysis = predict_analysis(email_data['subject'], sender_email, normalized_content)
+        if model_analysis:
+            ai_skipped = True
+            pre_decision = f"model:{model_analysis['classification']}"[:50]
+            pre_confidence = model_analysis['confidence']
+    
+    if model_analysis:
+        analysis = model_analysis
+    elif ai_skipped:
+        analysis = analysis_from_preclassification(preclassification, email_data)
+    else:
+        # AI Processing - COMBINED (1 API call instead of 4); short emails may share a batch request
+        analysis = analysis_batcher.analyze(
+            email_data['subject'],
+            normalized_content,
+            sender_email,
+            email_data.get('has_attachments', False),
+            email_data.get('attachments', [])
+        )
+    
+    # Extract results from combined analysis
+    classification = analysis.get('classification', 'General Inquiry')
+    ai_priority = analysis.get('priority', 'P2')
+    sentiment = analysis.get('sentiment', 'Neutral')
+    entities = analysis.get('entities', [])
+    summary_narrative = analysis.get('summary_narrative', '')
+    summary_text = summary_narrative
+    action_required = analysis.get('action_required', False)
+    
+    # Check if this is a pure advert (marketing email not in subscriptions whitelist); deletion
+    # needs the AI's word, so a local decision only marks the email read
+    is_pure_advert = should_delete(classification, sender_email, subscriptions_whitelist, ai_skipped)
+    
+    if is_pure_advert:
+        # Queue permanent deletion; applied in one expunge at the end of the run
+        email_service.queue_delete(email_data['id'])
+        
+        # Log the deletion
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO email_processing_log 
+                (email_id, sender_email, subject, received_at, processing_status, 
+                 classification, priority, sentiment, validation_result, account_id,
+                 preclassifier_decision, preclassifier_confidence, ai_skipped, ai_priority, body_features)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', (
+                email_data['id'],
+                sender_email,
+                email_data['subject'],
+                email_data['date'],
+                'deleted_advert',
+                classification,
+                ai_priority,
+                sentiment,
+                'pure_advertisement',
+                account['id'],
+                pre_decision,
+                pre_confidence,
+                ai_skipped,
+                ai_priority,
+                logged_body_features
+            ))
+        return None  # Skip to next email
+    
+    # Apply triaging matrix to determine final priority
+    priority = triage.apply(
+        sender_email,
+        email_data['subject'],
+        normalized_content,
+        ai_priority
+    )
+    
+    # Check if email requires action (skip draft creation for informational emails)
+    if not action_required:
+        # Mark email as read and log as no action required
+        email_service.queue_mark_as_read(email_data['id'])
+        
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO email_processing_log 
+                (email_id, sender_email, subject, received_at, processing_status, 
+                 classification, priority, sentiment, validation_result, account_id,
+                 preclassifier_decision, preclassifier_confidence, ai_skipped, ai_priority, body_features)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', (
+                email_data['id'],
+                sender_email,
+                email_data['subject'],
+                email_data['date'],
+                'no_action_required',
+                classification,
+                priority,
+                sentiment,
+                'informational_only',
+                account['id'],
+                pre_decision,
+                pre_confidence,
+                ai_skipped,
+                ai_priority,
+                logged_body_features
+            ))
+        return None  # Skip draft generation
+    
+    # Generate draft response - only for actionable emails.
+    # A linked template is rendered locally where possible (draft_engine.py); without one, the
+    # draft the analysis call already wrote in fused mode (AI_FUSED_DRAFT) is used before asking the AI.
+    draft = draft_engine.draft(
+        email_data['subject'],
+        normalized_content,
+        sender_email,
+        classification,
+        priority,
+        entities,
+        fused_draft=analysis.get('draft')
+    )
+    
+    # Save draft to database
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO email_drafts 
+            (original_email_id, sender_email, recipient_email, subject, body, 
+             classification, priority, sentiment, extracted_data, original_content, summary, status, account_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (
+            email_data['id'],
+            sender_email,
+            account['email_address'],
+            draft.get('subject'),
+            draft.get('body'),
+            classification,
+            priority,
+            sentiment,
+            json.dumps(entities),
+            normalized_content,
+            summary_text,
+            'pending',
+            account['id']
+        ))
+        draft_id = cursor.fetchone()['id']
+        
+        # Log processing
+        cursor.execute('''
+            INSERT INTO email_processing_log 
+            (email_id, sender_email, subject, received_at, processing_status, 
+             classification, priority, sentiment, validation_result, account_id,
+             preclassifier_decision, preclassifier_confidence, ai_skipped, ai_priority, body_features)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (
+            email_data['id'],
+            sender_email,
+            email_data['subject'],
+            email_data['date'],
+            'processed',
+            classification,
+            priority,
+            sentiment,
+            validation_result,
+            account['id'],
+            pre_decision,
+            pre_confidence,
+            ai_skipped,
+            ai_priority,
+            logged_body_features
+        ))
+    
+    # Mark email as read so it won't be reprocessed
+    email_service.queue_mark_as_read(email_data['id'])
+    
+    return {
+        'account_name': account['account_name'],
+        'email_id': email_data['id'],
+        'draft_id': draft_id,
+        'classification': classification,
+        'priority': priority
+    }
+
+
+def _collect_results(done, in_flight, account, processed, errors, completed, failed):
+    """
+    Record the outcome of finished email futures and remove them from in_flight
+    UIDs go into completed, or into failed as uid -> (email_data, error message).
+    """
+    for future in done:
+        email_data = in_flight.pop(future)
+        uid = int(email_data['id'])
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error processing email {email_data['id']} for account {account['account_name']}: {e}")
+            errors.append({
+                'account_name': account['account_name'],
+                'email_id': email_data['id'],
+                'error': str(e)
+            })
+            failed[uid] = (email_data, str(e))
+            continue
+        completed.add(uid)
+        if result:
+            processed.append(result)
+
+
+def _give_up(account, email_data, error):
+    """Log an email that failed MAX_EMAIL_ATTEMPTS times so the watermark can move past it"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO email_processing_log 
+            (email_id, sender_email, subject, received_at, processing_status, error_message, account_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (
+            email_data['id'],
+            email_data['sender_email'],
+            email_data['subject'],
+            email_data['date'],
+            'error',
+            error,
+            account['id']
+        ))
+
+
+def _process_email_bounded(email_service, account, email_data, validation_result, rules):
+    """process_email() gated by the process-wide concurrency cap"""
+    with _email_slots:
+        return process_email(email_service, account, email_data, validation_result, rules)
+
+
+def process_account(account):
+    """
+    Fetch and process new emails for a single email account
+    Shared by the /api/process-emails endpoint and the IDLE ingestion daemon.
+    Emails are picked up from the account's UID watermark, so calling this again
+    only processes mail that arrived since the previous call.
+    Returns {'processed': [draft summaries], 'errors': [per-email errors]}, plus 'locked': True
+    when another process held the account and nothing was done.
+    """
+    with account_lock(account['id']) as acquired:
+        if not acquired:
+            print(f"Account {account['account_name']} is already being processed elsewhere, skipping")
+            return {'processed': [], 'errors': [], 'locked': True}
+        
+        processed = []
+        errors = []
+        email_service = None
+        sync = None
+        uids = []
+        done_uids = set()
+        attempts = {}
+        mutations = {}
+        completed = set()
+        failed = {}
+        exhausted = False
+        try:
+            # Decrypt password
+            password = decrypt_password(account['encrypted_password'])
+            
+            # Initialize email service for this account
+            email_service = EmailService(
+                account['imap_server'],
+                account['email_address'],
+                password
+            )
+            
+            # Whitelists and triage rules come precompiled from the shared config cache, so a
+            # run over many accounts loads and compiles the configurations table once
+            config = config_cache.get()
+            whitelist = config.whitelist
+            subscriptions_whitelist = config.subscriptions_whitelist
+            
+            rules = {
+                'whitelist': whitelist,
+                'subscriptions_whitelist': subscriptions_whitelist,
+                'triage': config.triage
+            }
+            
+            # Find emails newer than the stored UID watermark
+            state = get_sync_state(account['id'], 'INBOX')
+            uids, sync = email_service.sync_window(
+                last_uid=state['last_uid'] if state else 0,
+                uidvalidity=state['uidvalidity'] if state else None,
+                limit=FETCH_BATCH_SIZE
+            )
+            
+            # Emails above the watermark finished on earlier runs are not redone; UIDs only
+            # carry over while UIDVALIDITY is unchanged
+            if state and state['uidvalidity'] == sync['uidvalidity']:
+                done_uids = {int(uid) for uid in state['done_uids'] or []}
+                attempts = {int(uid): count for uid, count in (state['failed_attempts'] or {}).items()}
+                mutations = {int(uid): action for uid, action in (state['pending_mutations'] or {}).items()}
+            
+            # Emails processed on an earlier run whose read flag or deletion was not applied only
+            # get that retried; processing them again would duplicate their drafts and log rows
+            for uid, action in mutations.items():
+                if action == 'delete':
+                    email_service.queue_delete(str(uid))
+                else:
+                    email_service.queue_mark_as_read(str(uid))
+            pending = [uid for uid in uids if int(uid) not in done_uids and int(uid) not in mutations]
+            
+            # Senders are validated on headers alone; only accepted emails get their text bodies downloaded
+            validation_results = {}
+            
+            def wants_body(email_data):
+                result = email_service.validate_sender(email_data['sender_email'], whitelist, subscriptions_whitelist)
+                validation_results[email_data['id']] = result
+                return result != 'subscription_not_whitelisted'
+            
+            # Stream emails off the wire and process them concurrently while later chunks are
+            # still being fetched, bounded per account and across all accounts
+            with ThreadPoolExecutor(max_workers=PER_ACCOUNT_CONCURRENCY) as executor:
+                in_flight = {}
+                try:
+                    for email_data in email_service.iter_emails(pending, body_filter=wants_body):
+                        future = executor.submit(
+                            _process_email_bounded, email_service, account, email_data,
+                            validation_results[email_data['id']], rules
+                        )
+                        in_flight[future] = email_data
+                        
+                        # Backpressure keeps memory flat on large backlog drains
+                        if len(in_flight) >= PER_ACCOUNT_CONCURRENCY * 2:
+                            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                            _collect_results(done, in_flight, account, processed, errors, completed, failed)
+                        if failed:
+                            # Stop fetching; the rest of the window is picked up next run
+                            break
+                    else:
+                        exhausted = True
+                finally:
+                    # Emails already handed to workers finish either way, so their outcome is recorded
+                    done, _ = wait(in_flight)
+                    _collect_results(done, in_flight, account, processed, errors, completed, failed)
+            
+            processed.sort(key=lambda item: int(item['email_id']))
+            
+            # An email failing on every run would pin the watermark, so it is eventually logged and skipped
+            for uid, (email_data, error) in failed.items():
+                attempts[uid] = attempts.get(uid, 0) + 1
+                if attempts[uid] >= MAX_EMAIL_ATTEMPTS:
+                    _give_up(account, email_data, error)
+                    completed.add(uid)
+        finally:
+            # Apply queued read flags and deletions in one batch per folder
+            unapplied = {}
+            if email_service is not None:
+                flush = email_service.flush_mutations()
+                unapplied = {int(uid): action for uid, action in flush['failed'].items()}
+            if sync is not None:
+                # Watermark: just below the first UID of the window that is not finished. UIDs the
+                # fetch never returned were expunged meanwhile, unless fetching stopped early.
+                finished = done_uids | completed | (set(mutations) - set(unapplied))
+                if exhausted:
+                    finished |= {int(uid) for uid in pending} - set(failed)
+                # A read flag or deletion that did not go through keeps its email unfinished, so the
+                # next run retries it, until it has failed MAX_EMAIL_ATTEMPTS times
+                for uid in list(unapplied):
+                    attempts[uid] = attempts.get(uid, 0) + 1
+                    if attempts[uid] >= MAX_EMAIL_ATTEMPTS:
+                        print(f"Giving up on marking/deleting email {uid} for {account['account_name']}")
+                        del unapplied[uid]
+                        finished.add(uid)
+                finished -= set(unapplied)
+                unfinished = [int(uid) for uid in uids if int(uid) not in finished]
+                if unfinished:
+                    sync_uid = unfinished[0] - 1
+                elif uids:
+                    sync_uid = int(uids[-1])
+                else:
+                    sync_uid = sync['last_uid']
+                save_sync_state(
+                    account['id'], 'INBOX', sync['uidvalidity'], sync_uid,
+                    done_uids={uid for uid in finished if uid > sync_uid},
+                    failed_attempts={str(uid): count for uid, count in attempts.items()
+                                     if uid > sync_uid and uid not in finished},
+                    pending_mutations={str(uid): action for uid, action in unapplied.items() if uid > sync_uid}
+                )
+        
+        return {'processed': processed, 'errors': errors}
@@ -0,0 +1,150 @@
+"""
+Triaging matrix: final priority from sender, subject and body rules
+
+Rules come from the configurations table (config_type 'whitelist',
+'subject_keyword' and 'body_keyword', with the priority in category) and are
+compiled into a TriageRuleset once, with one keyword automaton per field.
+"""
+from typing import Dict, List
+
+from matching import KeywordAutomaton, sender_matcher
+
+# Triage categories and the priority they assign
+TRIAGE_PRIORITY_MAP = {
+    'High Priority': 'P0',
+    'Important': 'P2',
+    'Low Priority': 'P3'
+}
+
+
+def get_priority_level(priority):
+    """Convert priority string to numeric level for comparison (lower is higher priority)"""
+    priority_levels = {
+        'P0': 0,
+        'P1': 1,
+        'P2': 2,
+        'P3': 3
+    }
+    return priority_levels.get(priority, 2)
+
+
+def _split_keywords(config_value: str) -> List[str]:
+    """One configuration entry may hold several comma-separated keywords"""
+    return [k.strip().lower() for k in (config_value or '').split(',') if k.strip()]
+
+
+class TriageRuleset:
+    """
+    Compiled triaging matrix
+
+    Precedence is unchanged from the original rule loops:
+    - The first sender rule (in configuration order) matching the sender sets the priority,
+      overriding the AI priority
+    - Subject keyword rules, then body keyword rules, may only upgrade the priority
+    """
+
+    def __init__(self, sender_priorities: List[Dict], subject_keywords: List[Dict], body_keywords: List[Dict]):
+        # Sender rules rank by position so the first matching rule wins
+        self._sender_priorities: List[str] = []
+        sender_rules = []
+        for sender_config in sender_priorities:
+            category = sender_config.get('category', '')
+            if category in TRIAGE_PRIORITY_MAP:
+                sender_rules.append((sender_config['config_value'], len(self._sender_priorities)))
+                self._sender_priorities.append(TRIAGE_PRIORITY_MAP[category])
+        self.sender = KeywordAutomaton(sender_rules)
+
+        # Keyword rules rank by the priority level they assign
+        self.subject = KeywordAutomaton(self._keyword_rules(subject_keywords))
+        self.body = KeywordAutomaton(self._keyword_rules(body_keywords))
+
+    @staticmethod
+    def _keyword_rules(keyword_configs: List[Dict]):
+        for keyword_config in keyword_configs:
+            category = keyword_config.get('category', '')
+            if category not in TRIAGE_PRIORITY_MAP:
+                continue
+            level = get_priority_level(TRIAGE_PRIORITY_MAP[category])
+            for keyword in _split_keywords(keyword_config['config_value']):
+                yield keyword, level
+
+    def __len__(self):
+        return len(self.sender) + len(self.subject) + len(self.body)
+
+    def apply(self, sender_email: str, subject: str, body: str, ai_priority: str) -> str:
+        """Final priority for an email given the AI's priority"""
+        final_priority = ai_priority
+
+        # Check sender whitelist (highest priority)
+        rule = self.sender.best(sender_email.lower(), stop_at=0)
+        if rule is not None:
+            final_priority = self._sender_priorities[rule]
+
+        # Check subject keywords, then body keywords; each can only upgrade
+        for automaton, text in ((self.subject, subject), (self.body, body)):
+            current = get_priority_level(final_priority)
+            if current == 0 or not len(automaton):
+                continue
+            level = automaton.best(text.lower(), stop_at=0)
+            if level is not None and level < current:
+                final_priority = 'P%d' % level
+
+        return final_priority
+
+
+def is_advertisement(classification, sender_email, subscriptions_whitelist):
+    """
+    Determine if an email is a pure advertisement that should be deleted.
+
+    Criteria for pure adverts:
+    - Classified as Marketing, Spam, Promotional, Newsletter, or similar
+    - NOT in the subscriptions whitelist (emails you want to keep)
+    - Contains typical marketing/promotional language
+
+    Returns True if the email should be permanently deleted
+    """
+    # Marketing-related classifications that indicate adverts
+    advert_classifications = [
+        'marketing',
+        'spam',
+        'promotional',
+        'advertisement',
+        'newsletter',
+        'sales',
+        'offer'
+    ]
+
+    # Check if classification matches advert patterns
+    classification_lower = classification.lower()
+    is_marketing = any(advert_type in classification_lower for advert_type in advert_classifications)
+
+    if not is_marketing:
+        return False
+
+    # Check if sender is in subscriptions whitelist (keep these)
+    if sender_matcher(subscriptions_whitelist).matches(sender_email):
+        return False  # Keep whitelisted newsletters
+
+    # It's marketing and not whitelisted = pure advert to delete
+    return True
+
+
+def should_delete(classification, sender_email, subscriptions_whitelist, ai_skipped):
+    """
+    Whether processing permanently deletes an email: a pure advert, classified by the AI
+    Deletion can't be undone, so a local classification (ai_skipped) only ever marks the email read.
+    Shared by processing and the backtest so both apply the same rule.
+    """
+    return not ai_skipped and is_advertisement(classification, sender_email, subscriptions_whitelist)
+
+
+def apply_triaging_matrix(sender_email, subject, body, ai_priority, sender_priorities, subject_keywords, body_keywords):
+    """
+    Apply triaging matrix rules to determine final priority.
+    Priority order: Sender whitelist > Subject keywords > Body keywords > AI priority
+    Priority levels: High Priority = P0/P1, Important = P2, Low Priority = P3
+    Compiles the rules on every call; hot paths should build a TriageRuleset once and reuse it.
+    """
+    return TriageRuleset(sender_priorities, subject_keywords, body_keywords).apply(
+        sender_email, subject, body, ai_priority
+    )